@@ -0,0 +1,202 @@
+"""Per-user library analytics, maintained incrementally.
+
+Each completed analysis adds its emotion scores, tempo, stem energies and
+predicted popularity to its owner's UserAnalyticsRollup. The values it added
+are kept on the analysis as ``rollup_snapshot``. Re-analysing a song
+subtracts the old snapshot before adding the new one, and deleting a song
+subtracts it. Reading the analytics touches one row, whatever the size of
+the library.
+"""
+from django.db import transaction
+from .models import SongAnalysis, UserAnalyticsRollup, STEM_FIELD_PREFIXES, EMOTION_FIELDS
+
+# Emotion scores are in [0, 1]
+EMOTION_BINS = 20
+TEMPO_BIN_WIDTH = 10
+# 0-250 BPM; the last bin also holds anything faster
+TEMPO_BINS = 25
+TOP_SONGS = 10
+PERCENTILES = (10, 25, 50, 75, 90)
+
+ENERGY_FIELDS = [f'{prefix}_energy' for prefix in STEM_FIELD_PREFIXES.values()]
+
+
+def _bin(value, width, bins):
+    return min(max(int(value / width), 0), bins - 1)
+
+
+def snapshot(analysis):
+    """The values ``analysis`` contributes to its owner's rollup"""
+    return {
+        'emotions': {emotion: getattr(analysis, emotion) for emotion in EMOTION_FIELDS},
+        'tempo': analysis.tempo,
+        'energies': {field: getattr(analysis, field) for field in ENERGY_FIELDS},
+        'popularity': analysis.track_popularity_prediction,
+    }
+
+
+def _apply(rollup, values, sign):
+    rollup.song_count += sign
+    for emotion, score in values['emotions'].items():
+        rollup.emotion_sums[emotion] = rollup.emotion_sums.get(emotion, 0.0) + sign * score
+        histogram = rollup.emotion_histograms.setdefault(emotion, [0] * EMOTION_BINS)
+        histogram[_bin(score, 1.0 / EMOTION_BINS, EMOTION_BINS)] += sign
+
+    if values['tempo'] is not None:
+        if not rollup.tempo_histogram:
+            rollup.tempo_histogram = [0] * TEMPO_BINS
+        rollup.tempo_count += sign
+        rollup.tempo_sum += sign * values['tempo']
+        rollup.tempo_histogram[_bin(values['tempo'], TEMPO_BIN_WIDTH, TEMPO_BINS)] += sign
+
+    for field, energy in values['energies'].items():
+        rollup.energy_sums[field] = rollup.energy_sums.get(field, 0.0) + sign * energy
+
+    if values['popularity'] is not None:
+        rollup.popularity_count += sign
+        rollup.popularity_sum += sign * values['popularity']
+
+
+def _refill_top_songs(rollup):
+    """Rebuild the top list with one indexed, LIMITed query"""
+    rollup.top_songs = [
+        {'song_id': song_id, 'title': title, 'popularity': popularity}
+        for song_id, title, popularity in SongAnalysis.objects.filter(
+            song__user_id=rollup.user_id,
+            rollup_snapshot__isnull=False,
+            track_popularity_prediction__isnull=False
+        ).order_by('-track_popularity_prediction').values_list(
+            'song_id', 'song__title', 'track_popularity_prediction'
+        )[:TOP_SONGS]
+    ]
+
+
+def _locked_rollup(user_id, create=True):
+    if create:
+        rollup, created = UserAnalyticsRollup.objects.select_for_update().get_or_create(user_id=user_id)
+        return rollup
+    return UserAnalyticsRollup.objects.select_for_update().filter(user_id=user_id).first()
+
+
+def record(analysis):
+    """Add a completed analysis (with ``song`` loaded) to its owner's rollup"""
+    values = snapshot(analysis)
+    song = analysis.song
+    with transaction.atomic():
+        # The stored snapshot, not the caller's copy: a concurrent record()
+        # may have replaced it since ``analysis`` was loaded. The analysis is
+        # locked before the rollup, the order a delete takes them in.
+        previous_values = SongAnalysis.objects.select_for_update().filter(
+            pk=analysis.pk
+        ).values_list('rollup_snapshot', flat=True).first()
+        rollup = _locked_rollup(song.user_id)
+        if previous_values:
+            _apply(rollup, previous_values, -1)
+        _apply(rollup, values, 1)
+        SongAnalysis.objects.filter(pk=analysis.pk).update(rollup_snapshot=values)
+        analysis.rollup_snapshot = values
+
+        previous = next((entry for entry in rollup.top_songs if entry['song_id'] == song.id), None)
+        popularity = values['popularity']
+        if previous and (popularity is None or popularity < previous['popularity']):
+            # A listed song whose score dropped may now rank below unlisted ones
+            _refill_top_songs(rollup)
+        else:
+            top_songs = [entry for entry in rollup.top_songs if entry['song_id'] != song.id]
+            if popularity is not None:
+                top_songs.append({'song_id': song.id, 'title': song.title, 'popularity': popularity})
+            top_songs.sort(key=lambda entry: entry['popularity'], reverse=True)
+            rollup.top_songs = top_songs[:TOP_SONGS]
+        rollup.save()
+
+
+def remove(analysis):
+    """Subtract a deleted analysis from its owner's rollup"""
+    if not analysis.rollup_snapshot:
+        return
+    with transaction.atomic():
+        rollup = _locked_rollup(analysis.song.user_id, create=False)
+        if rollup is None:
+            return
+        _apply(rollup, analysis.rollup_snapshot, -1)
+        top_songs = [entry for entry in rollup.top_songs if entry['song_id'] != analysis.song_id]
+        if len(top_songs) < len(rollup.top_songs):
+            rollup.top_songs = top_songs
+            _refill_top_songs(rollup)
+        rollup.save()
+
+
+def rebuild_for_users(user_ids):
+    """Recompute rollups from scratch, e.g. after a backfill or bulk import"""
+    for user_id in user_ids:
+        with transaction.atomic():
+            rollup = _locked_rollup(user_id)
+            fresh = UserAnalyticsRollup(user_id=user_id)
+            analyses = SongAnalysis.objects.filter(song__user_id=user_id, is_complete=True).only(
+                *EMOTION_FIELDS, *ENERGY_FIELDS, 'tempo', 'track_popularity_prediction'
+            )
+            updated = []
+            for analysis in analyses.iterator(chunk_size=1000):
+                analysis.rollup_snapshot = snapshot(analysis)
+                _apply(fresh, analysis.rollup_snapshot, 1)
+                updated.append(analysis)
+            SongAnalysis.objects.filter(song__user_id=user_id).update(rollup_snapshot=None)
+            SongAnalysis.objects.bulk_update(updated, ['rollup_snapshot'], batch_size=500)
+            _refill_top_songs(fresh)
+            fresh.pk = rollup.pk
+            fresh.save()
+
+
+def _percentile(histogram, q, width):
+    """Linearly interpolated percentile of a fixed-width histogram"""
+    total = sum(histogram)
+    if total <= 0:
+        return None
+    target = total * q / 100
+    seen = 0
+    for index, count in enumerate(histogram):
+        if count and seen + count >= target:
+            return round((index + (target - seen) / count) * width, 4)
+        seen += count
+    return round(len(histogram) * width, 4)
+
+
+def _mean(total, count):
+    return round(total / count, 4) if count else None
+
+
+def emotion_summary(rollup):
+    return {
+        emotion: {
+            'mean': _mean(rollup.emotion_sums.get(emotion, 0.0), rollup.song_count),
+            'percentiles': {
+                f'p{q}': _percentile(rollup.emotion_histograms.get(emotion, []), q, 1.0 / EMOTION_BINS)
+                for q in PERCENTILES
+            },
+        }
+        for emotion in EMOTION_FIELDS
+    }
+
+
+def tempo_summary(rollup):
+    return {
+        'mean': _mean(rollup.tempo_sum, rollup.tempo_count),
+        'histogram': [
+            {'min_bpm': index * TEMPO_BIN_WIDTH, 'count': count}
+            for index, count in enumerate(rollup.tempo_histogram)
+        ],
+    }
+
+
+def energy_summary(rollup):
+    return {
+        field: _mean(rollup.energy_sums.get(field, 0.0), rollup.song_count)
+        for field in ENERGY_FIELDS
+    }
+
+
+def popularity_summary(rollup):
+    return {
+        'mean': _mean(rollup.popularity_sum, rollup.popularity_count),
+        'top_songs': rollup.top_songs,
+    }
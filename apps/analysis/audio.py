@@ -0,0 +1,87 @@
+"""Decode-once audio buffer shared by every stage of the analysis pipeline.
+
+The upload is decoded a single time at its native rate; each consumer asks for
+the view it needs and gets an in-memory array resampled with soxr:
+
+- 22.05 kHz mono for the librosa features
+- 44.1 kHz stereo for Spleeter
+
+OpenL3 embeds the separated stems, not the mix. ``resample`` brings those
+to 48 kHz.
+"""
+import os
+import numpy as np
+import librosa
+import soundfile as sf
+
+FEATURE_SR = 22050
+SEPARATION_SR = 44100
+EMBEDDING_SR = 48000
+RESAMPLE_TYPE = 'soxr_hq'
+
+
+def resample(y, orig_sr, target_sr):
+    """Resample along the last axis, returning ``y`` untouched if rates match"""
+    if orig_sr == target_sr:
+        return y
+    return librosa.resample(y, orig_sr=orig_sr, target_sr=target_sr, res_type=RESAMPLE_TYPE)
+
+
+class AudioBuffer:
+    def __init__(self, y, sr, path=None):
+        # Always (channels, samples) float32
+        self.y = np.atleast_2d(np.asarray(y, dtype=np.float32))
+        self.sr = sr
+        self.path = path
+        self._views = {}
+
+    @classmethod
+    def load(cls, audio_path):
+        """Decode a file once at its native sample rate"""
+        try:
+            y, sr = sf.read(audio_path, dtype='float32', always_2d=True)
+            y = y.T
+        except RuntimeError:
+            # Formats libsndfile can't read (older mp3 builds, m4a) go
+            # through librosa's audioread fallback.
+            y, sr = librosa.load(audio_path, sr=None, mono=False)
+        return cls(y, sr, path=audio_path)
+
+    @classmethod
+    def from_source(cls, source):
+        """Accept either an AudioBuffer or a path to decode"""
+        if isinstance(source, cls):
+            return source
+        return cls.load(source)
+
+    @property
+    def name(self):
+        if not self.path:
+            return 'audio'
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+    @property
+    def duration(self):
+        return self.y.shape[1] / self.sr
+
+    def view(self, sr, mono=True):
+        """Return (and cache) the buffer at ``sr``, downmixed if ``mono``"""
+        key = (sr, mono)
+        if key not in self._views:
+            y = librosa.to_mono(self.y) if mono else self.y
+            self._views[key] = resample(y, self.sr, sr)
+        return self._views[key]
+
+    def for_features(self):
+        return self.view(FEATURE_SR, mono=True)
+
+    def for_separation(self):
+        """Stereo 44.1 kHz waveform shaped (samples, channels) for Spleeter"""
+        y = self.view(SEPARATION_SR, mono=False)
+        if y.shape[0] == 1:
+            y = np.repeat(y, 2, axis=0)
+        return y.T
+
+    def release(self):
+        """Drop the cached views once every consumer has run"""
+        self._views.clear()
@@ -0,0 +1,187 @@
+"""Batch analysis for nightly re-analysis and catalog imports.
+
+Features are extracted in a process pool, one song per task. Celery's
+prefork children are daemonic and the stdlib refuses to fork from them, so
+inside a worker the pool comes from billiard (Celery's own multiprocessing
+fork), which allows it. Workers started with ``--pool threads`` or
+``--pool solo`` are not daemonic and use the stdlib pool. The feature
+rows are stacked so the scaler and the forest run once over the whole batch,
+and the results are written back with ``bulk_update``. With ``with_stems``
+the batch also runs stem separation and embeds the stems of every song in
+the batch together.
+
+A batch claims its songs' analyses like a single-song task does (see
+scheduling.claim_batch). It skips songs another run holds, refreshes the
+heartbeat as it goes, and writes back only the rows it still owns.
+"""
+import logging
+import multiprocessing
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from apps.music.models import Song
+from .models import SongAnalysis, STEM_FIELD_PREFIXES
+from .viral_analyzer import ViralSongAnalyzer
+from .vectors import encode_matrix
+from . import registry, content_cache, read_cache, analytics, scheduling
+
+logger = logging.getLogger(__name__)
+
+# Seconds between heartbeats while features are extracted
+HEARTBEAT_SECONDS = 60
+
+FEATURE_FIELDS = [
+    'tempo', 'mfcc_features', 'spectral_features', 'chroma_features',
+    'duration_ms', 'feature_timeline', 'timeline_segment_seconds',
+    'track_popularity_prediction', 'model_version',
+] + content_cache.EMOTION_FIELDS
+
+STEM_FIELDS = [f'{prefix}_energy' for prefix in STEM_FIELD_PREFIXES.values()]
+
+
+def _collect(results, on_result=None):
+    collected = []
+    for result in results:
+        collected.append(result)
+        if on_result:
+            on_result()
+    return collected
+
+
+def extract_all(paths, processes=None, on_result=None):
+    """Extract features for every path, in parallel where possible"""
+    if processes == 1 or len(paths) < 2:
+        return _collect(map(ViralSongAnalyzer.extract_audio_features, paths), on_result)
+    if multiprocessing.current_process().daemon:
+        return _extract_in_daemon(paths, processes, on_result)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return _collect(pool.map(ViralSongAnalyzer.extract_audio_features, paths), on_result)
+
+
+def _extract_in_daemon(paths, processes, on_result):
+    """Extract from inside a daemonic process such as a Celery prefork child"""
+    try:
+        from billiard import Pool
+    except ImportError:
+        logger.warning(
+            "billiard is not installed; extracting %d songs serially in a daemonic worker", len(paths)
+        )
+        return _collect(map(ViralSongAnalyzer.extract_audio_features, paths), on_result)
+    pool = Pool(processes)
+    try:
+        return _collect(pool.imap(ViralSongAnalyzer.extract_audio_features, paths), on_result)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def analyze_batch(song_ids, processes=None, with_stems=False):
+    """Analyse a batch of songs; returns the number of analyses written"""
+    task_id = f'batch-{uuid.uuid4()}'
+    songs = [song for song in Song.objects.filter(id__in=song_ids) if song.file]
+    previous_states = scheduling.claim_batch([song.id for song in songs], task_id)
+    songs = [song for song in songs if song.id in previous_states]
+    try:
+        return _analyze_claimed(songs, task_id, processes, with_stems)
+    finally:
+        scheduling.release_batch(task_id, previous_states)
+
+
+def _analyze_claimed(songs, task_id, processes, with_stems):
+    if not songs:
+        return 0
+
+    last_beat = time.monotonic()
+
+    def beat():
+        nonlocal last_beat
+        if time.monotonic() - last_beat >= HEARTBEAT_SECONDS:
+            scheduling.heartbeat(task_id=task_id)
+            last_beat = time.monotonic()
+
+    features = extract_all([song.file.path for song in songs], processes, on_result=beat)
+
+    viral_analyzer = registry.get_viral_analyzer()
+    scored = [(song, song_features) for song, song_features in zip(songs, features) if song_features]
+    popularity = viral_analyzer.predict_virality_batch([song_features for _, song_features in scored])
+
+    stem_results = {}
+    if with_stems:
+        # Stems are held in memory until embedded, so only a few songs
+        # share each embedding batch
+        music_detector = registry.get_music_detector()
+        step = settings.ANALYSIS_STEM_BATCH_SONGS
+        for start in range(0, len(songs), step):
+            chunk = songs[start:start + step]
+            results = music_detector.analyze_stems_batch([song.file.path for song in chunk])
+            stem_results.update({song.id: result for song, result in zip(chunk, results) if result})
+            scheduling.heartbeat(task_id=task_id)
+
+    # claim_batch created any missing rows
+    existing = {analysis.song_id: analysis for analysis in SongAnalysis.objects.filter(song__in=songs)}
+
+    now = timezone.now()
+    updated = []
+    for (song, song_features), prediction in zip(scored, popularity):
+        analysis = existing[song.id]
+        analysis.song = song
+        for emotion, score in viral_analyzer.analyze_emotion_impact(song_features).items():
+            setattr(analysis, emotion, score)
+        analysis.tempo = song_features['tempo']
+        analysis.mfcc_features = song_features['mfcc_features']
+        analysis.spectral_features = song_features['spectral_features']
+        analysis.chroma_features = song_features['chroma_features']
+        analysis.duration_ms = song_features['duration_ms']
+        analysis.feature_timeline = encode_matrix(song_features['timeline'])
+        analysis.timeline_segment_seconds = song_features['segment_seconds']
+        analysis.track_popularity_prediction = prediction
+        analysis.model_version = viral_analyzer.model_version
+
+        result = stem_results.get(song.id)
+        if result:
+            for stem_name, proportion in result['proportions'].items():
+                setattr(analysis, f'{STEM_FIELD_PREFIXES[stem_name]}_energy', proportion)
+        analysis.features_complete = True
+        analysis.stems_complete = analysis.stems_complete or bool(result)
+        analysis.is_complete = analysis.is_complete or bool(result)
+        analysis.error_message = None
+        if analysis.is_complete:
+            analysis.state = SongAnalysis.STATE_COMPLETED
+            analysis.finished_at = now
+        analysis.updated_at = now
+        updated.append(analysis)
+
+    fields = FEATURE_FIELDS + [
+        'features_complete', 'stems_complete', 'is_complete', 'error_message', 'state', 'finished_at',
+        'updated_at',
+    ]
+    if with_stems:
+        fields += STEM_FIELDS
+
+    with transaction.atomic():
+        # Rows this batch held too long may have been taken over meanwhile
+        owned = set(SongAnalysis.objects.select_for_update().filter(
+            pk__in=[analysis.pk for analysis in updated], task_id=task_id
+        ).values_list('pk', flat=True))
+        updated = [analysis for analysis in updated if analysis.pk in owned]
+        SongAnalysis.objects.bulk_update(updated, fields, batch_size=500)
+        for analysis in updated:
+            result = stem_results.get(analysis.song_id)
+            if result:
+                analysis.set_embeddings(result['embeddings'])
+        Song.objects.filter(
+            id__in=[analysis.song_id for analysis in updated if analysis.is_complete]
+        ).update(is_analyzed=True, updated_at=now)
+    # bulk_update skips post_save, so drop the cached payloads here
+    read_cache.invalidate(*[analysis.id for analysis in updated])
+
+    for analysis in updated:
+        if analysis.song_id in stem_results:
+            content_cache.store_result(analysis)
+        if analysis.is_complete:
+            analytics.record(analysis)
+
+    return len(updated)
@@ -0,0 +1,322 @@
+"""Micro-benchmarks for the analysis pipeline.
+
+Synthetic tracks are generated deterministically from a seed, written once
+as 16-bit stereo wavs and reused across runs:
+
+    10s, 3min, 60min
+
+Every stage the tasks run is timed on each track:
+
+- decode: ``AudioBuffer.load``
+- extract_audio_features: the streaming feature pass
+- score: ``predict_virality`` plus ``analyze_emotion_impact``
+- separate_stems, compute_energy_db, get_openl3_embedding
+- analyze_stems: separation, energies and the batched embedding
+- pipeline: the work of ``analyze_song_task``'s two branches, end to end,
+  without the database and the broker
+
+Each case runs ``warmup`` untimed rounds and then ``rounds`` timed ones,
+like pytest-benchmark. It reports min/median/mean/stddev and the peak RSS of
+the rounds. The peak is reset before every round through
+``/proc/self/clear_refs``, so each stage reports its own high-water mark.
+Where that file is missing, the process-wide ``ru_maxrss`` is used instead.
+
+With ``stub_models`` Spleeter and OpenL3 are replaced by StubSeparator and
+StubEmbeddingEngine. These are cheap deterministic filters with the same
+inputs and outputs, so the suite runs on CPU-only machines without
+TensorFlow or model downloads. Their timings stand in for the heavy models
+and are only comparable with other stub runs.
+"""
+import json
+import os
+import platform
+import statistics
+import time
+import numpy as np
+import soundfile as sf
+import librosa
+from scipy import signal
+from django.utils import timezone
+from .audio import AudioBuffer, SEPARATION_SR, EMBEDDING_SR, resample
+from .embeddings import EmbeddingEngine, EMBEDDING_SIZE, HOP_PRESETS
+from .music_detector import MusicDetector
+from .instrumentation import peak_rss_supported, reset_peak_rss, peak_rss_mb
+
+TRACKS = {
+    '10s': 10,
+    '3min': 180,
+    '60min': 3600,
+}
+# Bump when synthesize() changes so stale fixtures are regenerated
+FIXTURE_VERSION = 1
+FIXTURE_SR = SEPARATION_SR
+STAGES = (
+    'decode', 'extract_audio_features', 'score', 'separate_stems',
+    'compute_energy_db', 'get_openl3_embedding', 'analyze_stems', 'pipeline',
+)
+# Relative slowdown (or RSS growth) reported as a regression
+DEFAULT_THRESHOLD = 0.10
+
+
+# Fixtures
+
+def synthesize(path, seconds, sr=FIXTURE_SR, seed=0, block_seconds=10):
+    """Write a deterministic stereo test track, block by block.
+
+    A two-second chord progression, a kick on every beat at 120 BPM, a
+    hi-hat on the off-beats and low-level noise, so every stem has content.
+    """
+    rng = np.random.default_rng(seed)
+    chords = np.array([[220.0, 277.2, 329.6], [196.0, 246.9, 293.7], [174.6, 220.0, 261.6], [196.0, 246.9, 311.1]])
+    beat = sr // 2
+    block = int(block_seconds * sr)
+    total = int(seconds * sr)
+    with sf.SoundFile(path, 'w', samplerate=sr, channels=2, subtype='PCM_16') as f:
+        for start in range(0, total, block):
+            t = np.arange(start, min(start + block, total)) / sr
+            chord = chords[(t // 2).astype(int) % len(chords)]
+            pad = np.sin(2 * np.pi * chord * t[:, None]).sum(axis=1) * 0.12
+            since_beat = (np.arange(start, start + len(t)) % beat) / sr
+            kick = np.sin(2 * np.pi * 55 * since_beat) * np.exp(-since_beat * 30) * 0.5
+            since_offbeat = ((np.arange(start, start + len(t)) + beat // 2) % beat) / sr
+            noise = rng.standard_normal(len(t))
+            hat = noise * np.exp(-since_offbeat * 200) * 0.15 + noise * 0.01
+            f.write(np.stack([pad + kick + hat, pad * 0.8 + kick + hat], axis=1).astype(np.float32))
+
+
+def fixture(name, directory, seed=0):
+    """Path of the named synthetic track, generated on first use"""
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, f'synthetic_{name}_s{seed}_v{FIXTURE_VERSION}')
+    path = f'{stem}.wav'
+    if not os.path.exists(path):
+        # soundfile picks the format from the extension
+        part = f'{stem}.part.wav'
+        synthesize(part, TRACKS[name], seed=seed)
+        os.replace(part, path)
+    return path
+
+
+# Stub models
+
+class StubSeparator:
+    """Band-split stand-in for Spleeter's 4-stem separator.
+
+    Returns the four stems as (samples, channels) float32 arrays, like
+    ``Separator.separate``.
+    """
+
+    def __init__(self, sr=SEPARATION_SR):
+        self.bands = {
+            'bass': signal.butter(4, 250, 'lowpass', fs=sr, output='sos'),
+            'vocals': signal.butter(4, [300, 3000], 'bandpass', fs=sr, output='sos'),
+            'drums': signal.butter(4, 5000, 'highpass', fs=sr, output='sos'),
+        }
+
+    def separate(self, waveform):
+        waveform = np.asarray(waveform, dtype=np.float32)
+        stems = {
+            name: signal.sosfilt(sos, waveform, axis=0).astype(np.float32)
+            for name, sos in self.bands.items()
+        }
+        stems['other'] = waveform - stems['bass'] - stems['vocals'] - stems['drums']
+        return stems
+
+
+class StubEmbeddingEngine(EmbeddingEngine):
+    """OpenL3-shaped embeddings from a fixed random projection.
+
+    Frames follow OpenL3's one-second windows at ``hop_size``. Each frame is
+    summarised by the RMS of 64 sub-blocks and projected to 512 dimensions.
+    """
+    WINDOW_BLOCKS = 64
+
+    def __init__(self, hop_size=None, batch_size=32, preset='default', seed=0):
+        self.model = None
+        self.hop_size = hop_size if hop_size is not None else HOP_PRESETS[preset]
+        self.batch_size = batch_size
+        self.projection = np.random.default_rng(seed).standard_normal(
+            (self.WINDOW_BLOCKS, EMBEDDING_SIZE)
+        ).astype(np.float32)
+
+    def frame_embeddings(self, waveforms):
+        block = EMBEDDING_SR // self.WINDOW_BLOCKS
+        hop_blocks = self.hop_size * EMBEDDING_SR / block
+        embeddings = []
+        for y, sr in waveforms:
+            y = resample(np.asarray(y, dtype=np.float32), sr, EMBEDDING_SR)
+            n_blocks = max(len(y) // block, self.WINDOW_BLOCKS)
+            y = np.pad(y, (0, max(0, n_blocks * block - len(y))))[:n_blocks * block]
+            rms = np.sqrt(np.mean(y.reshape(n_blocks, block) ** 2, axis=1))
+            n_frames = 1 + int((n_blocks - self.WINDOW_BLOCKS) / hop_blocks)
+            starts = np.round(np.arange(n_frames) * hop_blocks).astype(int)
+            windows = rms[starts[:, None] + np.arange(self.WINDOW_BLOCKS)]
+            embeddings.append(windows @ self.projection)
+        return embeddings
+
+
+def stub_music_detector(hop_size=None):
+    return MusicDetector(
+        in_memory=True,
+        embedding_engine=StubEmbeddingEngine(hop_size=hop_size),
+        separator=StubSeparator()
+    )
+
+
+# Harness
+
+def measure(fn, rounds=3, warmup=1):
+    """Time ``fn()`` over ``rounds`` runs after ``warmup`` untimed ones"""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    peak = 0.0
+    for _ in range(rounds):
+        reset_peak_rss()
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+        peak = max(peak, peak_rss_mb())
+    return {
+        'rounds': rounds,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'stddev': statistics.stdev(timings) if rounds > 1 else 0.0,
+        'peak_rss_mb': round(peak, 1),
+    }
+
+
+def _stage_cases(path, viral_analyzer, music_detector):
+    """``{stage: fn}`` for one track; inputs of later stages are prepared once"""
+    audio = AudioBuffer.load(path)
+    features = viral_analyzer.extract_audio_features(path)
+    stems = music_detector.separate_stems(audio)
+    mono_stems = {name: music_detector._load_stem(stem) for name, stem in stems.items()}
+    del stems
+
+    def decode():
+        AudioBuffer.load(path)
+
+    def extract_audio_features():
+        viral_analyzer.extract_audio_features(path)
+
+    def score():
+        viral_analyzer.predict_virality(features)
+        viral_analyzer.analyze_emotion_impact(features)
+
+    def separate_stems():
+        music_detector.separate_stems(audio)
+
+    def compute_energy_db():
+        for y, sr in mono_stems.values():
+            music_detector.compute_energy_db(y, sr)
+
+    def get_openl3_embedding():
+        for y, sr in mono_stems.values():
+            music_detector.get_openl3_embedding(y, sr)
+
+    def analyze_stems():
+        music_detector.analyze_stems(audio)
+
+    def pipeline():
+        track_features = viral_analyzer.extract_audio_features(path)
+        viral_analyzer.analyze_emotion_impact(track_features)
+        viral_analyzer.predict_virality(track_features)
+        track = AudioBuffer.load(path)
+        music_detector.analyze_stems(track)
+        track.release()
+
+    return {
+        'decode': decode,
+        'extract_audio_features': extract_audio_features,
+        'score': score,
+        'separate_stems': separate_stems,
+        'compute_energy_db': compute_energy_db,
+        'get_openl3_embedding': get_openl3_embedding,
+        'analyze_stems': analyze_stems,
+        'pipeline': pipeline,
+    }
+
+
+def run(tracks=tuple(TRACKS), stages=STAGES, rounds=3, warmup=1, fixtures_dir='benchmark_fixtures',
+        stub_models=True, seed=0, log=print):
+    """Benchmark ``stages`` on each of ``tracks``; returns the JSON-able report"""
+    if stub_models:
+        from .viral_analyzer import ViralSongAnalyzer
+        viral_analyzer, music_detector = ViralSongAnalyzer(), stub_music_detector()
+    else:
+        from . import registry
+        viral_analyzer, music_detector = registry.load_models(warm_up=True)
+
+    results = {}
+    for name in tracks:
+        path = fixture(name, fixtures_dir, seed)
+        log(f"{name}: preparing inputs")
+        cases = _stage_cases(path, viral_analyzer, music_detector)
+        results[name] = {}
+        for stage in stages:
+            results[name][stage] = measure(cases[stage], rounds=rounds, warmup=warmup)
+            log(f"{name} {stage}: {results[name][stage]['median']:.3f}s median, "
+                f"{results[name][stage]['peak_rss_mb']} MB peak RSS")
+        del cases
+
+    return {
+        'meta': {
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'librosa': librosa.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'stub_models': stub_models,
+            'virality_model': viral_analyzer.model_version,
+            'rounds': rounds,
+            'warmup': warmup,
+            'seed': seed,
+            'per_stage_peak_rss': peak_rss_supported(),
+        },
+        'results': results,
+    }
+
+
+def save(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(report, baseline, threshold=DEFAULT_THRESHOLD):
+    """Stage-by-stage comparison of two reports.
+
+    Returns one row per (track, stage) present in both, with the median
+    time and peak RSS ratios and whether either grew past ``threshold``.
+    """
+    if report['meta'].get('stub_models') != baseline['meta'].get('stub_models'):
+        raise ValueError('Stub and real-model runs are not comparable')
+    rows = []
+    for track, stages in report['results'].items():
+        for stage, current in stages.items():
+            previous = baseline['results'].get(track, {}).get(stage)
+            if previous is None:
+                continue
+            time_ratio = current['median'] / previous['median'] if previous['median'] else None
+            rss_ratio = current['peak_rss_mb'] / previous['peak_rss_mb'] if previous['peak_rss_mb'] else None
+            rows.append({
+                'track': track,
+                'stage': stage,
+                'median': current['median'],
+                'baseline_median': previous['median'],
+                'time_ratio': time_ratio,
+                'peak_rss_mb': current['peak_rss_mb'],
+                'baseline_peak_rss_mb': previous['peak_rss_mb'],
+                'rss_ratio': rss_ratio,
+                'regressed': any(
+                    ratio is not None and ratio > 1 + threshold for ratio in (time_ratio, rss_ratio)
+                ),
+            })
+    return rows
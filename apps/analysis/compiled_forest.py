@@ -0,0 +1,173 @@
+"""Array-backed RandomForest inference.
+
+``export`` flattens a fitted ``RandomForestRegressor`` and its
+``StandardScaler`` into contiguous arrays and writes them to one file. The
+arrays are concatenated node tables (feature, threshold, left, right, value)
+plus one root offset per tree. ``CompiledForest.load`` memory-maps that file,
+so loading costs a few milliseconds and forked workers share the pages
+read-only.
+
+Prediction walks every tree at once, level by level, with NumPy fancy
+indexing. It reproduces sklearn bit for bit:
+
+- inputs are scaled in float64 as ``StandardScaler.transform`` does, then
+  cast to float32 like sklearn's tree input before comparing against the
+  float64 thresholds
+- per-tree outputs are summed in tree order and divided by the tree count,
+  the same accumulation ``RandomForestRegressor.predict`` performs
+"""
+import json
+import os
+import struct
+import numpy as np
+
+MAGIC = b'MSFOREST'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+# sklearn's marker for "no feature" on leaf nodes
+LEAF = -2
+
+ARRAY_DTYPES = {
+    'scaler_mean': np.float64,
+    'scaler_scale': np.float64,
+    'roots': np.int64,
+    'feature': np.int32,
+    'threshold': np.float64,
+    'left': np.int64,
+    'right': np.int64,
+    'value': np.float64,
+}
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def flatten(model, scaler):
+    """Concatenate the forest's node tables into {name: array}"""
+    n_features = model.n_features_in_
+    trees = [estimator.tree_ for estimator in model.estimators_]
+    if any(tree.n_outputs != 1 for tree in trees):
+        raise ValueError('Only single-output regressors can be compiled')
+
+    roots, features, thresholds, lefts, rights, values = [], [], [], [], [], []
+    offset = 0
+    for tree in trees:
+        roots.append(offset)
+        leaf = tree.children_left == -1
+        # Child indices become absolute positions in the concatenated table;
+        # leaves point at themselves so extra traversal steps are no-ops
+        own = np.arange(offset, offset + tree.node_count)
+        features.append(np.where(leaf, LEAF, tree.feature))
+        thresholds.append(tree.threshold)
+        lefts.append(np.where(leaf, own, tree.children_left + offset))
+        rights.append(np.where(leaf, own, tree.children_right + offset))
+        values.append(tree.value[:, 0, 0])
+        offset += tree.node_count
+
+    mean = getattr(scaler, 'mean_', None)
+    scale = getattr(scaler, 'scale_', None)
+    return {
+        'scaler_mean': np.zeros(n_features) if mean is None else mean,
+        'scaler_scale': np.ones(n_features) if scale is None else scale,
+        'roots': np.array(roots),
+        'feature': np.concatenate(features),
+        'threshold': np.concatenate(thresholds),
+        'left': np.concatenate(lefts),
+        'right': np.concatenate(rights),
+        'value': np.concatenate(values),
+    }, {
+        'n_features': int(n_features),
+        'n_trees': len(trees),
+        'max_depth': int(max(tree.max_depth for tree in trees)),
+    }
+
+
+def export(model, scaler, path, source_version=None):
+    """Write the compiled forest to ``path`` atomically.
+
+    ``source_version`` identifies the pickles it was compiled from and is
+    kept in the header.
+    """
+    arrays, meta = flatten(model, scaler)
+    meta['source_version'] = source_version
+    arrays = {name: np.ascontiguousarray(arrays[name], dtype=dtype) for name, dtype in ARRAY_DTYPES.items()}
+
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _aligned(offset)
+        layout[name] = {'offset': offset, 'count': int(array.size)}
+        offset += array.nbytes
+    header = json.dumps({'version': FORMAT_VERSION, 'arrays': layout, **meta}).encode()
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(array.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return meta
+
+
+class CompiledForest:
+    def __init__(self, arrays, n_features, n_trees, max_depth, source_version=None):
+        self.n_features = n_features
+        self.n_trees = n_trees
+        self.max_depth = max_depth
+        self.source_version = source_version
+        for name in ARRAY_DTYPES:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a file written by ``export``"""
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f'{path} is not a compiled forest')
+        header_length, = struct.unpack('<Q', bytes(buffer[len(MAGIC):len(MAGIC) + 8]))
+        header_start = len(MAGIC) + 8
+        header = json.loads(bytes(buffer[header_start:header_start + header_length]))
+        if header['version'] != FORMAT_VERSION:
+            raise ValueError(f'Unsupported compiled forest version {header["version"]}')
+
+        data_start = _aligned(header_start + header_length)
+        arrays = {
+            name: np.frombuffer(
+                buffer, dtype=dtype, count=header['arrays'][name]['count'],
+                offset=data_start + header['arrays'][name]['offset']
+            )
+            for name, dtype in ARRAY_DTYPES.items()
+        }
+        return cls(
+            arrays, header['n_features'], header['n_trees'], header['max_depth'],
+            header.get('source_version')
+        )
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=np.float64) - self.scaler_mean) / self.scaler_scale
+
+    def leaves(self, X_scaled):
+        """Leaf index reached in every tree, shape (rows, trees)"""
+        # Compare in float32 like sklearn's tree input, promoted to float64
+        X = np.asarray(X_scaled, dtype=np.float32).astype(np.float64)
+        rows = np.arange(len(X))[:, None]
+        nodes = np.broadcast_to(self.roots, (len(X), self.n_trees)).copy()
+        for _ in range(self.max_depth):
+            feature = self.feature[nodes]
+            go_left = X[rows, np.maximum(feature, 0)] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return nodes
+
+    def predict(self, X):
+        """Scale and score one row or a batch, matching sklearn's predict"""
+        X = np.atleast_2d(X)
+        if X.shape[1] != self.n_features:
+            raise ValueError(f'Expected {self.n_features} features, got {X.shape[1]}')
+        per_tree = self.value[self.leaves(self.transform(X))]
+        # cumsum adds strictly in tree order, as sklearn's accumulation does
+        return np.cumsum(per_tree, axis=1)[:, -1] / self.n_trees
@@ -0,0 +1,143 @@
+"""Content-addressed cache of analysis results.
+
+Songs are keyed by the SHA-256 of their audio file. Once a file has been
+analysed, re-uploads of the same bytes (under any title, by any user) copy the
+stored result instead of running the pipeline again. Results are also keyed by
+``pipeline_key()``. It combines PIPELINE_VERSION with the OpenL3 hop and the
+virality/emotion model version, so changing the code, the embedding preset or
+the models invalidates them.
+"""
+import hashlib
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import SongAnalysis, AnalysisResultCache, EMOTION_FIELDS
+from .vectors import encode_matrix, decode_matrix
+from .viral_analyzer import installed_model_version
+from . import analytics, scheduling
+
+# Bump whenever feature extraction, separation, embedding or the bundled
+# models change in a way that alters stored results.
+PIPELINE_VERSION = '2'
+
+EMBEDDING_WIDTH = 512
+
+CACHED_FIELDS = EMOTION_FIELDS + [
+    'tempo', 'mfcc_features', 'spectral_features', 'chroma_features',
+    'timeline_segment_seconds',
+    'artist_popularity', 'year', 'duration_ms', 'track_popularity_prediction', 'model_version',
+    'vocal_energy', 'drums_energy', 'bass_energy', 'other_energy',
+]
+
+
+def hash_chunks(chunks):
+    """SHA-256 hex digest of an iterable of byte chunks"""
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    with open(path, 'rb') as f:
+        return hash_chunks(iter(lambda: f.read(chunk_size), b''))
+
+
+def hash_field_file(field_file):
+    """Hash a FileField's content without loading it into memory"""
+    field_file.open('rb')
+    try:
+        return hash_chunks(field_file.chunks())
+    finally:
+        field_file.close()
+
+
+def ensure_content_hash(song):
+    """Compute and store the song's content hash if it is missing"""
+    if not song.content_hash and song.file:
+        song.content_hash = hash_field_file(song.file)
+        song.save(update_fields=['content_hash'])
+    return song.content_hash
+
+
+def pipeline_key(model_version):
+    """Key of results from this pipeline, embedding hop and ``model_version``"""
+    if settings.ANALYSIS_EMBEDDING_HOP_SIZE:
+        embedding = f'hop-{settings.ANALYSIS_EMBEDDING_HOP_SIZE:g}'
+    else:
+        embedding = f'preset-{settings.ANALYSIS_EMBEDDING_PRESET}'
+    # Hashed to fit AnalysisResultCache.pipeline_version
+    digest = hashlib.sha256(f'{embedding}|{model_version}'.encode()).hexdigest()[:16]
+    return f'{PIPELINE_VERSION}-{digest}'
+
+
+def lookup(content_hash):
+    if not content_hash:
+        return None
+    # A web host without the model files never matches; the worker that then
+    # runs analyze_song_task looks again with the real version
+    return AnalysisResultCache.objects.filter(
+        content_hash=content_hash,
+        pipeline_version=pipeline_key(installed_model_version())
+    ).first()
+
+
+def store_result(analysis):
+    """Record a completed analysis under its song's content hash"""
+    content_hash = analysis.song.content_hash
+    if not content_hash:
+        return
+    result = {field: getattr(analysis, field) for field in CACHED_FIELDS}
+    embeddings = analysis.get_embeddings()
+    result['embedding_stems'] = list(embeddings)
+    AnalysisResultCache.objects.update_or_create(
+        content_hash=content_hash,
+        pipeline_version=pipeline_key(analysis.model_version),
+        defaults={
+            'result': result,
+            'embeddings': encode_matrix(list(embeddings.values())) if embeddings else None,
+            'feature_timeline': analysis.feature_timeline
+        }
+    )
+
+
+def apply_cached_result(song, task_id=None):
+    """Populate the song's analysis from the cache.
+
+    Returns the completed SongAnalysis, or None when the content has not been
+    analysed with the current pipeline yet. A live run the caller doesn't
+    own (``task_id``) is left alone and also gives None.
+    """
+    entry = lookup(song.content_hash)
+    if entry is None:
+        return None
+
+    with transaction.atomic():
+        analysis, created = SongAnalysis.objects.select_for_update().get_or_create(song=song)
+        if analysis.is_active and analysis.task_id != (task_id or '') and not scheduling.is_stale(analysis):
+            return None
+
+        for field in CACHED_FIELDS:
+            if field in entry.result:
+                setattr(analysis, field, entry.result[field])
+        analysis.feature_timeline = entry.feature_timeline
+        analysis.features_complete = True
+        analysis.stems_complete = True
+        analysis.is_complete = True
+        analysis.error_message = None
+        analysis.task_id = ''
+        analysis.heartbeat_at = None
+        scheduling.finish(analysis, True)
+        analysis.save()
+
+        stems = entry.result.get('embedding_stems', [])
+        if stems and entry.embeddings:
+            vectors = decode_matrix(entry.embeddings, EMBEDDING_WIDTH)
+            analysis.set_embeddings(dict(zip(stems, vectors)))
+
+    song.is_analyzed = True
+    song.save(update_fields=['is_analyzed', 'updated_at'])
+    analytics.record(analysis)
+
+    AnalysisResultCache.objects.filter(pk=entry.pk).update(last_hit_at=timezone.now())
+    return analysis
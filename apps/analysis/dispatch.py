@@ -0,0 +1,20 @@
+"""Enqueue analysis tasks by name.
+
+The web tier sends tasks through this module instead of importing tasks.py.
+tasks.py pulls in the model registry and, through it, librosa,
+scikit-learn, Spleeter and OpenL3. ``send_task`` only needs the task name,
+and CELERY_TASK_ROUTES still picks the queue. tasks.py registers its tasks
+under these same names.
+"""
+from celery import current_app
+
+ANALYZE_SONG = 'apps.analysis.tasks.analyze_song_task'
+ANALYZE_SONGS_BATCH = 'apps.analysis.tasks.analyze_songs_batch_task'
+
+
+def analyze_song(song_id, task_id=None):
+    return current_app.send_task(ANALYZE_SONG, args=(song_id,), task_id=task_id)
+
+
+def analyze_songs_batch(song_ids, with_stems=False):
+    return current_app.send_task(ANALYZE_SONGS_BATCH, args=(song_ids,), kwargs={'with_stems': with_stems})
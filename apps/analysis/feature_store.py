@@ -0,0 +1,210 @@
+"""Frame-level feature store on the media volume.
+
+The pipeline only keeps pooled vectors in the database. This store keeps
+the frame-level matrices they were pooled from, one directory per audio
+content hash and pipeline version:
+
+    MEDIA_ROOT/features/<pipeline_version>/<hash[:2]>/<hash>/
+        manifest.json
+        mfcc.f32            (frames, 13)
+        contrast.f32        (frames, 7)
+        chroma.f32          (frames, 12)
+        onset_env.f32       (frames,)
+        rms.f32             (frames,)
+        vocals_embedding.f32  (embedding frames, 512), one per stem
+
+Arrays are raw little-endian C-order files. Their dtype and shape live in
+the manifest, so the feature frames can be appended while the track streams
+and readers ``np.memmap`` them without copying. The FrameFeatureSet table
+indexes every directory and is the source of truth for its manifest. The
+features and stems branches write their arrays independently and merge
+them into the index row under a row lock.
+
+Audio frames come from fixed-length segments (see streaming.py). Each full
+segment contributes ``1 + segment_samples // hop_length`` frames, which the
+manifest records as ``segment_frames``.
+"""
+import json
+import os
+import uuid
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from .models import FrameFeatureSet
+from .content_cache import PIPELINE_VERSION
+from .features import HOP_LENGTH
+from .streaming import SEGMENT_SECONDS
+from .audio import FEATURE_SR
+
+STORE_DIR = 'features'
+MANIFEST = 'manifest.json'
+# FeatureEngine outputs kept per frame
+FRAME_FEATURES = ('mfcc', 'contrast', 'chroma', 'onset_env', 'rms')
+
+
+def relative_dir(content_hash, pipeline_version=PIPELINE_VERSION):
+    return os.path.join(STORE_DIR, pipeline_version, content_hash[:2], content_hash)
+
+
+def _absolute(relative):
+    return os.path.join(settings.MEDIA_ROOT, relative)
+
+
+def _array_path(directory, name):
+    return os.path.join(directory, f'{name}.f32')
+
+
+def _part_suffix():
+    # Unique per writer, so concurrent runs on the same content never share
+    # a partial file
+    return f'.{uuid.uuid4().hex}.part'
+
+
+class FrameWriter:
+    """Streams FeatureEngine frames of one track into the store.
+
+    Pass it as the ``frame_sink`` of StreamingFeatureExtractor. Nothing is
+    visible to readers until ``commit()``.
+    """
+
+    def __init__(self, content_hash):
+        self.content_hash = content_hash
+        self.relative = relative_dir(content_hash)
+        self.directory = _absolute(self.relative)
+        os.makedirs(self.directory, exist_ok=True)
+        self._suffix = _part_suffix()
+        self._files = {
+            name: open(_array_path(self.directory, name) + self._suffix, 'wb')
+            for name in FRAME_FEATURES
+        }
+        self._shapes = {name: None for name in FRAME_FEATURES}
+        self.frame_count = 0
+
+    def append(self, frames):
+        """Append one segment's ``{name: (coefficients, frames)}`` output"""
+        for name in FRAME_FEATURES:
+            # Stored frame-major so segments append contiguously
+            rows = np.ascontiguousarray(np.atleast_2d(frames[name]).T, dtype='<f4')
+            rows.tofile(self._files[name])
+            self._shapes[name] = rows.shape[1]
+        self.frame_count += frames['mfcc'].shape[1]
+
+    def _close(self):
+        for f in self._files.values():
+            f.close()
+
+    def abort(self):
+        self._close()
+        for name in FRAME_FEATURES:
+            try:
+                os.remove(_array_path(self.directory, name) + self._suffix)
+            except FileNotFoundError:
+                pass
+
+    def commit(self):
+        """Publish the arrays and record them in the index"""
+        self._close()
+        arrays = {}
+        for name in FRAME_FEATURES:
+            part = _array_path(self.directory, name) + self._suffix
+            with open(part, 'rb+') as f:
+                os.fsync(f.fileno())
+            os.replace(part, _array_path(self.directory, name))
+            width = self._shapes[name]
+            shape = [self.frame_count] if width in (None, 1) else [self.frame_count, width]
+            arrays[name] = {'dtype': '<f4', 'shape': shape}
+        return _register(self.content_hash, arrays, {
+            'sr': FEATURE_SR,
+            'hop_length': HOP_LENGTH,
+            'segment_seconds': SEGMENT_SECONDS,
+            'segment_frames': 1 + int(SEGMENT_SECONDS * FEATURE_SR) // HOP_LENGTH,
+        })
+
+
+def save_stem_frames(content_hash, frame_embeddings, hop_seconds):
+    """Store the per-frame OpenL3 matrix of each stem"""
+    directory = _absolute(relative_dir(content_hash))
+    os.makedirs(directory, exist_ok=True)
+    arrays = {}
+    for stem_name, frames in frame_embeddings.items():
+        name = f'{stem_name}_embedding'
+        frames = np.ascontiguousarray(frames, dtype='<f4')
+        part = _array_path(directory, name) + _part_suffix()
+        try:
+            with open(part, 'wb') as f:
+                frames.tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(part, _array_path(directory, name))
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        arrays[name] = {'dtype': '<f4', 'shape': list(frames.shape)}
+    return _register(content_hash, arrays, {'embedding_hop_seconds': hop_seconds})
+
+
+def _register(content_hash, arrays, attributes):
+    """Merge arrays into the index row and rewrite the on-disk manifest"""
+    with transaction.atomic():
+        entry, created = FrameFeatureSet.objects.select_for_update().get_or_create(
+            content_hash=content_hash,
+            pipeline_version=PIPELINE_VERSION,
+            defaults={'directory': relative_dir(content_hash)}
+        )
+        entry.arrays = {**entry.arrays, **arrays}
+        entry.attributes = {**entry.attributes, **attributes}
+        entry.save()
+
+        manifest_path = os.path.join(_absolute(entry.directory), MANIFEST)
+        part = manifest_path + _part_suffix()
+        with open(part, 'w') as f:
+            json.dump({
+                'content_hash': content_hash,
+                'pipeline_version': PIPELINE_VERSION,
+                'arrays': entry.arrays,
+                **entry.attributes,
+            }, f, indent=2)
+        os.replace(part, manifest_path)
+    return entry
+
+
+class FrameFeatures:
+    """Read-only, memory-mapped view of one song's stored frames"""
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.directory = _absolute(entry.directory)
+        self.attributes = entry.attributes
+        self._arrays = {}
+
+    @property
+    def names(self):
+        return list(self.entry.arrays)
+
+    def __contains__(self, name):
+        return name in self.entry.arrays
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            spec = self.entry.arrays[name]
+            self._arrays[name] = np.memmap(
+                _array_path(self.directory, name),
+                dtype=spec['dtype'], mode='r', shape=tuple(spec['shape'])
+            )
+        return self._arrays[name]
+
+
+def load(content_hash, pipeline_version=PIPELINE_VERSION):
+    """Frames stored for ``content_hash``, or None if there are none"""
+    entry = FrameFeatureSet.objects.filter(
+        content_hash=content_hash, pipeline_version=pipeline_version
+    ).first()
+    return FrameFeatures(entry) if entry else None
+
+
+def iter_stored(pipeline_version=PIPELINE_VERSION, chunk_size=500):
+    """Stream every stored song's frames, e.g. for training or backfills"""
+    entries = FrameFeatureSet.objects.filter(pipeline_version=pipeline_version).order_by('id')
+    for entry in entries.iterator(chunk_size=chunk_size):
+        yield FrameFeatures(entry)
@@ -0,0 +1,108 @@
+"""Shared-spectrogram feature engine.
+
+The STFT is computed once per signal. Every feature is derived from that
+transform (magnitude, power, mel or log-mel) instead of calling librosa on
+``y`` again. On librosa's defaults the results match ``librosa.feature.mfcc``,
+``spectral_contrast``, ``chroma_stft`` and ``onset.onset_strength`` called
+on the waveform.
+
+New features register a function taking a ``Spectra`` and don't add an STFT
+pass::
+
+    @register_feature('bandwidth')
+    def bandwidth(spectra):
+        return librosa.feature.spectral_bandwidth(S=spectra.magnitude, sr=spectra.sr)
+"""
+from functools import cached_property
+import numpy as np
+import librosa
+from .audio import FEATURE_SR
+
+N_FFT = 2048
+HOP_LENGTH = 512
+N_MFCC = 13
+
+FEATURES = {}
+
+
+def register_feature(name):
+    """Register ``fn(spectra) -> ndarray`` as a named feature"""
+    def decorator(fn):
+        FEATURES[name] = fn
+        return fn
+    return decorator
+
+
+class Spectra:
+    """One STFT of a signal and the representations derived from it, built lazily"""
+
+    def __init__(self, y, sr=FEATURE_SR, n_fft=N_FFT, hop_length=HOP_LENGTH):
+        self.y = y
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+
+    @cached_property
+    def magnitude(self):
+        return np.abs(librosa.stft(self.y, n_fft=self.n_fft, hop_length=self.hop_length))
+
+    @cached_property
+    def power(self):
+        return self.magnitude ** 2
+
+    @cached_property
+    def mel(self):
+        return librosa.feature.melspectrogram(S=self.power, sr=self.sr, n_fft=self.n_fft)
+
+    @cached_property
+    def log_mel(self):
+        return librosa.power_to_db(self.mel)
+
+
+@register_feature('mfcc')
+def mfcc(spectra):
+    return librosa.feature.mfcc(S=spectra.log_mel, n_mfcc=N_MFCC)
+
+
+@register_feature('contrast')
+def contrast(spectra):
+    return librosa.feature.spectral_contrast(
+        S=spectra.magnitude, sr=spectra.sr,
+        n_fft=spectra.n_fft, hop_length=spectra.hop_length
+    )
+
+
+@register_feature('chroma')
+def chroma(spectra):
+    return librosa.feature.chroma_stft(
+        S=spectra.power, sr=spectra.sr,
+        n_fft=spectra.n_fft, hop_length=spectra.hop_length
+    )
+
+
+@register_feature('onset_env')
+def onset_env(spectra):
+    return librosa.onset.onset_strength(
+        S=spectra.log_mel, sr=spectra.sr, hop_length=spectra.hop_length
+    )
+
+
+@register_feature('rms')
+def rms(spectra):
+    # Time-domain framing is cheaper than the STFT and matches librosa exactly
+    return librosa.feature.rms(
+        y=spectra.y, frame_length=spectra.n_fft, hop_length=spectra.hop_length
+    )
+
+
+class FeatureEngine:
+    def __init__(self, sr=FEATURE_SR, n_fft=N_FFT, hop_length=HOP_LENGTH, features=None):
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.features = list(features or FEATURES)
+
+    def compute(self, y):
+        """Return {feature name: frames} for ``y`` from a single STFT"""
+        spectra = Spectra(y, self.sr, self.n_fft, self.hop_length)
+        return {name: FEATURES[name](spectra) for name in self.features}
@@ -0,0 +1,117 @@
+"""Per-analysis timing and memory spans.
+
+Each branch of analyze_song_task times its work with a Recorder:
+
+- features branch: features (streamed decode and extraction), emotion,
+  virality
+- stems branch: decode, separation, energy, embedding
+
+A branch returns ``Recorder.summary()`` with its chord result.
+merge_analysis_stage combines the two summaries into
+``SongAnalysis.stage_timings`` and exports them as Prometheus histograms
+(see apps/monitoring/metrics.py).
+
+The realtime factor is the slower branch's total divided by the audio
+duration. The branches run in parallel, so that is the processing time per
+second of audio, queueing excluded. Peak memory is the process high-water
+mark, reset when the Recorder starts. On Linux this goes through
+``/proc/self/clear_refs``; elsewhere the peak is process-wide.
+"""
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from apps.monitoring import metrics
+
+BRANCHES = ('features', 'stems')
+
+
+def peak_rss_supported():
+    return os.path.exists('/proc/self/clear_refs')
+
+
+def reset_peak_rss():
+    if peak_rss_supported():
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+
+
+def peak_rss_mb():
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 1024
+
+
+class Recorder:
+    def __init__(self):
+        reset_peak_rss()
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.attributes = {}
+
+    @contextmanager
+    def span(self, name):
+        """Time a block; repeated spans of one name add up"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + time.perf_counter() - started
+
+    def summary(self):
+        return {
+            'spans': {name: round(seconds, 4) for name, seconds in self.spans.items()},
+            'total_seconds': round(time.perf_counter() - self.started, 4),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            **self.attributes,
+        }
+
+
+def span(recorder, name):
+    """``recorder.span(name)``, or a no-op without a recorder"""
+    return recorder.span(name) if recorder else nullcontext()
+
+
+def combine(results, analysis):
+    """Merge the branch summaries of a chord into one stage_timings dict"""
+    timings = {
+        result['stage']: result['timings']
+        for result in results if result.get('timings')
+    }
+    audio_seconds = analysis.duration_ms / 1000 if analysis.duration_ms else None
+    if audio_seconds is None:
+        audio_seconds = timings.get('stems', {}).get('audio_seconds')
+    slowest = max((branch['total_seconds'] for branch in timings.values()), default=None)
+
+    timings['audio_seconds'] = audio_seconds
+    timings['realtime_factor'] = (
+        round(slowest / audio_seconds, 4) if slowest is not None and audio_seconds else None
+    )
+    if analysis.started_at and analysis.finished_at:
+        timings['wall_seconds'] = round((analysis.finished_at - analysis.started_at).total_seconds(), 3)
+    return timings
+
+
+def export(timings):
+    """Observe stage_timings into the shared Prometheus histograms"""
+    observations = []
+    for branch in BRANCHES:
+        summary = timings.get(branch)
+        if not summary:
+            continue
+        for stage, seconds in summary['spans'].items():
+            observations.append((metrics.ANALYSIS_STAGE_SECONDS, seconds, {'stage': stage}))
+        observations.append((
+            metrics.ANALYSIS_PEAK_MEMORY_BYTES, summary['peak_rss_mb'] * 2**20, {'branch': branch}
+        ))
+    if timings.get('audio_seconds'):
+        observations.append((metrics.ANALYSIS_AUDIO_SECONDS, timings['audio_seconds'], {}))
+    if timings.get('realtime_factor') is not None:
+        observations.append((metrics.ANALYSIS_REALTIME_FACTOR, timings['realtime_factor'], {}))
+    metrics.record(observations)
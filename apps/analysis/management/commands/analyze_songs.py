@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from apps.music.models import Song
+from apps.analysis import dispatch
+
+
+class Command(BaseCommand):
+    help = "Analyse songs in batches with a feature-extraction process pool"
+
+    def add_arguments(self, parser):
+        parser.add_argument('song_ids', nargs='*', type=int)
+        parser.add_argument('--all', action='store_true', help="Re-analyse every song")
+        parser.add_argument('--pending', action='store_true', help="Only songs not analysed yet")
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--processes', type=int, default=None)
+        parser.add_argument('--with-stems', action='store_true', help="Also separate and embed stems")
+        parser.add_argument('--enqueue', action='store_true', help="Queue Celery batch tasks instead of running here")
+
+    def handle(self, *args, **options):
+        if options['song_ids']:
+            songs = Song.objects.filter(id__in=options['song_ids'])
+        elif options['all']:
+            songs = Song.objects.all()
+        elif options['pending']:
+            songs = Song.objects.filter(is_analyzed=False)
+        else:
+            raise CommandError("Pass song IDs, --all or --pending")
+
+        song_ids = list(songs.order_by('id').values_list('id', flat=True))
+        batch_size = options['batch_size']
+        written = 0
+        for start in range(0, len(song_ids), batch_size):
+            chunk = song_ids[start:start + batch_size]
+            if options['enqueue']:
+                dispatch.analyze_songs_batch(chunk, with_stems=options['with_stems'])
+                self.stdout.write(f"Queued {start + len(chunk)}/{len(song_ids)} songs")
+                continue
+            # Runs the pipeline here, so the models are only loaded now
+            from apps.analysis import batch
+            written += batch.analyze_batch(
+                chunk,
+                processes=options['processes'],
+                with_stems=options['with_stems']
+            )
+            self.stdout.write(f"Analysed {start + len(chunk)}/{len(song_ids)} songs ({written} written)")
+
+        self.stdout.write(self.style.SUCCESS("Done"))
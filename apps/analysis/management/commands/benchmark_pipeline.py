@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from apps.analysis import benchmark
+
+
+class Command(BaseCommand):
+    help = "Time each analysis stage on synthetic tracks and compare against a stored baseline"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tracks', nargs='+', choices=list(benchmark.TRACKS), default=list(benchmark.TRACKS))
+        parser.add_argument('--stages', nargs='+', choices=benchmark.STAGES, default=list(benchmark.STAGES))
+        parser.add_argument('--rounds', type=int, default=3)
+        parser.add_argument('--warmup', type=int, default=1)
+        parser.add_argument('--fixtures-dir', default='benchmark_fixtures', help="Where generated tracks are kept")
+        parser.add_argument('--real-models', action='store_true', help="Use Spleeter and OpenL3 instead of the stubs")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=None, help="Write the results as JSON")
+        parser.add_argument('--baseline', default=None, help="JSON results to compare against")
+        parser.add_argument('--threshold', type=float, default=benchmark.DEFAULT_THRESHOLD,
+                            help="Relative growth reported as a regression")
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['rounds'] < 1:
+            raise CommandError("--rounds must be at least 1")
+        baseline = benchmark.load(options['baseline']) if options['baseline'] else None
+
+        report = benchmark.run(
+            tracks=options['tracks'],
+            stages=options['stages'],
+            rounds=options['rounds'],
+            warmup=options['warmup'],
+            fixtures_dir=options['fixtures_dir'],
+            stub_models=not options['real_models'],
+            seed=options['seed'],
+            log=self.stdout.write
+        )
+        if not report['meta']['per_stage_peak_rss']:
+            self.stdout.write(self.style.WARNING("Peak RSS can't be reset here; it is process-wide"))
+        if options['output']:
+            benchmark.save(report, options['output'])
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if baseline is None:
+            return
+        try:
+            rows = benchmark.compare(report, baseline, options['threshold'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        regressions = 0
+        for row in rows:
+            line = (
+                f"{row['track']:>6} {row['stage']:<24} "
+                f"{row['baseline_median']:8.3f}s -> {row['median']:8.3f}s "
+                f"({row['time_ratio'] or 0:.2f}x), "
+                f"{row['baseline_peak_rss_mb']} -> {row['peak_rss_mb']} MB"
+            )
+            if row['regressed']:
+                regressions += 1
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+
+        if regressions and options['fail_on_regression']:
+            raise CommandError(f"{regressions} stage(s) regressed by more than {options['threshold']:.0%}")
+        self.stdout.write(self.style.SUCCESS(f"{len(rows)} stages compared, {regressions} regressed"))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from apps.analysis import similarity
+
+
+class Command(BaseCommand):
+    help = "Build the similar-song indexes and publish them for web processes to map"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=2, help="Builds to keep on disk")
+
+    def handle(self, *args, **options):
+        for name, size in similarity.build_snapshots(keep=max(1, options['keep'])):
+            self.stdout.write(f"{name}: {size} songs")
+        self.stdout.write(self.style.SUCCESS(
+            f"Published {similarity.current_snapshot_dir()}"
+        ))
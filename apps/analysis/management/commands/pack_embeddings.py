@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from apps.analysis.models import SongAnalysis, StemEmbedding, STEM_FIELD_PREFIXES
+from apps.analysis.vectors import encode_vector, SUPPORTED_DTYPES
+
+LEGACY_FIELDS = {
+    stem: f'{prefix}_embedding' for stem, prefix in STEM_FIELD_PREFIXES.items()
+}
+
+
+class Command(BaseCommand):
+    help = "Convert legacy JSON stem embeddings into packed StemEmbedding rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dtype', choices=SUPPORTED_DTYPES, default='float32')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dtype = options['dtype']
+        legacy_fields = list(LEGACY_FIELDS.values())
+
+        # Rows whose legacy columns still hold vectors
+        pending = SongAnalysis.objects.exclude(
+            vocal_embedding=[], drums_embedding=[], bass_embedding=[], other_embedding=[]
+        ).order_by('id').only('id', *legacy_fields)
+
+        converted = 0
+        last_id = 0
+        while True:
+            batch = list(pending.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            rows = []
+            for analysis in batch:
+                for stem, field in LEGACY_FIELDS.items():
+                    vector = getattr(analysis, field)
+                    if vector:
+                        rows.append(StemEmbedding(
+                            analysis_id=analysis.id,
+                            stem=stem,
+                            dtype=dtype,
+                            vector=encode_vector(vector, dtype)
+                        ))
+
+            with transaction.atomic():
+                StemEmbedding.objects.bulk_create(rows, ignore_conflicts=True)
+                SongAnalysis.objects.filter(id__in=[a.id for a in batch]).update(
+                    **{field: [] for field in legacy_fields}
+                )
+
+            converted += len(batch)
+            self.stdout.write(f"Packed embeddings for {converted} analyses")
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {converted} analyses converted"))
@@ -0,0 +1,26 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from apps.analysis import analytics
+
+
+class Command(BaseCommand):
+    help = "Recompute per-user analytics rollups from their completed analyses"
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_ids', nargs='*', type=int)
+        parser.add_argument('--all', action='store_true', help="Rebuild every user's rollup")
+
+    def handle(self, *args, **options):
+        if options['user_ids']:
+            user_ids = options['user_ids']
+        elif options['all']:
+            user_ids = list(get_user_model().objects.order_by('pk').values_list('pk', flat=True))
+        else:
+            raise CommandError("Pass user IDs or --all")
+
+        for done, user_id in enumerate(user_ids, start=1):
+            analytics.rebuild_for_users([user_id])
+            if done % 100 == 0:
+                self.stdout.write(f"Rebuilt {done}/{len(user_ids)} rollups")
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(user_ids)} rollups"))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from apps.analysis import rescore
+
+
+class Command(BaseCommand):
+    help = "Re-score stored analyses with the current virality and emotion models, resumably"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', default='default', help="Checkpoint name; reruns resume from it")
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--rate', type=float, default=None, help="Max rows written per second")
+        parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start over")
+
+    def handle(self, *args, **options):
+        def report(checkpoint):
+            self.stdout.write(f"Re-scored {checkpoint.processed} analyses (up to id {checkpoint.last_id})")
+
+        try:
+            checkpoint = rescore.rescore(
+                name=options['name'],
+                chunk_size=options['chunk_size'],
+                rate=options['rate'],
+                restart=options['restart'],
+                on_batch=report
+            )
+        except rescore.RescoreError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {checkpoint.processed} analyses at {checkpoint.model_version}"
+        ))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from apps.analysis import training
+
+
+class Command(BaseCommand):
+    help = "Train the virality model from stored features and publish a new model version"
+
+    def add_arguments(self, parser):
+        parser.add_argument('labels', help="CSV with song_id,popularity[,artist_popularity,year]")
+        parser.add_argument('--n-estimators', type=int, default=200)
+        parser.add_argument('--max-samples', type=float, default=1.0, help="Bootstrap fraction per tree")
+        parser.add_argument('--cv-folds', type=int, default=5, help="0 to skip cross-validation")
+        parser.add_argument('--n-jobs', type=int, default=-1, help="Threads for the final fit")
+        parser.add_argument('--memory-budget-mb', type=int, default=4096)
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--random-state', type=int, default=42)
+
+    def handle(self, *args, **options):
+        try:
+            metrics = training.train(
+                options['labels'],
+                n_estimators=options['n_estimators'],
+                max_samples=options['max_samples'],
+                cv_folds=options['cv_folds'],
+                n_jobs=options['n_jobs'],
+                memory_budget_mb=options['memory_budget_mb'],
+                chunk_size=options['chunk_size'],
+                random_state=options['random_state'],
+                log=self.stdout.write
+            )
+        except training.TrainingError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(
+            f"Fit {metrics['fit_seconds']}s (CV {metrics['cv_seconds']}s), "
+            f"peak traced {metrics['peak_traced_mb']} MB, max RSS {metrics['max_rss_mb']} MB"
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Published model version {metrics['version']}; restart workers to load it, "
+            f"then run rescore_analyses"
+        ))
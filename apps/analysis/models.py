@@ -1,7 +1,41 @@
-from django.db import models
+from django.db import models, transaction
+from django.contrib.auth import get_user_model
 from apps.music.models import Song
+from .vectors import encode_vector, decode_vector, decode_matrix, DEFAULT_DTYPE
+
+User = get_user_model()
+
+# Spleeter stem name -> prefix of the matching SongAnalysis fields
+STEM_FIELD_PREFIXES = {
+    'vocals': 'vocal',
+    'drums': 'drums',
+    'bass': 'bass',
+    'other': 'other',
+}
+
+EMOTION_FIELDS = [
+    'uplifting', 'distracting', 'reappraisal', 'motivating',
+    'relaxing', 'suppressing', 'destressing'
+]
+
+# Columns per feature_timeline row: start, rms, 13 MFCC, 7 contrast, 12 chroma
+TIMELINE_WIDTH = 34
 
 class SongAnalysis(models.Model):
+    STATE_PENDING = 'pending'
+    STATE_QUEUED = 'queued'
+    STATE_RUNNING = 'running'
+    STATE_COMPLETED = 'completed'
+    STATE_FAILED = 'failed'
+    STATE_CHOICES = [
+        (STATE_PENDING, 'Pending'),
+        (STATE_QUEUED, 'Queued'),
+        (STATE_RUNNING, 'Running'),
+        (STATE_COMPLETED, 'Completed'),
+        (STATE_FAILED, 'Failed'),
+    ]
+    ACTIVE_STATES = (STATE_QUEUED, STATE_RUNNING)
+
     song = models.OneToOneField(Song, on_delete=models.CASCADE, related_name='analysis')
     
     # Emotion scores
@@ -18,12 +52,17 @@ class SongAnalysis(models.Model):
     mfcc_features = models.JSONField(default=list)
     spectral_features = models.JSONField(default=list)
     chroma_features = models.JSONField(default=list)
+    # Per-segment summary rows (see streaming.TIMELINE_COLUMNS), packed float32
+    feature_timeline = models.BinaryField(null=True, blank=True)
+    timeline_segment_seconds = models.FloatField(null=True, blank=True)
     
     # Viral prediction
     artist_popularity = models.IntegerField(default=0)
     year = models.IntegerField(null=True, blank=True)
     duration_ms = models.IntegerField(null=True, blank=True)
     track_popularity_prediction = models.FloatField(null=True, blank=True)
+    # ViralSongAnalyzer.model_version that produced the scores above
+    model_version = models.CharField(max_length=64, blank=True, default='', db_index=True)
     
     # Stem analysis (from music detection)
     vocal_energy = models.FloatField(default=0.0)
@@ -31,16 +70,165 @@ class SongAnalysis(models.Model):
     bass_energy = models.FloatField(default=0.0)
     other_energy = models.FloatField(default=0.0)
     
+    # Legacy JSON embeddings, superseded by StemEmbedding. New analyses leave
+    # them empty and `manage.py pack_embeddings` converts existing rows.
     vocal_embedding = models.JSONField(default=list)
     drums_embedding = models.JSONField(default=list)
     bass_embedding = models.JSONField(default=list)
     other_embedding = models.JSONField(default=list)
     
     # Analysis metadata
+    features_complete = models.BooleanField(default=False)
+    stems_complete = models.BooleanField(default=False)
     is_complete = models.BooleanField(default=False)
     error_message = models.TextField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    # In-flight tracking: at most one active analysis task per song
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=STATE_PENDING, db_index=True)
+    task_id = models.CharField(max_length=64, blank=True, default='')
+    queued_at = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Refreshed at every stage of a running analysis (see scheduling.heartbeat)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    # Values this analysis last added to its owner's UserAnalyticsRollup, so
+    # a re-analysis or delete can subtract exactly that contribution
+    rollup_snapshot = models.JSONField(null=True, blank=True)
+
+    # Per-branch spans, peak memory and realtime factor of the last run
+    # (see instrumentation.combine)
+    stage_timings = models.JSONField(null=True, blank=True)
     
     def __str__(self):
         return f"Analysis for {self.song.title}"
+
+    @property
+    def is_active(self):
+        return self.state in self.ACTIVE_STATES
+
+    def get_feature_timeline(self):
+        """Return the per-segment timeline as a (segments, columns) array"""
+        if not self.feature_timeline:
+            return None
+        return decode_matrix(self.feature_timeline, TIMELINE_WIDTH)
+
+    def get_embeddings(self):
+        """Return {stem: ndarray} for every stored stem embedding"""
+        return {
+            stem_embedding.stem: stem_embedding.as_array()
+            for stem_embedding in self.stem_embeddings.all()
+        }
+
+    def set_embeddings(self, embeddings, dtype=DEFAULT_DTYPE):
+        """Replace the stored stem embeddings with {stem: vector}"""
+        with transaction.atomic():
+            self.stem_embeddings.all().delete()
+            StemEmbedding.objects.bulk_create([
+                StemEmbedding(
+                    analysis=self,
+                    stem=stem,
+                    dtype=dtype,
+                    vector=encode_vector(vector, dtype)
+                )
+                for stem, vector in embeddings.items()
+            ])
+
+
+class StemEmbedding(models.Model):
+    """Normalised OpenL3 embedding of one stem, packed as raw bytes"""
+    STEM_CHOICES = [(stem, stem.capitalize()) for stem in STEM_FIELD_PREFIXES]
+
+    analysis = models.ForeignKey(SongAnalysis, on_delete=models.CASCADE, related_name='stem_embeddings')
+    stem = models.CharField(max_length=16, choices=STEM_CHOICES)
+    dtype = models.CharField(max_length=8, default=DEFAULT_DTYPE)
+    vector = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['analysis', 'stem']
+
+    def __str__(self):
+        return f"{self.stem} embedding for analysis {self.analysis_id}"
+
+    def as_array(self):
+        return decode_vector(self.vector, self.dtype)
+
+
+class AnalysisResultCache(models.Model):
+    """Analysis results keyed by audio content hash and pipeline version"""
+    content_hash = models.CharField(max_length=64)
+    pipeline_version = models.CharField(max_length=32)
+    result = models.JSONField(default=dict)
+    # Stem embeddings packed row-major in the order of result['embedding_stems']
+    embeddings = models.BinaryField(null=True, blank=True)
+    feature_timeline = models.BinaryField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_hit_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ['content_hash', 'pipeline_version']
+
+    def __str__(self):
+        return f"Cached analysis {self.content_hash[:12]} ({self.pipeline_version})"
+
+
+class UserAnalyticsRollup(models.Model):
+    """Running per-user aggregates of completed analyses.
+
+    Updated incrementally by analytics.record/remove. Emotion and tempo
+    distributions are kept as fixed-bin histograms, so percentiles are read
+    without scanning the user's analyses.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='analytics_rollup')
+    song_count = models.IntegerField(default=0)
+    emotion_sums = models.JSONField(default=dict)
+    emotion_histograms = models.JSONField(default=dict)
+    tempo_count = models.IntegerField(default=0)
+    tempo_sum = models.FloatField(default=0.0)
+    tempo_histogram = models.JSONField(default=list)
+    energy_sums = models.JSONField(default=dict)
+    popularity_count = models.IntegerField(default=0)
+    popularity_sum = models.FloatField(default=0.0)
+    # [{song_id, title, popularity}], highest first
+    top_songs = models.JSONField(default=list)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Analytics rollup for {self.user_id}"
+
+
+class FrameFeatureSet(models.Model):
+    """Index of the frame-level arrays stored for one audio content hash"""
+    content_hash = models.CharField(max_length=64)
+    pipeline_version = models.CharField(max_length=32)
+    # Relative to MEDIA_ROOT
+    directory = models.CharField(max_length=255)
+    # {name: {dtype, shape}}
+    arrays = models.JSONField(default=dict)
+    # Framing parameters (sample rate, hops, segment length)
+    attributes = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['content_hash', 'pipeline_version']
+
+    def __str__(self):
+        return f"Frame features {self.content_hash[:12]} ({self.pipeline_version})"
+
+
+class BackfillCheckpoint(models.Model):
+    """Resume point of a rescoring run, keyed by run name"""
+    name = models.CharField(max_length=64, unique=True)
+    model_version = models.CharField(max_length=64)
+    last_id = models.BigIntegerField(default=0)
+    processed = models.BigIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Backfill {self.name} at {self.last_id}"
@@ -1,43 +1,82 @@
+import logging
 import os
+import shutil
+import tempfile
 import numpy as np
 import librosa
 import soundfile as sf
-from spleeter.separator import Separator
-import openl3
+from .audio import AudioBuffer, SEPARATION_SR, EMBEDDING_SR
+from .embeddings import EmbeddingEngine, EMBEDDING_SIZE
+from .instrumentation import span
+
+logger = logging.getLogger(__name__)
+
+STEM_NAMES = ("vocals", "drums", "bass", "other")
 
 class MusicDetector:
-    def __init__(self):
-        self.separator = Separator('spleeter:4stems')
+    def __init__(self, in_memory=True, embedding_engine=None, separator=None):
+        # In-memory mode keeps the stems as arrays; otherwise each call
+        # writes them to its own directory under output_dir.
+        self.in_memory = in_memory
+        if separator is None:
+            # Imported here so callers passing their own separator don't
+            # need TensorFlow
+            from spleeter.separator import Separator
+            separator = Separator('spleeter:4stems')
+        self.separator = separator
+        self.embedding_engine = embedding_engine or EmbeddingEngine()
+        # Only created once stems are actually written to disk
         self.output_dir = "temp_separated_audio"
-        os.makedirs(self.output_dir, exist_ok=True)
+
+    def warm_up(self):
+        """Run one second of silence through Spleeter and OpenL3"""
+        try:
+            self.separator.separate(np.zeros((SEPARATION_SR, 2), dtype=np.float32))
+            self.embedding_engine.embed([(np.zeros(EMBEDDING_SR, dtype=np.float32), EMBEDDING_SR)])
+        except Exception as e:
+            logger.warning("Error warming up models: %s", e)
     
-    def separate_stems(self, audio_path):
-        """Separate audio into stems"""
+    def separate_stems(self, audio):
+        """Separate audio into stems.
+
+        Returns a dict of stem name to (samples, channels) waveform at
+        44.1 kHz, or to a wav path when the detector isn't in memory mode.
+        """
         try:
-            # Get base name without extension
-            base_name = os.path.splitext(os.path.basename(audio_path))[0]
-            
-            # Separate audio
-            self.separator.separate_to_file(audio_path, self.output_dir)
-            
-            # Return paths to stems
-            stem_dir = os.path.join(self.output_dir, base_name)
-            stems = {
-                "vocals": os.path.join(stem_dir, "vocals.wav"),
-                "drums": os.path.join(stem_dir, "drums.wav"),
-                "bass": os.path.join(stem_dir, "bass.wav"),
-                "other": os.path.join(stem_dir, "other.wav")
-            }
-            
+            audio = AudioBuffer.from_source(audio)
+
+            # Separate the already-decoded 44.1 kHz waveform
+            sources = self.separator.separate(audio.for_separation())
+            stems = {name: sources[name] for name in STEM_NAMES}
+            if self.in_memory:
+                return stems
+
+            # Each call gets its own directory so concurrent workers
+            # never clean up each other's stems
+            os.makedirs(self.output_dir, exist_ok=True)
+            stem_dir = tempfile.mkdtemp(prefix=f"{audio.name}_", dir=self.output_dir)
+            for stem_name, waveform in stems.items():
+                stem_path = os.path.join(stem_dir, f"{stem_name}.wav")
+                sf.write(stem_path, waveform, SEPARATION_SR)
+                stems[stem_name] = stem_path
+
             return stems
         except Exception as e:
-            print(f"Error separating stems: {e}")
+            logger.exception("Error separating stems: %s", e)
             return None
+
+    def _load_stem(self, stem):
+        """Return a stem as a mono waveform and its sample rate"""
+        if isinstance(stem, str):
+            return librosa.load(stem, sr=None)
+        return librosa.to_mono(np.asarray(stem).T), SEPARATION_SR
     
-    def compute_energy_db(self, wav_path):
-        """Compute energy and dB level"""
+    def compute_energy_db(self, audio, sr=None):
+        """Compute energy and dB level from a wav path or a waveform"""
         try:
-            y, sr = librosa.load(wav_path, sr=None)
+            if isinstance(audio, str):
+                audio, sr = librosa.load(audio, sr=None)
+            y = audio
             rms = np.sqrt(np.mean(y**2))
             db = librosa.amplitude_to_db(np.array([rms]), ref=np.max)[0]
             energy = float(np.sum(y**2))
@@ -49,69 +88,128 @@ class MusicDetector:
                 'duration': duration
             }
         except Exception as e:
-            print(f"Error computing energy: {e}")
+            logger.exception("Error computing energy: %s", e)
             return {'energy': 0.0, 'db': -120.0, 'duration': 0.0}
     
-    def get_openl3_embedding(self, wav_path):
-        """Get OpenL3 embedding for audio"""
+    def get_openl3_embedding(self, audio, sr=None):
+        """Get OpenL3 embedding from a wav path or a waveform"""
         try:
-            y, sr = librosa.load(wav_path, sr=None)
-            emb, _ = openl3.get_audio_embedding(
-                y, sr, 
-                input_repr="mel256", 
-                content_type="music", 
-                embedding_size=512
-            )
-            mean_emb = emb.mean(axis=0)
-            norm_emb = mean_emb / np.linalg.norm(mean_emb) if np.linalg.norm(mean_emb) > 0 else mean_emb
-            return norm_emb.tolist()
+            if isinstance(audio, str):
+                audio, sr = librosa.load(audio, sr=None)
+            return self.embedding_engine.embed([(audio, sr)])[0].tolist()
         except Exception as e:
-            print(f"Error getting embedding: {e}")
-            return [0.0] * 512
+            logger.exception("Error getting embedding: %s", e)
+            return [0.0] * EMBEDDING_SIZE
     
-    def analyze_stems(self, audio_path):
+    def analyze_stems(self, audio, on_stage=None, keep_frames=False, recorder=None):
         """Analyze audio stems and return energy distribution"""
-        stems = self.separate_stems(audio_path)
-        if not stems:
-            return None
-        
-        results = {
-            'energy_info': {},
-            'proportions': {},
-            'embeddings': {},
-            'total_energy': 0.0
-        }
-        
-        # Analyze each stem
-        for stem_name, stem_path in stems.items():
-            if os.path.exists(stem_path):
+        return self.analyze_stems_batch([audio], on_stage, keep_frames, recorder)[0]
+
+    def analyze_stems_batch(self, audios, on_stage=None, keep_frames=False, recorder=None):
+        """Analyze the stems of several songs, embedding them all in one batch.
+
+        ``on_stage(name)``, if given, is called as separation ("stems") and
+        embedding ("embeddings") begin. With ``keep_frames`` each result also
+        carries ``frame_embeddings``, the per-frame OpenL3 matrix of each
+        stem. ``recorder`` (an instrumentation.Recorder) receives the
+        separation, energy and embedding spans.
+        """
+        if on_stage:
+            on_stage('stems')
+        batch = []
+        for audio in audios:
+            with span(recorder, 'separation'):
+                stems = self.separate_stems(audio)
+                if not stems:
+                    batch.append(None)
+                    continue
+
+                # Load each stem once for both energy and embedding
+                waveforms = {}
+                for stem_name, stem in stems.items():
+                    if isinstance(stem, str) and not os.path.exists(stem):
+                        continue
+                    waveforms[stem_name] = self._load_stem(stem)
+
+                # Clean up temporary files
+                if not self.in_memory:
+                    self._cleanup_temp_files(stems)
+
+            batch.append(waveforms)
+
+        if on_stage:
+            on_stage('embeddings')
+        with span(recorder, 'embedding'):
+            embeddings, frames = self._embed_batch(
+                [waveforms for waveforms in batch if waveforms is not None], keep_frames
+            )
+
+        all_results = []
+        for waveforms in batch:
+            if waveforms is None:
+                all_results.append(None)
+                continue
+
+            results = {
+                'energy_info': {},
+                'proportions': {},
+                'embeddings': {},
+                'total_energy': 0.0
+            }
+
+            # Analyze each stem
+            song_embeddings = embeddings.pop(0)
+            song_frames = frames.pop(0)
+            if keep_frames:
+                results['frame_embeddings'] = song_frames
+            for stem_name, (y, sr) in waveforms.items():
                 # Get energy info
-                energy_info = self.compute_energy_db(stem_path)
+                with span(recorder, 'energy'):
+                    energy_info = self.compute_energy_db(y, sr)
                 results['energy_info'][stem_name] = energy_info
                 results['total_energy'] += energy_info['energy']
-                
+
                 # Get embedding
-                embedding = self.get_openl3_embedding(stem_path)
-                results['embeddings'][stem_name] = embedding
-        
-        # Calculate proportions
-        if results['total_energy'] > 0:
-            for stem_name, info in results['energy_info'].items():
-                results['proportions'][stem_name] = round(
-                    info['energy'] / results['total_energy'] * 100, 2
-                )
-        
-        # Clean up temporary files
-        self._cleanup_temp_files()
-        
-        return results
+                results['embeddings'][stem_name] = song_embeddings[stem_name]
+
+            # Calculate proportions
+            if results['total_energy'] > 0:
+                for stem_name, info in results['energy_info'].items():
+                    results['proportions'][stem_name] = round(
+                        info['energy'] / results['total_energy'] * 100, 2
+                    )
+
+            all_results.append(results)
+
+        return all_results
+
+    def _embed_batch(self, songs, keep_frames=False):
+        """Embed every stem of every song in one engine call.
+
+        Returns ``(embeddings, frames)``; ``frames`` holds the per-frame
+        matrices when ``keep_frames`` is set and empty dicts otherwise.
+        """
+        try:
+            if keep_frames:
+                batch, frames = self.embedding_engine.embed_songs(songs, keep_frames=True)
+            else:
+                batch, frames = self.embedding_engine.embed_songs(songs), [{} for _ in songs]
+            return [
+                {stem_name: vector.tolist() for stem_name, vector in song.items()}
+                for song in batch
+            ], frames
+        except Exception as e:
+            logger.exception("Error getting embeddings: %s", e)
+            return [
+                {stem_name: [0.0] * EMBEDDING_SIZE for stem_name in song}
+                for song in songs
+            ], [{} for _ in songs]
     
-    def _cleanup_temp_files(self):
-        """Clean up temporary separated files"""
+    def _cleanup_temp_files(self, stems):
+        """Remove the directory holding this call's separated files"""
         try:
-            import shutil
-            if os.path.exists(self.output_dir):
-                shutil.rmtree(self.output_dir)
-                os.makedirs(self.output_dir, exist_ok=True)
+            stem_dirs = {os.path.dirname(path) for path in stems.values()}
+            for stem_dir in stem_dirs:
+                shutil.rmtree(stem_dir, ignore_errors=True)
         except Exception as e:
-            print(f"Error cleaning up: {e}")
+            logger.warning("Error cleaning up: %s", e)
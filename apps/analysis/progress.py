@@ -0,0 +1,75 @@
+"""Stage-level analysis progress over Redis pub/sub.
+
+The Celery stages publish a small JSON event on ``analysis:progress:<song_id>``
+as each stage begins or the run ends. The last event is also kept under
+``analysis:progress:last:<song_id>`` so that a client connecting mid-run sees
+the current stage immediately. ``views.analysis_events`` relays the channel to
+the browser as Server-Sent Events.
+
+Stages, in order: queued, decoding, features, stems, embeddings, then done or
+failed. The features and stems branches run in parallel, so their events
+interleave.
+"""
+import json
+import logging
+import time
+from django.conf import settings
+import redis
+import redis.asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('queued', 'decoding', 'features', 'stems', 'embeddings', 'done', 'failed')
+TERMINAL_STAGES = ('done', 'failed')
+
+_client = None
+
+
+def channel(song_id):
+    return f'analysis:progress:{song_id}'
+
+
+def last_event_key(song_id):
+    return f'analysis:progress:last:{song_id}'
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.ANALYSIS_PROGRESS_REDIS_URL)
+    return _client
+
+
+def event(song_id, stage, **data):
+    return {'song_id': song_id, 'stage': stage, 'timestamp': time.time(), **data}
+
+
+def publish_progress(song_id, stage, **data):
+    """Publish a stage event. Progress is best effort and never fails a task."""
+    payload = json.dumps(event(song_id, stage, **data))
+    try:
+        client = get_client()
+        pipe = client.pipeline()
+        pipe.set(last_event_key(song_id), payload, ex=settings.ANALYSIS_PROGRESS_TTL)
+        pipe.publish(channel(song_id), payload)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("Error publishing progress for song %s: %s", song_id, e)
+
+
+def stage_callback(song_id):
+    """A ``fn(stage)`` that publishes each stage of ``song_id``"""
+    return lambda stage: publish_progress(song_id, stage)
+
+
+async def subscribe(song_id):
+    """Open an async pub/sub subscription; returns (client, pubsub)"""
+    client = aioredis.Redis.from_url(settings.ANALYSIS_PROGRESS_REDIS_URL)
+    pubsub = client.pubsub()
+    await pubsub.subscribe(channel(song_id))
+    return client, pubsub
+
+
+async def last_event(client, song_id):
+    payload = await client.get(last_event_key(song_id))
+    return json.loads(payload) if payload else None
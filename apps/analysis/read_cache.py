@@ -0,0 +1,140 @@
+"""Read-through cache of serialized analyses.
+
+``get_analysis`` payloads are cached in Redis (Django's default cache) under
+the analysis ID, together with the owner, ``updated_at`` and an ETag derived
+from it. A small in-process LRU sits in front. Its entries live for only
+ANALYSIS_LOCAL_CACHE_SECONDS because other processes can't invalidate it.
+
+Every ``SongAnalysis.save()`` invalidates the entry through a post_save
+signal. Code that writes with ``QuerySet.update()`` or ``bulk_update()``
+bypasses signals and must call ``invalidate()`` itself.
+
+Invalidation also bumps a per-analysis version key. A reader takes the
+version before it queries the database, and the entry it stores carries
+that version. ``get`` ignores entries whose version is behind. So a fill
+that read the row just before a write can't put the old payload back.
+"""
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from .serializers import SongAnalysisSerializer
+
+KEY_PREFIX = 'analysis:payload:'
+VERSION_PREFIX = 'analysis:version:'
+
+
+class LocalLRU:
+    """Thread-safe LRU with a per-entry TTL"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local = LocalLRU(settings.ANALYSIS_LOCAL_CACHE_SIZE, settings.ANALYSIS_LOCAL_CACHE_SECONDS)
+
+
+def cache_key(analysis_id):
+    return f'{KEY_PREFIX}{analysis_id}'
+
+
+def version_key(analysis_id):
+    return f'{VERSION_PREFIX}{analysis_id}'
+
+
+def make_etag(analysis):
+    return f'"{analysis.id}-{analysis.updated_at.timestamp():.6f}"'
+
+
+def build_entry(analysis):
+    return {
+        'user_id': analysis.song.user_id,
+        'etag': make_etag(analysis),
+        'last_modified': analysis.updated_at.timestamp(),
+        'payload': SongAnalysisSerializer(analysis).data,
+    }
+
+
+def get(analysis_id):
+    """Cached entry for an analysis, or None on a miss"""
+    key = cache_key(analysis_id)
+    entry = local.get(key)
+    if entry is None:
+        found = cache.get_many([key, version_key(analysis_id)])
+        entry = found.get(key)
+        if entry is None or entry.get('version') != found.get(version_key(analysis_id), 0):
+            return None
+        local.set(key, entry)
+    return entry
+
+
+def version(analysis_id):
+    """Current version of an analysis' entry; read it before the database"""
+    return cache.get(version_key(analysis_id), 0)
+
+
+def store(analysis, version):
+    """Serialize ``analysis`` (with ``song`` loaded) into both tiers.
+
+    ``version`` is what ``version()`` returned before ``analysis`` was read.
+    """
+    entry = {**build_entry(analysis), 'version': version}
+    key = cache_key(analysis.id)
+    cache.set(key, entry, settings.ANALYSIS_READ_CACHE_SECONDS)
+    local.set(key, entry)
+    return entry
+
+
+def invalidate(*analysis_ids):
+    keys = [cache_key(analysis_id) for analysis_id in analysis_ids]
+    for key in keys:
+        local.delete(key)
+    for analysis_id in analysis_ids:
+        try:
+            cache.incr(version_key(analysis_id))
+        except ValueError:
+            # No version yet. Versions never expire: one that vanished would
+            # make older entries current again
+            if not cache.add(version_key(analysis_id), 1, None):
+                cache.incr(version_key(analysis_id))
+    cache.delete_many(keys)
+
+
+def invalidate_songs(*song_ids):
+    """Invalidate by song, for callers that only have song IDs"""
+    from .models import SongAnalysis
+
+    invalidate(*SongAnalysis.objects.filter(song_id__in=song_ids).values_list('id', flat=True))
@@ -0,0 +1,73 @@
+"""Process-level registry of the analysis models.
+
+Each Celery worker process builds the virality model, the Spleeter graph and
+the OpenL3 model once and hands the same instances to every task it runs.
+The model modules are imported by the factories, so importing the registry
+costs nothing until a model is first asked for.
+"""
+import threading
+
+from django.conf import settings
+
+_lock = threading.Lock()
+_instances = {}
+
+
+def _get(name, factory):
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = factory()
+                _instances[name] = instance
+    return instance
+
+
+def get_viral_analyzer():
+    """Return this process's shared ViralSongAnalyzer"""
+    return _get('viral_analyzer', _create_viral_analyzer)
+
+
+def _create_viral_analyzer():
+    from .viral_analyzer import ViralSongAnalyzer
+    return ViralSongAnalyzer()
+
+
+def get_music_detector():
+    """Return this process's shared MusicDetector"""
+    return _get('music_detector', _create_music_detector)
+
+
+def _create_music_detector():
+    from .music_detector import MusicDetector
+    from .embeddings import EmbeddingEngine
+
+    embedding_engine = EmbeddingEngine(
+        hop_size=settings.ANALYSIS_EMBEDDING_HOP_SIZE,
+        batch_size=settings.ANALYSIS_EMBEDDING_BATCH_SIZE,
+        preset=settings.ANALYSIS_EMBEDDING_PRESET
+    )
+    return MusicDetector(
+        in_memory=settings.ANALYSIS_STEMS_IN_MEMORY,
+        embedding_engine=embedding_engine
+    )
+
+
+def load_models(warm_up=False, stems=True):
+    """Load the models up front, optionally running a dummy inference.
+
+    Workers that only consume the light (features) queue pass
+    ``stems=False`` to skip Spleeter and OpenL3.
+    """
+    viral_analyzer = get_viral_analyzer()
+    music_detector = get_music_detector() if stems else None
+    if warm_up and music_detector:
+        music_detector.warm_up()
+    return viral_analyzer, music_detector
+
+
+def reset():
+    """Drop the cached instances (used after retraining or in a forked child)"""
+    with _lock:
+        _instances.clear()
@@ -0,0 +1,125 @@
+"""Re-score stored analyses with the current models.
+
+Virality and emotion scores are recomputed from the features already stored
+on each SongAnalysis (tempo, MFCC, contrast, chroma, duration), so no audio
+is decoded. Analyses are streamed in id order with ``iterator()``. Each batch
+is scored with one model call and written with ``bulk_update``. The batch
+then advances a BackfillCheckpoint in the same transaction, so an
+interrupted run resumes after the last committed batch. Rows already carrying
+the current ``model_version`` are skipped, and ``rate`` caps the rows written
+per second.
+"""
+import time
+from django.db import transaction
+from django.utils import timezone
+from .models import SongAnalysis, BackfillCheckpoint, EMOTION_FIELDS
+from .viral_analyzer import DEFAULT_ARTIST_POPULARITY, DEFAULT_YEAR
+from . import registry, read_cache, analytics
+
+SCORE_FIELDS = ['track_popularity_prediction', 'model_version', 'updated_at'] + EMOTION_FIELDS
+
+LOADED_FIELDS = [
+    'id', 'tempo', 'mfcc_features', 'spectral_features', 'chroma_features',
+    'duration_ms', 'artist_popularity', 'year', 'is_complete', 'rollup_snapshot',
+    'track_popularity_prediction', 'vocal_energy', 'drums_energy', 'bass_energy',
+    'other_energy', 'song__id', 'song__user_id', 'song__title',
+] + EMOTION_FIELDS
+
+
+class RescoreError(Exception):
+    pass
+
+
+def stored_features(analysis):
+    """The extract_audio_features subset the scoring models read"""
+    return {
+        'tempo': analysis.tempo,
+        'mfcc_features': analysis.mfcc_features,
+        'spectral_features': analysis.spectral_features,
+        'chroma_features': analysis.chroma_features,
+        'duration_ms': analysis.duration_ms,
+    }
+
+
+def _rescore_batch(analyzer, checkpoint, batch):
+    scorable = [analysis for analysis in batch if analysis.mfcc_features]
+    if scorable:
+        X = [
+            analyzer.feature_vector(
+                stored_features(analysis),
+                analysis.artist_popularity or DEFAULT_ARTIST_POPULARITY,
+                analysis.year or DEFAULT_YEAR
+            )
+            for analysis in scorable
+        ]
+        now = timezone.now()
+        for analysis, popularity in zip(scorable, analyzer.predict_matrix(X)):
+            for emotion, score in analyzer.analyze_emotion_impact(stored_features(analysis)).items():
+                setattr(analysis, emotion, score)
+            analysis.track_popularity_prediction = popularity
+            analysis.model_version = analyzer.model_version
+            analysis.updated_at = now
+
+    with transaction.atomic():
+        SongAnalysis.objects.bulk_update(scorable, SCORE_FIELDS, batch_size=500)
+        checkpoint.last_id = batch[-1].id
+        checkpoint.processed += len(scorable)
+        checkpoint.save(update_fields=['last_id', 'processed', 'updated_at'])
+
+    read_cache.invalidate(*[analysis.id for analysis in scorable])
+    for analysis in scorable:
+        if analysis.is_complete:
+            analytics.record(analysis)
+    return len(scorable)
+
+
+def rescore(name='default', chunk_size=500, rate=None, restart=False, on_batch=None):
+    """Re-score every analysis not yet at the current model version.
+
+    ``rate`` is a cap in rows per second. ``on_batch(checkpoint)`` is called
+    after each committed batch. Returns the checkpoint.
+    """
+    analyzer = registry.get_viral_analyzer()
+    if not analyzer.is_trained:
+        raise RescoreError('No trained virality model is loaded')
+    version = analyzer.model_version
+
+    checkpoint, created = BackfillCheckpoint.objects.get_or_create(
+        name=name, defaults={'model_version': version}
+    )
+    if restart or checkpoint.model_version != version:
+        checkpoint.model_version = version
+        checkpoint.last_id = 0
+        checkpoint.processed = 0
+        checkpoint.completed_at = None
+        checkpoint.save()
+
+    analyses = SongAnalysis.objects.filter(
+        id__gt=checkpoint.last_id,
+        tempo__isnull=False,
+        duration_ms__isnull=False
+    ).exclude(model_version=version).select_related('song').only(*LOADED_FIELDS).order_by('id')
+
+    started = time.monotonic()
+    written = 0
+    batch = []
+    for analysis in analyses.iterator(chunk_size=chunk_size):
+        batch.append(analysis)
+        if len(batch) < chunk_size:
+            continue
+        written += _rescore_batch(analyzer, checkpoint, batch)
+        batch = []
+        if on_batch:
+            on_batch(checkpoint)
+        if rate:
+            # Sleep off any lead over the allowed rate
+            time.sleep(max(0.0, written / rate - (time.monotonic() - started)))
+
+    if batch:
+        _rescore_batch(analyzer, checkpoint, batch)
+        if on_batch:
+            on_batch(checkpoint)
+
+    checkpoint.completed_at = timezone.now()
+    checkpoint.save(update_fields=['completed_at', 'updated_at'])
+    return checkpoint
@@ -0,0 +1,177 @@
+"""Idempotent analysis scheduling.
+
+Each SongAnalysis row doubles as the song's in-flight registry: ``state``,
+``task_id`` and the queue/start timestamps are written under a row lock
+before anything is enqueued. A song therefore has at most one active
+analysis. Repeated requests get the existing task back instead of
+enqueueing a duplicate. Running analyses refresh ``heartbeat_at`` at every
+stage, so a long mix is not mistaken for a lost one. A task that has been
+queued, or running without a heartbeat, for longer than
+``ANALYSIS_STALE_SECONDS`` is treated as lost (worker killed, broker message
+dropped) and may be replaced.
+
+Batch runs (see batch.py) claim their analyses the same way, under a
+``batch-`` task ID, and skip songs that another run holds.
+"""
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import SongAnalysis
+from . import progress, dispatch
+
+
+def is_stale(analysis, now=None):
+    """Whether an active analysis went ANALYSIS_STALE_SECONDS without a sign of life"""
+    last_seen = max(
+        filter(None, (analysis.heartbeat_at, analysis.started_at, analysis.queued_at)),
+        default=None
+    )
+    if last_seen is None:
+        return True
+    now = now or timezone.now()
+    return now - last_seen > timedelta(seconds=settings.ANALYSIS_STALE_SECONDS)
+
+
+def heartbeat(song_ids=None, task_id=None):
+    """Mark running analyses alive, by song or by the task that owns them"""
+    analyses = SongAnalysis.objects.filter(state=SongAnalysis.STATE_RUNNING)
+    if song_ids is not None:
+        analyses = analyses.filter(song_id__in=song_ids)
+    if task_id is not None:
+        analyses = analyses.filter(task_id=task_id)
+    # update() leaves updated_at, and so the cached payload's ETag, alone
+    analyses.update(heartbeat_at=timezone.now())
+
+
+def stage_callback(song_id):
+    """``progress.stage_callback`` that also refreshes the heartbeat"""
+    publish = progress.stage_callback(song_id)
+
+    def on_stage(stage):
+        publish(stage)
+        heartbeat([song_id])
+    return on_stage
+
+
+def _enqueue(song_id, task_id):
+    # Published first so it can't arrive after the worker's first stage
+    progress.publish_progress(song_id, 'queued', task_id=task_id)
+    dispatch.analyze_song(song_id, task_id=task_id)
+
+
+def schedule_analysis(song, force=False):
+    """Enqueue the song's analysis unless one is already active or done.
+
+    Returns ``(analysis, scheduled)``. Completed analyses are only re-run
+    with ``force``. Failed or stale ones are always rescheduled. The task is
+    sent after the transaction commits, so workers never see the row before
+    its task_id.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        analysis, created = SongAnalysis.objects.select_for_update().get_or_create(song=song)
+        if analysis.is_active and not is_stale(analysis, now):
+            return analysis, False
+        # is_complete covers rows analysed before state was tracked
+        if (analysis.state == SongAnalysis.STATE_COMPLETED or analysis.is_complete) and not force:
+            return analysis, False
+
+        analysis.state = SongAnalysis.STATE_QUEUED
+        analysis.task_id = str(uuid.uuid4())
+        analysis.queued_at = now
+        analysis.started_at = None
+        analysis.finished_at = None
+        analysis.save(update_fields=['state', 'task_id', 'queued_at', 'started_at', 'finished_at', 'updated_at'])
+
+        task_id = analysis.task_id
+        transaction.on_commit(lambda: _enqueue(song.id, task_id))
+
+    return analysis, True
+
+
+def claim(song_id, task_id):
+    """Mark the analysis running if ``task_id`` still owns it.
+
+    Returns the analysis, or None when a newer task has replaced this one (a
+    duplicate or stale delivery) and the caller should stop.
+    """
+    with transaction.atomic():
+        analysis, created = SongAnalysis.objects.select_for_update().get_or_create(song_id=song_id)
+        if analysis.task_id and task_id and analysis.task_id != task_id:
+            return None
+        if analysis.state == SongAnalysis.STATE_RUNNING and not is_stale(analysis):
+            # Redelivered message for a run that is still going
+            return None
+
+        analysis.state = SongAnalysis.STATE_RUNNING
+        analysis.task_id = task_id or analysis.task_id
+        analysis.started_at = timezone.now()
+        analysis.heartbeat_at = analysis.started_at
+        analysis.finished_at = None
+        analysis.features_complete = False
+        analysis.stems_complete = False
+        analysis.is_complete = False
+        analysis.error_message = None
+        analysis.save()
+    return analysis
+
+
+def owned(song_id, task_id):
+    """The song's analysis, if the run ``task_id`` still owns it.
+
+    Stages of a superseded run filter their writes through this so they
+    never touch the newer run's row. Without ``task_id`` (messages sent
+    before task ids were passed along) ownership isn't checked.
+    """
+    analyses = SongAnalysis.objects.filter(song_id=song_id)
+    return analyses.filter(task_id=task_id) if task_id else analyses
+
+
+def claim_batch(song_ids, task_id):
+    """Mark the analyses of ``song_ids`` running for a batch.
+
+    Songs whose analysis another run holds are skipped. Returns
+    ``{song_id: previous_state}`` for the claimed ones.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        SongAnalysis.objects.bulk_create(
+            [SongAnalysis(song_id=song_id) for song_id in song_ids], ignore_conflicts=True
+        )
+        claimed = {}
+        analyses = []
+        for analysis in SongAnalysis.objects.select_for_update().filter(song_id__in=song_ids):
+            if analysis.is_active and not is_stale(analysis, now):
+                continue
+            claimed[analysis.song_id] = analysis.state
+            analysis.state = SongAnalysis.STATE_RUNNING
+            analysis.task_id = task_id
+            analysis.started_at = now
+            analysis.heartbeat_at = now
+            analysis.finished_at = None
+            analyses.append(analysis)
+        SongAnalysis.objects.bulk_update(
+            analyses, ['state', 'task_id', 'started_at', 'heartbeat_at', 'finished_at']
+        )
+    return claimed
+
+
+def release_batch(task_id, previous_states):
+    """Hand back the analyses a batch still holds but didn't finish"""
+    with transaction.atomic():
+        analyses = list(SongAnalysis.objects.select_for_update().filter(
+            task_id=task_id, state=SongAnalysis.STATE_RUNNING
+        ))
+        for analysis in analyses:
+            previous = previous_states.get(analysis.song_id, SongAnalysis.STATE_PENDING)
+            # A lost run's active state would only block rescheduling
+            analysis.state = SongAnalysis.STATE_PENDING if previous in SongAnalysis.ACTIVE_STATES else previous
+        SongAnalysis.objects.bulk_update(analyses, ['state'])
+
+
+def finish(analysis, completed):
+    """Record the end of a run on ``analysis`` (saved by the caller)"""
+    analysis.state = SongAnalysis.STATE_COMPLETED if completed else SongAnalysis.STATE_FAILED
+    analysis.finished_at = timezone.now()
@@ -8,5 +8,5 @@ class SongAnalysisSerializer(serializers.ModelSerializer):
             'id', 'uplifting', 'distracting', 'reappraisal', 'motivating',
             'relaxing', 'suppressing', 'destressing', 'tempo', 'track_popularity_prediction',
             'vocal_energy', 'drums_energy', 'bass_energy', 'other_energy',
-            'is_complete', 'created_at'
+            'features_complete', 'stems_complete', 'is_complete', 'created_at'
         ]
@@ -0,0 +1,15 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import SongAnalysis
+from . import read_cache, analytics
+
+
+@receiver(post_save, sender=SongAnalysis)
+@receiver(post_delete, sender=SongAnalysis)
+def invalidate_analysis_payload(sender, instance, **kwargs):
+    read_cache.invalidate(instance.id)
+
+
+@receiver(post_delete, sender=SongAnalysis)
+def remove_from_analytics(sender, instance, **kwargs):
+    analytics.remove(instance)
@@ -0,0 +1,485 @@
+"""In-process similarity search over stem embeddings.
+
+Each index keeps its vectors in one contiguous float32 matrix, so a query is a
+single matrix-vector product followed by ``argpartition``. When an index grows
+past ``SIMILARITY_IVF_THRESHOLD`` vectors it also builds an inverted-file
+(IVF) partition. Queries then probe only the ``nprobe`` closest clusters
+instead of scanning the whole catalog.
+
+Indexes are built offline by ``manage.py build_similarity_index``. The build
+writes them to ``SIMILARITY_INDEX_DIR`` as .npy files with some spare rows,
+and each web process memory-maps them copy-on-write when it starts (see
+``warm_indexes``). The page cache shares the matrices between processes.
+Only rows added after the snapshot take private memory. Without a snapshot,
+the start-up warm-up loads the index from the database instead, and it
+never runs on the request path.
+
+After warm-up, an index picks up the rows written by ``analyze_song_task``
+incrementally, at most every ``SIMILARITY_REFRESH_SECONDS``. The IVF
+partition is retrained only by the offline build. Searches copy what they
+read under the index lock and score outside it. Removal leaves a tombstone
+rather than moving rows, so a search never sees a row change keys.
+
+Every row also records the song's owner. Refreshes recompute an
+eligibility mask from the owners who turned CollaborationMatching off, so
+catalog searches filter with the mask instead of a per-query ID list.
+"""
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import timedelta
+import numpy as np
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from apps.feature_settings.models import FeatureSettings
+from .models import StemEmbedding, STEM_FIELD_PREFIXES
+from .vectors import decode_vector
+
+logger = logging.getLogger(__name__)
+
+MIX = 'mix'
+INDEX_NAMES = (MIX,) + tuple(STEM_FIELD_PREFIXES)
+
+# Rows committed slightly out of id/timestamp order are re-read on the next
+# refresh; upserts are idempotent so the overlap is harmless.
+REFRESH_OVERLAP = timedelta(minutes=5)
+
+# Key of a removed row, and owner of a row whose owner isn't known
+TOMBSTONE = -1
+NO_OWNER = -1
+# Spare rows saved with a snapshot, as a fraction of its size
+SNAPSHOT_HEADROOM = 0.25
+CURRENT_FILE = 'CURRENT'
+META_FILE = 'meta.json'
+ARRAYS = ('vectors', 'keys', 'owners', 'centroids', 'assignments')
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class IndexSnapshot:
+    """What one search reads, captured under the index lock"""
+
+    def __init__(self, vectors, keys, centroids, assignments, nprobe, positions, eligible=None):
+        # ``vectors`` may be a view: rows below the captured size are only
+        # ever overwritten with the same key's new vector
+        self.vectors = vectors
+        self.keys = keys
+        self.centroids = centroids
+        self.assignments = assignments
+        self.nprobe = nprobe
+        self.positions = positions
+        # Rows whose owners allow catalog matching; None = no filter
+        self.eligible = eligible
+
+    def _candidates(self, query):
+        if self.centroids is None:
+            return None
+        probes = np.argpartition(
+            -(self.centroids @ query), min(self.nprobe, len(self.centroids)) - 1
+        )[:self.nprobe]
+        return np.flatnonzero(np.isin(self.assignments, probes))
+
+    def search(self, query, k=10, exclude=()):
+        query = _normalize(query)
+        positions = self.positions if self.positions is not None else self._candidates(query)
+
+        eligible = self.eligible
+        if positions is None:
+            scores = self.vectors @ query
+            keys = self.keys
+        else:
+            scores = self.vectors[positions] @ query
+            keys = self.keys[positions]
+            if eligible is not None:
+                eligible = eligible[positions]
+
+        mask = keys != TOMBSTONE
+        if eligible is not None:
+            mask &= eligible
+        if len(exclude):
+            mask &= ~np.isin(keys, np.fromiter(exclude, dtype=np.int64))
+        scores, keys = scores[mask], keys[mask]
+
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(keys[i]), float(scores[i])) for i in top]
+
+
+class VectorIndex:
+    """Cosine top-k over L2-normalised vectors keyed by song ID"""
+
+    def __init__(self, dim, capacity=1024):
+        self.dim = dim
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._keys = np.full(capacity, TOMBSTONE, dtype=np.int64)
+        self._owners = np.full(capacity, NO_OWNER, dtype=np.int64)
+        self._eligible = np.ones(capacity, dtype=bool)
+        self._opted_out = frozenset()
+        self._positions = {}
+        self._size = 0
+        # IVF state; None until build_ivf() runs
+        self._centroids = None
+        self._assignments = None
+        self._trained_size = 0
+        self.nprobe = 8
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def get(self, key):
+        position = self._positions.get(key)
+        if position is None:
+            return None
+        return self._vectors[position].copy()
+
+    def upsert(self, key, vector, owner=NO_OWNER):
+        vector = _normalize(vector)
+        position = self._positions.get(key)
+        if position is None:
+            if self._size == len(self._keys):
+                self._grow()
+            position = self._size
+            self._size += 1
+            self._positions[key] = position
+            self._keys[position] = key
+        self._owners[position] = owner
+        self._eligible[position] = owner not in self._opted_out
+        self._vectors[position] = vector
+        if self._centroids is not None:
+            self._assignments[position] = int(np.argmax(self._centroids @ vector))
+
+    def remove(self, key):
+        position = self._positions.pop(key, None)
+        if position is not None:
+            # Compacted away by the next _grow()
+            self._keys[position] = TOMBSTONE
+
+    def set_opted_out(self, owners):
+        """Exclude the rows of ``owners`` from eligible-only searches"""
+        opted_out = frozenset(owners)
+        if opted_out == self._opted_out:
+            return
+        self._opted_out = opted_out
+        # A new array, so snapshots holding the old one are unaffected
+        eligible = np.ones(len(self._keys), dtype=bool)
+        eligible[:self._size] = ~np.isin(
+            self._owners[:self._size], np.fromiter(opted_out, dtype=np.int64, count=len(opted_out))
+        )
+        self._eligible = eligible
+
+    def _grow(self):
+        """Move the live rows into new arrays with room to spare.
+
+        Snapshots taken earlier keep the old arrays, which are never touched
+        again.
+        """
+        live = np.flatnonzero(self._keys[:self._size] != TOMBSTONE)
+        capacity = max(1024, len(live) * 2)
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:len(live)] = self._vectors[live]
+        keys = np.full(capacity, TOMBSTONE, dtype=np.int64)
+        keys[:len(live)] = self._keys[live]
+        owners = np.full(capacity, NO_OWNER, dtype=np.int64)
+        owners[:len(live)] = self._owners[live]
+        eligible = np.ones(capacity, dtype=bool)
+        eligible[:len(live)] = self._eligible[live]
+        self._owners, self._eligible = owners, eligible
+        if self._assignments is not None:
+            assignments = np.zeros(capacity, dtype=np.int32)
+            assignments[:len(live)] = self._assignments[live]
+            self._assignments = assignments
+        self._vectors, self._keys = vectors, keys
+        self._size = len(live)
+        self._positions = {int(key): position for position, key in enumerate(keys[:self._size])}
+
+    @property
+    def needs_training(self):
+        threshold = settings.SIMILARITY_IVF_THRESHOLD
+        if len(self) < threshold:
+            return False
+        # Retrain once the catalog has doubled since the last partition
+        return self._centroids is None or len(self) >= 2 * self._trained_size
+
+    def build_ivf(self, nlist=None, iterations=10, sample_size=20000, seed=0):
+        """Partition the vectors with spherical k-means"""
+        vectors = self._vectors[:self._size]
+        live = np.flatnonzero(self._keys[:self._size] != TOMBSTONE)
+        nlist = nlist or max(1, int(np.sqrt(len(live))))
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(live, size=min(sample_size, len(live)), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=min(nlist, len(sample)), replace=False)].copy()
+
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(len(centroids)):
+                members = sample[labels == cluster]
+                if len(members):
+                    centroids[cluster] = _normalize(members.sum(axis=0))
+
+        assignments = np.zeros(len(self._keys), dtype=np.int32)
+        for start in range(0, self._size, 8192):
+            block = vectors[start:start + 8192]
+            assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+        self._centroids = centroids
+        self._assignments = assignments
+        self._trained_size = len(live)
+        self.nprobe = max(8, len(centroids) // 32)
+
+    def snapshot(self, restrict_to=None, eligible_only=False):
+        """Capture the arrays a search needs; call under the owner's lock"""
+        positions = None
+        if restrict_to is not None:
+            positions = np.fromiter(
+                (self._positions[key] for key in restrict_to if key in self._positions),
+                dtype=np.int64
+            )
+        return IndexSnapshot(
+            self._vectors[:self._size],
+            self._keys[:self._size].copy(),
+            self._centroids,
+            None if self._assignments is None else self._assignments[:self._size].copy(),
+            self.nprobe,
+            positions,
+            self._eligible[:self._size].copy() if eligible_only else None
+        )
+
+    def search(self, query, k=10, exclude=(), restrict_to=None, eligible_only=False):
+        """Return [(key, score)] of the k most similar vectors"""
+        return self.snapshot(restrict_to, eligible_only).search(query, k=k, exclude=exclude)
+
+    def save(self, directory):
+        """Write the index as .npy files, with spare rows for later upserts"""
+        if self._size and len(self) < self._size:
+            self._grow()
+        capacity = max(1024, int(self._size * (1 + SNAPSHOT_HEADROOM)))
+        vectors = np.lib.format.open_memmap(
+            os.path.join(directory, 'vectors.npy'), mode='w+', dtype=np.float32, shape=(capacity, self.dim)
+        )
+        vectors[:self._size] = self._vectors[:self._size]
+        vectors.flush()
+        del vectors
+        keys = np.full(capacity, TOMBSTONE, dtype=np.int64)
+        keys[:self._size] = self._keys[:self._size]
+        np.save(os.path.join(directory, 'keys.npy'), keys)
+        owners = np.full(capacity, NO_OWNER, dtype=np.int64)
+        owners[:self._size] = self._owners[:self._size]
+        np.save(os.path.join(directory, 'owners.npy'), owners)
+        if self._centroids is not None:
+            assignments = np.zeros(capacity, dtype=np.int32)
+            assignments[:self._size] = self._assignments[:self._size]
+            np.save(os.path.join(directory, 'centroids.npy'), self._centroids)
+            np.save(os.path.join(directory, 'assignments.npy'), assignments)
+        return {'size': self._size, 'trained_size': self._trained_size, 'nprobe': self.nprobe}
+
+    @classmethod
+    def load(cls, directory, meta):
+        """Map a saved index copy-on-write: shared pages until written"""
+        vectors = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='c')
+        index = cls(vectors.shape[1], capacity=0)
+        index._vectors = vectors
+        index._keys = np.load(os.path.join(directory, 'keys.npy'))
+        index._owners = np.load(os.path.join(directory, 'owners.npy'))
+        index._eligible = np.ones(len(index._keys), dtype=bool)
+        index._size = meta['size']
+        index._positions = {
+            int(key): position for position, key in enumerate(index._keys[:index._size])
+            if key != TOMBSTONE
+        }
+        centroids = os.path.join(directory, 'centroids.npy')
+        if os.path.exists(centroids):
+            index._centroids = np.load(centroids)
+            index._assignments = np.load(os.path.join(directory, 'assignments.npy'))
+            index._trained_size = meta['trained_size']
+            index.nprobe = meta['nprobe']
+        return index
+
+
+class StemSimilarityIndex:
+    """A VectorIndex kept in sync with the StemEmbedding table.
+
+    ``name`` is a stem, or ``'mix'`` for the normalised sum of all stems.
+    """
+
+    def __init__(self, name, dim=512):
+        self.name = name
+        self.index = VectorIndex(dim)
+        self._lock = threading.Lock()
+        self._synced_until = None
+        self._last_refresh = 0.0
+        self.warmed = False
+
+    def _rows(self, since):
+        rows = StemEmbedding.objects.all()
+        if since is not None:
+            rows = rows.filter(created_at__gte=since - REFRESH_OVERLAP)
+        if self.name != MIX:
+            rows = rows.filter(stem=self.name)
+        return rows.order_by('analysis_id', 'stem').values_list(
+            'analysis__song_id', 'analysis__song__user_id', 'dtype', 'vector', 'created_at'
+        ).iterator(chunk_size=2000)
+
+    def _sync(self):
+        # Opt-outs first, so new rows get their eligibility on upsert
+        self.index.set_opted_out(
+            FeatureSettings.objects.filter(CollaborationMatching=False).values_list('user_id', flat=True)
+        )
+        synced_until = self._synced_until
+        for song_id, rows in itertools.groupby(self._rows(synced_until), key=lambda row: row[0]):
+            vector = None
+            for _, owner, dtype, data, created_at in rows:
+                stem_vector = decode_vector(data, dtype).astype(np.float32)
+                vector = stem_vector if vector is None else vector + stem_vector
+                if synced_until is None or created_at > synced_until:
+                    synced_until = created_at
+            self.index.upsert(song_id, vector, owner)
+        self._synced_until = synced_until
+        self._last_refresh = time.monotonic()
+
+    def refresh(self, force=False):
+        """Load rows written since the last refresh"""
+        with self._lock:
+            if not force and time.monotonic() - self._last_refresh < settings.SIMILARITY_REFRESH_SECONDS:
+                return
+            self._sync()
+
+    def warm(self, directory=None):
+        """Map the saved snapshot, if any, then catch up from the database"""
+        with self._lock:
+            if self.warmed:
+                return
+            directory = directory or current_snapshot_dir()
+            path = directory and os.path.join(directory, self.name)
+            if path and os.path.exists(os.path.join(path, META_FILE)):
+                with open(os.path.join(path, META_FILE)) as f:
+                    meta = json.load(f)
+                self.index = VectorIndex.load(path, meta)
+                self._synced_until = parse_datetime(meta['synced_until']) if meta['synced_until'] else None
+            self._sync()
+            self.warmed = True
+
+    def build(self):
+        """Load every row and train the IVF partition when it is due"""
+        with self._lock:
+            self._sync()
+            if self.index.needs_training:
+                self.index.build_ivf()
+            self.warmed = True
+
+    def save(self, directory):
+        with self._lock:
+            path = os.path.join(directory, self.name)
+            os.makedirs(path)
+            meta = self.index.save(path)
+            meta['synced_until'] = self._synced_until.isoformat() if self._synced_until else None
+            with open(os.path.join(path, META_FILE), 'w') as f:
+                json.dump(meta, f)
+
+    def vector_for(self, song_id):
+        with self._lock:
+            return self.index.get(song_id)
+
+    def search(self, query, k=10, exclude=(), restrict_to=None, eligible_only=False):
+        """``eligible_only`` skips songs whose owners turned CollaborationMatching off"""
+        self.refresh()
+        if restrict_to is not None:
+            # Evaluated before taking the lock
+            restrict_to = list(restrict_to)
+        with self._lock:
+            snapshot = self.index.snapshot(restrict_to, eligible_only)
+        return snapshot.search(query, k=k, exclude=exclude)
+
+    def discard(self, song_ids):
+        with self._lock:
+            for song_id in song_ids:
+                self.index.remove(song_id)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def current_snapshot_dir():
+    """Directory of the active saved build, or None"""
+    pointer = os.path.join(settings.SIMILARITY_INDEX_DIR, CURRENT_FILE)
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as f:
+        return os.path.join(settings.SIMILARITY_INDEX_DIR, f.read().strip())
+
+
+def _index(name):
+    with _indexes_lock:
+        index = _indexes.get(name)
+        if index is None:
+            index = _indexes[name] = StemSimilarityIndex(name)
+    return index
+
+
+def get_index(name=MIX):
+    """Return this process's index for a stem (or 'mix')"""
+    if name not in INDEX_NAMES:
+        raise ValueError(f"Unknown similarity index: {name}")
+    index = _index(name)
+    if not index.warmed:
+        # Start-up warming is off, or still running and this waits for it
+        logger.warning("Similarity index %s not warmed yet; loading it now", name)
+        index.warm()
+    return index
+
+
+def warm_indexes():
+    """Load every index; run once per web process at start-up"""
+    for name in INDEX_NAMES:
+        try:
+            _index(name).warm()
+        except Exception:
+            logger.exception("Error warming similarity index %s", name)
+
+
+def warm_in_background():
+    threading.Thread(target=warm_indexes, name='similarity-warm-up', daemon=True).start()
+
+
+def build_snapshots(keep=2):
+    """Build every index from the database and publish it for web processes"""
+    root = settings.SIMILARITY_INDEX_DIR
+    os.makedirs(root, exist_ok=True)
+    build_id = time.strftime('%Y%m%dT%H%M%S')
+    staging = os.path.join(root, f'.{build_id}')
+    os.makedirs(staging)
+    try:
+        for name in INDEX_NAMES:
+            index = StemSimilarityIndex(name)
+            index.build()
+            index.save(staging)
+            yield name, len(index.index)
+        os.rename(staging, os.path.join(root, build_id))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    pointer = os.path.join(root, CURRENT_FILE)
+    with open(f'{pointer}.tmp', 'w') as f:
+        f.write(build_id)
+    os.replace(f'{pointer}.tmp', pointer)
+
+    # Running processes keep their mapped files open, so removing old builds
+    # is safe
+    builds = sorted(entry for entry in os.listdir(root) if entry[0].isdigit())
+    for old in builds[:-keep]:
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
@@ -0,0 +1,147 @@
+"""Streaming, full-track feature extraction.
+
+Audio is decoded block by block with ``librosa.stream`` and resampled to
+22.05 kHz with a streaming soxr resampler. It is then cut into fixed-length
+segments. Every segment is reduced to frame sums (for the track-level means)
+and one row of the per-segment timeline, then dropped. Memory stays flat
+however long the recording is. Only the onset envelope (~43 floats per
+second) is kept whole, for tempo estimation.
+"""
+import numpy as np
+import librosa
+import soundfile as sf
+import soxr
+from .audio import AudioBuffer, FEATURE_SR
+from .features import FeatureEngine, N_FFT, HOP_LENGTH, N_MFCC
+
+SEGMENT_SECONDS = 5.0
+# Decoder block size, in samples at the file's native rate
+DECODE_BLOCK = 4096
+
+# Layout of one timeline row
+TIMELINE_COLUMNS = (
+    ['start', 'rms']
+    + [f'mfcc_{i}' for i in range(N_MFCC)]
+    + [f'contrast_{i}' for i in range(7)]
+    + [f'chroma_{i}' for i in range(12)]
+)
+
+
+def blocks_from_file(path, sr=FEATURE_SR, block_seconds=SEGMENT_SECONDS):
+    """Yield mono float32 blocks at ``sr`` without decoding the whole file"""
+    try:
+        # librosa.stream is lazy and librosa.get_samplerate falls back to
+        # audioread, so probe libsndfile itself before committing to a stream
+        with sf.SoundFile(path) as f:
+            native_sr = f.samplerate
+        stream = librosa.stream(
+            path,
+            block_length=max(1, int(block_seconds * native_sr) // DECODE_BLOCK),
+            frame_length=DECODE_BLOCK,
+            hop_length=DECODE_BLOCK,
+            mono=True
+        )
+    except Exception:
+        # Formats libsndfile can't stream fall back to a full decode
+        yield from blocks_from_array(AudioBuffer.load(path).for_features(), sr, block_seconds)
+        return
+
+    if native_sr == sr:
+        yield from stream
+        return
+
+    resampler = soxr.ResampleStream(native_sr, sr, 1, dtype='float32', quality='HQ')
+    for block in stream:
+        yield resampler.resample_chunk(block.astype(np.float32))
+    yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+
+def blocks_from_array(y, sr=FEATURE_SR, block_seconds=SEGMENT_SECONDS):
+    """Yield views over an in-memory waveform already at ``sr``"""
+    step = int(block_seconds * sr)
+    for start in range(0, len(y), step):
+        yield y[start:start + step]
+
+
+class StreamingFeatureExtractor:
+    def __init__(self, sr=FEATURE_SR, segment_seconds=SEGMENT_SECONDS):
+        self.sr = sr
+        self.segment_seconds = segment_seconds
+        self.segment_length = int(segment_seconds * sr)
+        self.engine = FeatureEngine(sr=sr, hop_length=HOP_LENGTH)
+
+    def _segments(self, blocks):
+        """Re-cut arbitrary blocks into fixed-length segments"""
+        pending, pending_length = [], 0
+        for block in blocks:
+            pending.append(block)
+            pending_length += len(block)
+            while pending_length >= self.segment_length:
+                buffer = np.concatenate(pending)
+                yield buffer[:self.segment_length]
+                rest = buffer[self.segment_length:]
+                pending, pending_length = [rest], len(rest)
+        if pending_length:
+            yield np.concatenate(pending)
+
+    def segment_features(self, y):
+        """Frame-level features of one segment, all from a single STFT"""
+        return self.engine.compute(y)
+
+    def extract(self, blocks, frame_sink=None):
+        """Aggregate features over every block of a track.
+
+        ``frame_sink.append(frames)``, if given, receives each segment's
+        frame-level features before they are reduced.
+        """
+        sums = {'mfcc': 0.0, 'contrast': 0.0, 'chroma': 0.0}
+        frame_count = 0
+        total_samples = 0
+        onset_envelopes = []
+        timeline = []
+
+        for segment in self._segments(blocks):
+            start = total_samples / self.sr
+            total_samples += len(segment)
+            if len(segment) < N_FFT:
+                continue
+
+            frames = self.segment_features(segment)
+            if frame_sink is not None:
+                frame_sink.append(frames)
+            for name in sums:
+                sums[name] = sums[name] + frames[name].sum(axis=1)
+            frame_count += frames['mfcc'].shape[1]
+            onset_envelopes.append(frames['onset_env'])
+
+            timeline.append(np.concatenate([
+                [start, float(frames['rms'].mean())],
+                frames['mfcc'].mean(axis=1),
+                frames['contrast'].mean(axis=1),
+                frames['chroma'].mean(axis=1),
+            ]))
+
+        if frame_count == 0:
+            return None
+
+        tempo, _ = librosa.beat.beat_track(
+            onset_envelope=np.concatenate(onset_envelopes),
+            sr=self.sr,
+            hop_length=HOP_LENGTH
+        )
+
+        return {
+            'tempo': float(np.atleast_1d(tempo)[0]),
+            'mfcc_features': (sums['mfcc'] / frame_count).tolist(),
+            'spectral_features': (sums['contrast'] / frame_count).tolist(),
+            'chroma_features': (sums['chroma'] / frame_count).tolist(),
+            'duration_ms': int(total_samples / self.sr * 1000),
+            'timeline': np.asarray(timeline, dtype=np.float32),
+            'segment_seconds': self.segment_seconds,
+        }
+
+    def extract_file(self, path, frame_sink=None):
+        return self.extract(blocks_from_file(path, self.sr, self.segment_seconds), frame_sink)
+
+    def extract_array(self, y, frame_sink=None):
+        return self.extract(blocks_from_array(y, self.sr, self.segment_seconds), frame_sink)
@@ -1,76 +1,252 @@
-from celery import shared_task
+import json
+import logging
+from celery import shared_task, chord, group
+from celery.signals import worker_process_init
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 from apps.music.models import Song
-from .models import SongAnalysis
-from .viral_analyzer import ViralSongAnalyzer
-from .music_detector import MusicDetector
-
-@shared_task
-def analyze_song_task(song_id):
-    """Celery task to analyze a song"""
+from .models import SongAnalysis, STEM_FIELD_PREFIXES
+from . import (
+    registry, content_cache, batch, scheduling, progress, read_cache, analytics, feature_store,
+    instrumentation, dispatch
+)
+from .audio import AudioBuffer
+from .vectors import encode_matrix
+
+logger = logging.getLogger(__name__)
+
+@worker_process_init.connect
+def load_analysis_models(**kwargs):
+    """Load the analysis models once per worker process"""
+    if settings.ANALYSIS_PRELOAD_MODELS:
+        registry.load_models(
+            warm_up=settings.ANALYSIS_WARM_UP_MODELS,
+            stems=settings.ANALYSIS_PRELOAD_STEM_MODELS
+        )
+
+@shared_task(bind=True, name=dispatch.ANALYZE_SONG)
+def analyze_song_task(self, song_id):
+    """Celery task to analyze a song.
+
+    Serves duplicates from the content cache; otherwise fans out into a
+    chord of the features branch (light queue) and the stems branch (heavy
+    queue), merged by merge_analysis_stage. Schedule it through
+    scheduling.schedule_analysis so a song has one active run at a time.
+    """
     try:
         song = Song.objects.get(id=song_id)
 
-        # Create or get analysis instance
-        analysis, created = SongAnalysis.objects.get_or_create(song=song)
-
-        # Get file path
-        file_path = song.file.path
+        # Identical audio analysed before: copy the stored result
+        content_cache.ensure_content_hash(song)
+        if content_cache.apply_cached_result(song, task_id=self.request.id):
+            progress.publish_progress(song_id, 'done', cached=True)
+            return f"Analysis loaded from cache for song {song_id}"
+
+        # Duplicate or superseded deliveries stop here
+        analysis = scheduling.claim(song_id, self.request.id)
+        if analysis is None:
+            return f"Analysis already in progress for song {song_id}"
+
+        # The stages carry the claim so a rescheduled run supersedes them
+        task_id = analysis.task_id
+        chord(
+            group(
+                extract_features_stage.si(song_id, task_id),
+                analyze_stems_stage.si(song_id, task_id)
+            ),
+            merge_analysis_stage.s(song_id, task_id)
+        ).apply_async()
+
+        return f"Analysis scheduled for song {song_id}"
 
-        # Initialize analyzers
-        viral_analyzer = ViralSongAnalyzer()
-        music_detector = MusicDetector()
+    except Exception as e:
+        logger.exception("Analysis failed for song %s", song_id)
+        SongAnalysis.objects.filter(song_id=song_id, task_id=self.request.id or '').update(
+            state=SongAnalysis.STATE_FAILED,
+            error_message=str(e),
+            finished_at=timezone.now()
+        )
+        read_cache.invalidate_songs(song_id)
+        progress.publish_progress(song_id, 'failed', error=str(e))
+        return f"Error analyzing song {song_id}: {str(e)}"
 
-        # Extract audio features
-        audio_features = viral_analyzer.extract_audio_features(file_path)
+def _superseded(stage, song_id):
+    logger.info("Run of song %s was superseded; dropping its %s stage", song_id, stage)
+    return {'stage': stage, 'ok': False, 'error': 'Superseded by a newer run'}
 
-        if audio_features:
-            # Get emotion predictions
+@shared_task
+def extract_features_stage(song_id, task_id=None):
+    """Features, emotions and virality; persisted as soon as they're ready"""
+    frame_writer = None
+    committed = False
+    try:
+        if not scheduling.owned(song_id, task_id).exists():
+            return _superseded('features', song_id)
+        song = Song.objects.get(id=song_id)
+        viral_analyzer = registry.get_viral_analyzer()
+        progress.publish_progress(song_id, 'features')
+        recorder = instrumentation.Recorder()
+
+        # Streamed from disk in constant memory; frames go to the store
+        if settings.ANALYSIS_FEATURE_STORE and song.content_hash:
+            frame_writer = feature_store.FrameWriter(song.content_hash)
+        with recorder.span('features'):
+            audio_features = viral_analyzer.extract_audio_features(song.file.path, frame_writer)
+        if not audio_features:
+            return {'stage': 'features', 'ok': False, 'error': 'Feature extraction failed'}
+        scheduling.heartbeat([song_id])
+        if frame_writer:
+            try:
+                frame_writer.commit()
+                committed = True
+            except Exception as e:
+                # The store is a by-product (files or its index row); the
+                # analysis itself succeeded
+                logger.warning("Error storing frames for song %s: %s", song_id, e)
+
+        # Get emotion predictions
+        with recorder.span('emotion'):
             emotions = viral_analyzer.analyze_emotion_impact(audio_features)
 
-            # Update analysis with emotions
-            for emotion, score in emotions.items():
-                setattr(analysis, emotion, score)
-
-            # Update audio features
-            analysis.tempo = audio_features['tempo']
-            analysis.mfcc_features = audio_features['mfcc_features']
-            analysis.spectral_features = audio_features['spectral_features']
-            analysis.chroma_features = audio_features['chroma_features']
-            analysis.duration_ms = audio_features['duration_ms']
-
-            # Predict virality
+        # Predict virality
+        with recorder.span('virality'):
             popularity = viral_analyzer.predict_virality(
                 audio_features,
                 artist_popularity=50,  # Default value
                 year=2024
             )
-            analysis.track_popularity_prediction = popularity
 
-        # Analyze stems
-        stem_results = music_detector.analyze_stems(file_path)
+        # Only this branch's fields are written so the stems branch can
+        # save concurrently
+        written = scheduling.owned(song_id, task_id).update(
+            tempo=audio_features['tempo'],
+            mfcc_features=audio_features['mfcc_features'],
+            spectral_features=audio_features['spectral_features'],
+            chroma_features=audio_features['chroma_features'],
+            duration_ms=audio_features['duration_ms'],
+            feature_timeline=encode_matrix(audio_features['timeline']),
+            timeline_segment_seconds=audio_features['segment_seconds'],
+            track_popularity_prediction=popularity,
+            model_version=viral_analyzer.model_version,
+            features_complete=True,
+            updated_at=timezone.now(),
+            **emotions
+        )
+        if not written:
+            return _superseded('features', song_id)
+        read_cache.invalidate_songs(song_id)
+        return {'stage': 'features', 'ok': True, 'timings': recorder.summary()}
 
-        if stem_results:
-            # Update energy proportions
-            for stem_name, proportion in stem_results['proportions'].items():
-                setattr(analysis, f'{stem_name}_energy', proportion)
+    except Exception as e:
+        logger.exception("Feature extraction failed for song %s", song_id)
+        return {'stage': 'features', 'ok': False, 'error': str(e)}
+    finally:
+        # Whatever happened, an uncommitted writer leaves no part files
+        if frame_writer and not committed:
+            try:
+                frame_writer.abort()
+            except OSError as e:
+                logger.warning("Error removing partial frames for song %s: %s", song_id, e)
 
-            # Update embeddings
-            for stem_name, embedding in stem_results['embeddings'].items():
-                setattr(analysis, f'{stem_name}_embedding', embedding)
+@shared_task
+def analyze_stems_stage(song_id, task_id=None):
+    """Stem separation, energies and embeddings"""
+    try:
+        if not scheduling.owned(song_id, task_id).exists():
+            return _superseded('stems', song_id)
+        song = Song.objects.get(id=song_id)
+        music_detector = registry.get_music_detector()
+
+        on_stage = scheduling.stage_callback(song_id)
+        on_stage('decoding')
+        recorder = instrumentation.Recorder()
+        with recorder.span('decode'):
+            audio = AudioBuffer.load(song.file.path)
+        recorder.attributes['audio_seconds'] = round(audio.duration, 3)
+        keep_frames = settings.ANALYSIS_FEATURE_STORE and bool(song.content_hash)
+        stem_results = music_detector.analyze_stems(
+            audio, on_stage=on_stage, keep_frames=keep_frames,
+            recorder=recorder
+        )
+        audio.release()
+        if not stem_results:
+            return {'stage': 'stems', 'ok': False, 'error': 'Stem separation failed'}
+        if keep_frames and stem_results['frame_embeddings']:
+            try:
+                feature_store.save_stem_frames(
+                    song.content_hash,
+                    stem_results.pop('frame_embeddings'),
+                    music_detector.embedding_engine.hop_size
+                )
+            except Exception as e:
+                # Best effort, like the features branch's frames
+                logger.warning("Error storing stem frames for song %s: %s", song_id, e)
+
+        # Update energy proportions
+        energies = {
+            f'{STEM_FIELD_PREFIXES[stem_name]}_energy': proportion
+            for stem_name, proportion in stem_results['proportions'].items()
+        }
+        with transaction.atomic():
+            analysis = scheduling.owned(song_id, task_id).select_for_update().first()
+            if analysis is None:
+                return _superseded('stems', song_id)
+            SongAnalysis.objects.filter(pk=analysis.pk).update(
+                stems_complete=True,
+                updated_at=timezone.now(),
+                **energies
+            )
+            # Store embeddings as packed float32 rows
+            analysis.set_embeddings(stem_results['embeddings'])
+        read_cache.invalidate(analysis.pk)
+        return {'stage': 'stems', 'ok': True, 'timings': recorder.summary()}
+
+    except Exception as e:
+        logger.exception("Stem analysis failed for song %s", song_id)
+        return {'stage': 'stems', 'ok': False, 'error': str(e)}
 
-        # Mark as complete
-        analysis.is_complete = True
-        analysis.save()
+@shared_task
+def merge_analysis_stage(results, song_id, task_id=None):
+    """Mark the analysis complete once both branches have reported"""
+    with transaction.atomic():
+        analysis = scheduling.owned(song_id, task_id).select_for_update().first()
+        if analysis is None:
+            logger.info("Run of song %s was superseded; skipping its merge", song_id)
+            return f"Analysis of song {song_id} superseded by a newer run"
+        errors = [f"{result['stage']}: {result['error']}" for result in results if not result['ok']]
+
+        analysis.is_complete = analysis.features_complete and analysis.stems_complete
+        analysis.error_message = '; '.join(errors) or None
+        scheduling.finish(analysis, analysis.is_complete)
+        analysis.stage_timings = instrumentation.combine(results, analysis)
+        analysis.save(update_fields=[
+            'is_complete', 'error_message', 'state', 'finished_at', 'stage_timings', 'updated_at'
+        ])
+    instrumentation.export(analysis.stage_timings)
+    logger.info("Analysis of song %s finished: %s", song_id, json.dumps(analysis.stage_timings))
+
+    if analysis.is_complete:
+        # Only fully successful runs are reused for duplicate uploads
+        content_cache.store_result(analysis)
+        analytics.record(analysis)
 
         # Update song status
+        song = analysis.song
         song.is_analyzed = True
-        song.save()
-
+        song.save(update_fields=['is_analyzed', 'updated_at'])
+        progress.publish_progress(song_id, 'done')
         return f"Analysis completed for song {song_id}"
 
-    except Exception as e:
-        # Log error
-        if 'analysis' in locals():
-            analysis.error_message = str(e)
-            analysis.save()
-        return f"Error analyzing song {song_id}: {str(e)}"
+    progress.publish_progress(song_id, 'failed', error=analysis.error_message)
+    return f"Error analyzing song {song_id}: {analysis.error_message}"
+
+@shared_task(name=dispatch.ANALYZE_SONGS_BATCH)
+def analyze_songs_batch_task(song_ids, with_stems=False):
+    """Celery task to analyze many songs with vectorized scoring"""
+    written = batch.analyze_batch(
+        song_ids,
+        processes=settings.ANALYSIS_BATCH_PROCESSES,
+        with_stems=with_stems
+    )
+    return f"Batch analysis wrote {written} of {len(song_ids)} songs"
@@ -0,0 +1,283 @@
+"""Training pipeline for the virality model.
+
+1. Labels (``song_id,popularity[,artist_popularity,year]``) are read into
+   sorted NumPy columns.
+2. Stored features are streamed out of SongAnalysis in id-ordered chunks
+   and written straight into a preallocated float32 matrix backed by a
+   temporary file. The StandardScaler is fitted with ``partial_fit`` on the
+   same chunks.
+3. The matrix is scaled in place, chunk by chunk.
+4. Cross-validation folds are fitted in a process pool. The workers open
+   the matrix with ``mmap_mode='r'``, so it is never copied per process.
+5. The final forest is fitted with ``n_jobs`` threads.
+6. The pickles, the compiled forest and metrics.json go into a fresh
+   versioned directory. The directory is renamed into place, then the
+   CURRENT pointer is swapped atomically.
+
+Memory is planned against a fixed budget. The feature matrix is counted
+once. The rest of the budget caps the forest size through
+``min_samples_leaf``: a tree with ``s`` samples has at most about
+``2 * s / min_samples_leaf`` nodes. The fold processes that run at once are
+limited the same way.
+"""
+import json
+import math
+import os
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import joblib
+import numpy as np
+import pandas as pd
+from django.utils import timezone
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_absolute_error, r2_score
+from sklearn.model_selection import KFold
+from sklearn.preprocessing import StandardScaler
+from .models import SongAnalysis
+from . import compiled_forest
+from .viral_analyzer import (
+    MODEL_DIR, MODEL_FILE, SCALER_FILE, COMPILED_MODEL_FILE, VERSIONS_DIR, CURRENT_FILE,
+    DEFAULT_ARTIST_POPULARITY, DEFAULT_YEAR, file_digest
+)
+
+N_MFCC = 13
+N_CONTRAST = 7
+N_CHROMA = 12
+# tempo, MFCC, contrast, chroma, artist popularity, year, duration
+N_FEATURES = 1 + N_MFCC + N_CONTRAST + N_CHROMA + 3
+
+# sklearn Node struct plus one float64 value per node, rounded up
+BYTES_PER_NODE = 80
+# Interpreter, Django, sklearn and scratch buffers
+BASE_OVERHEAD = 300 * 1024 * 1024
+
+
+class TrainingError(Exception):
+    pass
+
+
+def load_labels(path):
+    """Label columns sorted by song_id, for ``np.searchsorted`` lookups"""
+    labels = pd.read_csv(path)
+    if not {'song_id', 'popularity'} <= set(labels.columns):
+        raise TrainingError('Labels need song_id and popularity columns')
+    labels = labels.sort_values('song_id')
+    return {
+        'song_id': labels['song_id'].to_numpy(np.int64),
+        'popularity': labels['popularity'].to_numpy(np.float64),
+        'artist_popularity': (
+            labels['artist_popularity'].to_numpy(np.float64) if 'artist_popularity' in labels
+            else np.full(len(labels), DEFAULT_ARTIST_POPULARITY, dtype=np.float64)
+        ),
+        'year': (
+            labels['year'].to_numpy(np.float64) if 'year' in labels
+            else np.full(len(labels), DEFAULT_YEAR, dtype=np.float64)
+        ),
+    }
+
+
+def build_matrix(labels, path, chunk_size=5000):
+    """Stream labelled features into a float32 .npy at ``path``.
+
+    Returns ``(X, y, scaler)``. ``X`` is the memory-mapped matrix, already
+    standardised in place by ``scaler``.
+    """
+    capacity = len(labels['song_id'])
+    X = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(capacity, N_FEATURES))
+    y = np.empty(capacity, dtype=np.float64)
+    scaler = StandardScaler()
+
+    rows = SongAnalysis.objects.filter(
+        tempo__isnull=False, duration_ms__isnull=False
+    ).order_by('song_id').values_list(
+        'song_id', 'tempo', 'mfcc_features', 'spectral_features', 'chroma_features', 'duration_ms'
+    )
+
+    n = 0
+    chunk_start = 0
+    for song_id, tempo, mfcc, contrast, chroma, duration_ms in rows.iterator(chunk_size=chunk_size):
+        index = np.searchsorted(labels['song_id'], song_id)
+        if index >= capacity or labels['song_id'][index] != song_id:
+            continue
+        if len(mfcc) != N_MFCC or len(contrast) != N_CONTRAST or len(chroma) != N_CHROMA:
+            continue
+        row = X[n]
+        row[0] = tempo
+        row[1:14] = mfcc
+        row[14:21] = contrast
+        row[21:33] = chroma
+        row[33] = labels['artist_popularity'][index]
+        row[34] = labels['year'][index]
+        row[35] = duration_ms
+        y[n] = labels['popularity'][index]
+        n += 1
+        if n - chunk_start == chunk_size:
+            scaler.partial_fit(X[chunk_start:n])
+            chunk_start = n
+    if n > chunk_start:
+        scaler.partial_fit(X[chunk_start:n])
+    if n < 2:
+        raise TrainingError('Fewer than two labelled analyses with stored features')
+
+    for start in range(0, n, chunk_size):
+        X[start:start + chunk_size] = scaler.transform(X[start:start + chunk_size])
+    X.flush()
+    return X[:n], y[:n], scaler
+
+
+def plan(n_rows, n_estimators, max_samples, budget_bytes, cv_folds):
+    """Choose min_samples_leaf and fold concurrency to fit ``budget_bytes``"""
+    matrix_bytes = n_rows * N_FEATURES * 4 + n_rows * 8
+    available = budget_bytes - BASE_OVERHEAD - matrix_bytes
+    if available <= 0:
+        raise TrainingError(
+            f'A budget of {budget_bytes // 2**20} MB cannot hold the '
+            f'{matrix_bytes // 2**20} MB feature matrix'
+        )
+    samples_per_tree = max(1, int(n_rows * max_samples))
+    max_nodes_per_tree = available / (n_estimators * BYTES_PER_NODE)
+    min_samples_leaf = max(1, math.ceil(2 * samples_per_tree / max_nodes_per_tree))
+    forest_bytes = n_estimators * BYTES_PER_NODE * 2 * samples_per_tree / min_samples_leaf
+    # Each fold process holds its own forest, a copy of its training rows and
+    # interpreter overhead; the full matrix is shared through the page cache
+    fold_bytes = forest_bytes + matrix_bytes + BASE_OVERHEAD
+    cv_workers = max(1, min(cv_folds, int(available // fold_bytes)))
+    return {
+        'min_samples_leaf': min_samples_leaf,
+        'cv_workers': cv_workers,
+        'estimated_forest_mb': round(forest_bytes / 2**20, 1),
+        'matrix_mb': round(matrix_bytes / 2**20, 1),
+    }
+
+
+def _forest(params, n_jobs):
+    return RandomForestRegressor(
+        n_estimators=params['n_estimators'],
+        max_samples=params['max_samples'],
+        min_samples_leaf=params['min_samples_leaf'],
+        random_state=params['random_state'],
+        n_jobs=n_jobs
+    )
+
+
+def _fit_fold(matrix_path, y, n_rows, train_index, test_index, params):
+    """Fit and score one CV fold in a worker process"""
+    X = np.load(matrix_path, mmap_mode='r')[:n_rows]
+    model = _forest(params, n_jobs=1).fit(X[train_index], y[train_index])
+    predictions = model.predict(X[test_index])
+    return {
+        'r2': float(r2_score(y[test_index], predictions)),
+        'mae': float(mean_absolute_error(y[test_index], predictions)),
+    }
+
+
+def cross_validate(matrix_path, y, n_rows, params, folds, workers):
+    splits = KFold(n_splits=folds, shuffle=True, random_state=params['random_state']).split(np.arange(n_rows))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_fit_fold, matrix_path, y, n_rows, train_index, test_index, params)
+            for train_index, test_index in splits
+        ]
+        return [future.result() for future in futures]
+
+
+def publish(model, scaler, metrics, model_dir=MODEL_DIR):
+    """Write a versioned artifact directory and point CURRENT at it"""
+    version = timezone.now().strftime('%Y%m%dT%H%M%S')
+    versions_dir = os.path.join(model_dir, VERSIONS_DIR)
+    os.makedirs(versions_dir, exist_ok=True)
+
+    staging = tempfile.mkdtemp(prefix=f'.{version}-', dir=versions_dir)
+    try:
+        model_file = os.path.join(staging, MODEL_FILE)
+        scaler_file = os.path.join(staging, SCALER_FILE)
+        joblib.dump(model, model_file)
+        joblib.dump(scaler, scaler_file)
+        compiled_forest.export(
+            model, scaler, os.path.join(staging, COMPILED_MODEL_FILE),
+            source_version=file_digest(model_file, scaler_file)
+        )
+        with open(os.path.join(staging, 'metrics.json'), 'w') as f:
+            json.dump({**metrics, 'version': version}, f, indent=2)
+        os.chmod(staging, 0o755)
+        os.rename(staging, os.path.join(versions_dir, version))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    pointer = os.path.join(model_dir, CURRENT_FILE)
+    with open(f'{pointer}.tmp', 'w') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{pointer}.tmp', pointer)
+    return version
+
+
+def train(labels_path, n_estimators=200, max_samples=1.0, cv_folds=5, n_jobs=-1,
+          memory_budget_mb=4096, chunk_size=5000, random_state=42, model_dir=MODEL_DIR, log=print):
+    """Train, validate and publish a new virality model; returns its metrics"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    workdir = tempfile.mkdtemp(prefix='viral_training_')
+    try:
+        labels = load_labels(labels_path)
+        matrix_path = os.path.join(workdir, 'features.npy')
+        X, y, scaler = build_matrix(labels, matrix_path, chunk_size)
+        del labels
+        n_rows = len(X)
+        load_seconds = time.perf_counter() - started
+        log(f"Loaded {n_rows} labelled analyses in {load_seconds:.1f}s")
+
+        layout = plan(n_rows, n_estimators, max_samples, memory_budget_mb * 2**20, cv_folds)
+        params = {
+            'n_estimators': n_estimators,
+            'max_samples': max_samples if max_samples < 1.0 else None,
+            'min_samples_leaf': layout['min_samples_leaf'],
+            'random_state': random_state,
+        }
+        log(
+            f"min_samples_leaf={layout['min_samples_leaf']}, "
+            f"~{layout['estimated_forest_mb']} MB per forest, {layout['cv_workers']} CV workers"
+        )
+
+        folds = []
+        cv_seconds = 0.0
+        if cv_folds >= 2:
+            cv_started = time.perf_counter()
+            folds = cross_validate(matrix_path, y, n_rows, params, cv_folds, layout['cv_workers'])
+            cv_seconds = time.perf_counter() - cv_started
+            log(f"CV R2 {np.mean([fold['r2'] for fold in folds]):.4f} in {cv_seconds:.1f}s")
+
+        fit_started = time.perf_counter()
+        model = _forest(params, n_jobs=n_jobs).fit(X, y)
+        fit_seconds = time.perf_counter() - fit_started
+        model.n_jobs = None
+
+        current, peak = tracemalloc.get_traced_memory()
+        metrics = {
+            'rows': n_rows,
+            'params': params,
+            'cv_folds': folds,
+            'cv_r2_mean': float(np.mean([fold['r2'] for fold in folds])) if folds else None,
+            'cv_mae_mean': float(np.mean([fold['mae'] for fold in folds])) if folds else None,
+            'load_seconds': round(load_seconds, 2),
+            'cv_seconds': round(cv_seconds, 2),
+            'fit_seconds': round(fit_seconds, 2),
+            'peak_traced_mb': round(peak / 2**20, 1),
+            # ru_maxrss is in KiB on Linux
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'max_cv_worker_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+            'memory_budget_mb': memory_budget_mb,
+            **layout,
+        }
+        del X
+        metrics['version'] = publish(model, scaler, metrics, model_dir)
+        return metrics
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -2,5 +2,7 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
+    path('analytics/', views.library_analytics, name='library-analytics'),
     path('<int:analysis_id>/', views.get_analysis, name='get-analysis'),
+    path('<int:analysis_id>/similar/', views.similar_songs, name='similar-songs'),
 ]
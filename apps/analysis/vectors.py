@@ -0,0 +1,34 @@
+"""Packed binary storage for embedding vectors.
+
+Vectors are stored as raw little-endian float32 (or float16) bytes. Decoding
+wraps the buffer returned by the database driver without copying it.
+"""
+import numpy as np
+
+DEFAULT_DTYPE = 'float32'
+SUPPORTED_DTYPES = ('float32', 'float16')
+
+
+def _dtype(name):
+    if name not in SUPPORTED_DTYPES:
+        raise ValueError(f"Unsupported vector dtype: {name}")
+    return np.dtype(name).newbyteorder('<')
+
+
+def encode_vector(values, dtype=DEFAULT_DTYPE):
+    """Pack a sequence or array of floats into bytes"""
+    return np.ascontiguousarray(values, dtype=_dtype(dtype)).tobytes()
+
+
+def decode_vector(data, dtype=DEFAULT_DTYPE):
+    """Return a read-only array view over packed bytes (no copy)"""
+    return np.frombuffer(data, dtype=_dtype(dtype))
+
+
+def encode_matrix(rows, dtype=DEFAULT_DTYPE):
+    """Pack a 2-D array row-major; the row width must be stored separately"""
+    return encode_vector(np.asarray(rows).reshape(-1), dtype)
+
+
+def decode_matrix(data, width, dtype=DEFAULT_DTYPE):
+    return decode_vector(data, dtype).reshape(-1, width)
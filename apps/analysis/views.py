@@ -2,21 +2,155 @@ from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from .models import SongAnalysis
-from .serializers import SongAnalysisSerializer
+import numpy as np
+from django.utils.http import http_date, parse_http_date_safe
+from apps.music.models import Song
+from apps.feature_settings.models import FeatureSettings
+from .models import SongAnalysis, UserAnalyticsRollup
+from . import similarity, read_cache, analytics
+
+MAX_SIMILAR_RESULTS = 100
+
+def _not_modified(request, entry):
+    """Evaluate If-None-Match, falling back to If-Modified-Since"""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or entry['etag'] in tags or f"W/{entry['etag']}" in tags
+    if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return if_modified_since is not None and int(entry['last_modified']) <= if_modified_since
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_analysis(request, analysis_id):
+    entry = read_cache.get(analysis_id)
+    if entry is None:
+        version = read_cache.version(analysis_id)
+        try:
+            analysis = SongAnalysis.objects.select_related('song').get(id=analysis_id)
+        except SongAnalysis.DoesNotExist:
+            analysis = None
+        entry = read_cache.store(analysis, version) if analysis else None
+
+    if entry is None or entry['user_id'] != request.user.id:
+        return Response(
+            {'error': 'Analysis not found'}, 
+            status=status.HTTP_404_NOT_FOUND
+        )
+
+    headers = {
+        'ETag': entry['etag'],
+        'Last-Modified': http_date(entry['last_modified']),
+        'Cache-Control': 'private, no-cache',
+    }
+    if _not_modified(request, entry):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(entry['payload'], status=status.HTTP_200_OK, headers=headers)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def similar_songs(request, analysis_id):
+    """Songs whose stem embeddings are closest to this analysis'.
+
+    ``stem`` selects a stem index or ``mix`` (default). ``scope=library``
+    searches the user's own songs (PlaylistRecommendations) and
+    ``scope=catalog`` searches every analysed song whose owner has
+    CollaborationMatching enabled, as the caller must.
+    """
     try:
         analysis = SongAnalysis.objects.get(
-            id=analysis_id, 
+            id=analysis_id,
             song__user=request.user
         )
-        serializer = SongAnalysisSerializer(analysis)
-        return Response(serializer.data, status=status.HTTP_200_OK)
     except SongAnalysis.DoesNotExist:
         return Response(
-            {'error': 'Analysis not found'}, 
+            {'error': 'Analysis not found'},
             status=status.HTTP_404_NOT_FOUND
         )
+
+    stem = request.GET.get('stem', similarity.MIX)
+    scope = request.GET.get('scope', 'library')
+    if stem not in similarity.INDEX_NAMES or scope not in ('library', 'catalog'):
+        return Response(
+            {'error': 'Invalid stem or scope'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    try:
+        k = max(1, min(int(request.GET.get('k', 10)), MAX_SIMILAR_RESULTS))
+    except ValueError:
+        return Response({'error': 'k must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+    feature_settings, created = FeatureSettings.objects.get_or_create(user=request.user)
+    enabled = (
+        feature_settings.PlaylistRecommendations if scope == 'library'
+        else feature_settings.CollaborationMatching
+    )
+    if not enabled:
+        return Response(
+            {'error': 'Feature disabled in settings'},
+            status=status.HTTP_403_FORBIDDEN
+        )
+
+    index = similarity.get_index(stem)
+    query = index.vector_for(analysis.song_id)
+    if query is None:
+        embeddings = analysis.get_embeddings()
+        if stem == similarity.MIX and embeddings:
+            query = np.sum(list(embeddings.values()), axis=0)
+        else:
+            query = embeddings.get(stem)
+    if query is None:
+        return Response(
+            {'error': 'Analysis has no embeddings yet'},
+            status=status.HTTP_409_CONFLICT
+        )
+
+    restrict_to = None
+    if scope == 'library':
+        restrict_to = Song.objects.filter(user=request.user).values_list('id', flat=True)
+
+    # Other users' songs are only matched if their owners opted in too; the
+    # index keeps that as a per-row mask
+    matches = index.search(
+        query, k=k, exclude=[analysis.song_id], restrict_to=restrict_to,
+        eligible_only=scope == 'catalog'
+    )
+    songs = Song.objects.in_bulk([song_id for song_id, score in matches])
+
+    # Songs deleted since they were indexed
+    index.discard([song_id for song_id, score in matches if song_id not in songs])
+
+    return Response({
+        'data': [
+            {'song_id': song_id, 'title': songs[song_id].title, 'score': round(score, 4)}
+            for song_id, score in matches if song_id in songs
+        ]
+    }, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def library_analytics(request):
+    """Library-wide distributions, served from the user's rollup row.
+
+    TargetAudience enables the emotion and tempo profile; TrendAnalysis
+    enables stem energies and predicted popularity.
+    """
+    feature_settings, created = FeatureSettings.objects.get_or_create(user=request.user)
+    if not (feature_settings.TargetAudience or feature_settings.TrendAnalysis):
+        return Response(
+            {'error': 'Feature disabled in settings'},
+            status=status.HTTP_403_FORBIDDEN
+        )
+
+    rollup = UserAnalyticsRollup.objects.filter(user=request.user).first()
+    if rollup is None:
+        rollup = UserAnalyticsRollup(user=request.user)
+
+    data = {'song_count': rollup.song_count}
+    if feature_settings.TargetAudience:
+        data['emotions'] = analytics.emotion_summary(rollup)
+        data['tempo'] = analytics.tempo_summary(rollup)
+    if feature_settings.TrendAnalysis:
+        data['stem_energy'] = analytics.energy_summary(rollup)
+        data['popularity'] = analytics.popularity_summary(rollup)
+    return Response(data, status=status.HTTP_200_OK)
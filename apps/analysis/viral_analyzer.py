@@ -1,87 +1,174 @@
-import librosa
 import numpy as np
-import pandas as pd
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.preprocessing import StandardScaler
-import joblib
+import hashlib
+import logging
 import os
+from .compiled_forest import CompiledForest
+
+logger = logging.getLogger(__name__)
+
+MODEL_DIR = 'models/viral_audio_model/'
+# Trained versions live in MODEL_DIR/versions/<version>/; CURRENT names the
+# active one. Without CURRENT the files are read from MODEL_DIR itself.
+VERSIONS_DIR = 'versions'
+CURRENT_FILE = 'CURRENT'
+MODEL_FILE = 'audio_rf_model.pkl'
+SCALER_FILE = 'audio_scaler.pkl'
+# Written by `manage.py export_viral_model`; preferred over the pickles
+COMPILED_MODEL_FILE = 'audio_rf_model.forest'
+# Bump when analyze_emotion_impact changes
+EMOTION_MODEL_VERSION = 'heuristic-1'
+UNTRAINED = 'untrained'
+# Inputs used when the artist's popularity and release year are unknown
+DEFAULT_ARTIST_POPULARITY = 50
+DEFAULT_YEAR = 2024
+
+def file_digest(*paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    return digest.hexdigest()[:12]
+
+def resolve_model_dir(base=MODEL_DIR):
+    """Directory of the active model version"""
+    pointer = os.path.join(base, CURRENT_FILE)
+    if os.path.exists(pointer):
+        with open(pointer) as f:
+            return os.path.join(base, VERSIONS_DIR, f.read().strip())
+    return base
+
+_installed_versions = {}
+
+def installed_model_version(model_dir=None):
+    """``model_version`` a fresh ViralSongAnalyzer would report, without loading the models"""
+    model_dir = model_dir or resolve_model_dir()
+    compiled_file = os.path.join(model_dir, COMPILED_MODEL_FILE)
+    model_file = os.path.join(model_dir, MODEL_FILE)
+    scaler_file = os.path.join(model_dir, SCALER_FILE)
+    stamp = tuple(
+        os.path.getmtime(path) if os.path.exists(path) else None
+        for path in (compiled_file, model_file, scaler_file)
+    )
+    cached = _installed_versions.get(model_dir)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    if stamp[0] is not None:
+        virality_version = f'rf-{CompiledForest.load(compiled_file).source_version or file_digest(compiled_file)}'
+    elif stamp[1] is not None and stamp[2] is not None:
+        virality_version = f'rf-{file_digest(model_file, scaler_file)}'
+    else:
+        virality_version = UNTRAINED
+    version = f'{virality_version}+emo-{EMOTION_MODEL_VERSION}'
+    _installed_versions[model_dir] = (stamp, version)
+    return version
 
 class ViralSongAnalyzer:
     def __init__(self):
         self.model = None
         self.scaler = None
-        self.model_path = 'models/viral_audio_model/'
+        self.compiled = None
+        self.virality_version = UNTRAINED
+        self.model_path = resolve_model_dir()
         self._load_or_create_model()
     
     def _load_or_create_model(self):
         """Load existing model or create a new one"""
-        model_file = os.path.join(self.model_path, 'audio_rf_model.pkl')
-        scaler_file = os.path.join(self.model_path, 'audio_scaler.pkl')
+        compiled_file = os.path.join(self.model_path, COMPILED_MODEL_FILE)
+        model_file = os.path.join(self.model_path, MODEL_FILE)
+        scaler_file = os.path.join(self.model_path, SCALER_FILE)
         
-        if os.path.exists(model_file) and os.path.exists(scaler_file):
+        if os.path.exists(compiled_file):
+            # Memory-mapped, shared read-only across forked workers
+            self.compiled = CompiledForest.load(compiled_file)
+            # Versioned by the pickles it was compiled from: same scores
+            self.virality_version = f'rf-{self.compiled.source_version or file_digest(compiled_file)}'
+        elif os.path.exists(model_file) and os.path.exists(scaler_file):
+            # scikit-learn is only needed for the pickles, not the compiled file
+            import joblib
             self.model = joblib.load(model_file)
             self.scaler = joblib.load(scaler_file)
+            self.virality_version = f'rf-{file_digest(model_file, scaler_file)}'
         else:
             # Create a simple model for demonstration
+            from sklearn.ensemble import RandomForestRegressor
+            from sklearn.preprocessing import StandardScaler
             self.model = RandomForestRegressor(n_estimators=200, random_state=42)
             self.scaler = StandardScaler()
             # You would train this with real data
     
-    def extract_audio_features(self, audio_path):
-        """Extract audio features from a file"""
+    @property
+    def is_trained(self):
+        return self.virality_version != UNTRAINED
+
+    @property
+    def model_version(self):
+        """Identifies the models behind the scores, stored on each analysis"""
+        return f'{self.virality_version}+emo-{EMOTION_MODEL_VERSION}'
+
+    @staticmethod
+    def extract_audio_features(audio, frame_sink=None):
+        """Extract full-track audio features from a file path or AudioBuffer.
+
+        Paths are streamed block by block in constant memory; buffers reuse
+        their decoded 22.05 kHz view. ``frame_sink`` receives the frame-level
+        features (see feature_store.FrameWriter).
+        """
+        # librosa is loaded with the first extraction; scoring alone (e.g.
+        # rescore_analyses) never needs it
+        from .audio import AudioBuffer
+        from .streaming import StreamingFeatureExtractor
         try:
-            y, sr = librosa.load(audio_path, duration=30)
-            
-            # Extract tempo
-            tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
-            
-            # Extract MFCCs (13 coefficients)
-            mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
-            mfcc_mean = np.mean(mfccs, axis=1).tolist()
-            
-            # Extract spectral contrast (7 bands)
-            spectral = librosa.feature.spectral_contrast(y=y, sr=sr)
-            spectral_mean = np.mean(spectral, axis=1).tolist()
-            
-            # Extract chroma features (12 pitch classes)
-            chroma = librosa.feature.chroma_stft(y=y, sr=sr)
-            chroma_mean = np.mean(chroma, axis=1).tolist()
-            
-            return {
-                'tempo': float(tempo),
-                'mfcc_features': mfcc_mean,
-                'spectral_features': spectral_mean,
-                'chroma_features': chroma_mean,
-                'duration_ms': int(len(y) / sr * 1000)
-            }
+            extractor = StreamingFeatureExtractor()
+            if isinstance(audio, AudioBuffer):
+                return extractor.extract_array(audio.for_features(), frame_sink)
+            return extractor.extract_file(audio, frame_sink)
         except Exception as e:
-            print(f"Error extracting features: {e}")
+            logger.exception("Error extracting features: %s", e)
             return None
     
-    def predict_virality(self, features, artist_popularity=50, year=2024):
-        """Predict track popularity based on features"""
-        if not features:
-            return None
-        
-        # Prepare feature vector
-        feature_vector = (
+    @staticmethod
+    def feature_vector(features, artist_popularity=DEFAULT_ARTIST_POPULARITY, year=DEFAULT_YEAR):
+        """Flatten extracted features into the model's input row"""
+        return (
             [features['tempo']] +
             features['mfcc_features'] +
             features['spectral_features'] +
             features['chroma_features'] +
             [artist_popularity, year, features['duration_ms']]
         )
-        
+
+    def predict_virality(self, features, artist_popularity=DEFAULT_ARTIST_POPULARITY, year=DEFAULT_YEAR):
+        """Predict track popularity based on features"""
+        if not features:
+            return None
+        return self.predict_virality_batch([features], artist_popularity, year)[0]
+
+    def predict_virality_batch(self, features_list, artist_popularity=DEFAULT_ARTIST_POPULARITY, year=DEFAULT_YEAR):
+        """Predict popularity for many tracks with one scaler/model call"""
+        if not features_list:
+            return []
+
+        # Prepare feature matrix
+        X = np.array([
+            self.feature_vector(features, artist_popularity, year)
+            for features in features_list
+        ], dtype=np.float64)
+        return self.predict_matrix(X)
+
+    def predict_matrix(self, X):
+        """Predict popularity for prepared feature_vector rows"""
         # If model is trained, use it for prediction
-        if hasattr(self.model, 'n_features_in_'):
-            X = np.array(feature_vector).reshape(1, -1)
-            X_scaled = self.scaler.transform(X)
-            prediction = self.model.predict(X_scaled)[0]
+        if self.compiled is not None:
+            predictions = self.compiled.predict(X)
+        elif hasattr(self.model, 'n_features_in_'):
+            predictions = self.model.predict(self.scaler.transform(X))
         else:
             # Return a mock prediction for demonstration
-            prediction = np.random.uniform(40, 85)
+            predictions = np.random.uniform(40, 85, size=len(X))
         
-        return float(prediction)
+        return [float(prediction) for prediction in predictions]
     
     def analyze_emotion_impact(self, audio_features):
         """Analyze emotional impact based on audio features"""
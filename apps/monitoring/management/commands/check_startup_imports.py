@@ -0,0 +1,89 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Modules that belong to the Celery workers only
+HEAVY_MODULES = (
+    'tensorflow', 'torch', 'spleeter', 'openl3', 'librosa', 'sklearn',
+    'pandas', 'scipy', 'numba', 'soundfile', 'soxr', 'joblib',
+)
+
+# Run in a fresh interpreter: boot the web application the way the ASGI/WSGI
+# server does, resolve every URL module, then report time, RSS and modules
+PROBE = """
+import json, resource, sys, time
+started = time.perf_counter()
+import importlib
+application = importlib.import_module(sys.argv[1]).application
+from django.urls import get_resolver
+get_resolver().url_patterns
+seconds = time.perf_counter() - started
+rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+try:
+    with open('/proc/self/status') as f:
+        rss_mb = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:')) / 1024
+except OSError:
+    pass
+print(json.dumps({'seconds': seconds, 'rss_mb': rss_mb, 'modules': sorted(sys.modules)}))
+"""
+
+
+class Command(BaseCommand):
+    help = "Boot the web application in a fresh process and fail if it imports the ML stack or is too slow"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entrypoint', choices=['asgi', 'wsgi'], default='asgi')
+        parser.add_argument('--runs', type=int, default=3, help="Boots to take the median of")
+        parser.add_argument('--max-seconds', type=float, default=None)
+        parser.add_argument('--max-rss-mb', type=float, default=None)
+        parser.add_argument('--json', action='store_true', help="Print the measurements as JSON")
+
+    def _boot(self, module):
+        env = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'moodsinger.settings'),
+            'PYTHONPATH': os.pathsep.join(filter(None, [str(settings.BASE_DIR), os.environ.get('PYTHONPATH')])),
+            # Measure the boot itself, not the similarity index warm-up thread
+            'SIMILARITY_WARM_ON_START': 'false',
+        }
+        result = subprocess.run(
+            [sys.executable, '-c', PROBE, module],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise CommandError(f"Web application failed to boot:\n{result.stderr}")
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def handle(self, *args, **options):
+        module = f"{settings.ROOT_URLCONF.split('.')[0]}.{options['entrypoint']}"
+        boots = [self._boot(module) for _ in range(max(1, options['runs']))]
+        loaded = sorted({
+            name for boot in boots for name in boot['modules']
+            if name.split('.')[0] in HEAVY_MODULES
+        })
+        report = {
+            'entrypoint': module,
+            'seconds': round(statistics.median(boot['seconds'] for boot in boots), 3),
+            'rss_mb': round(statistics.median(boot['rss_mb'] for boot in boots), 1),
+            'heavy_modules': sorted({name.split('.')[0] for name in loaded}),
+        }
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write(f"{module}: {report['seconds']}s, {report['rss_mb']} MB RSS")
+
+        failures = []
+        if report['heavy_modules']:
+            failures.append(f"imports {', '.join(report['heavy_modules'])}")
+        if options['max_seconds'] is not None and report['seconds'] > options['max_seconds']:
+            failures.append(f"took {report['seconds']}s (limit {options['max_seconds']}s)")
+        if options['max_rss_mb'] is not None and report['rss_mb'] > options['max_rss_mb']:
+            failures.append(f"used {report['rss_mb']} MB (limit {options['max_rss_mb']} MB)")
+        if failures:
+            raise CommandError(f"Web startup regressed: {'; '.join(failures)}")
+        self.stdout.write(self.style.SUCCESS("Web startup is free of the analysis ML stack"))
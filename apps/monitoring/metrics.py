@@ -0,0 +1,196 @@
+"""Prometheus histograms shared by every process through Redis.
+
+Web and Celery workers observe into the same Redis hashes, so a scrape of
+``/metrics`` on any web process exports the whole deployment. Each
+histogram is one hash, ``metrics:<name>``. Every label set gets one field
+per bucket plus ``sum``. An observation bumps its own bucket and the sum,
+and several observations share one pipelined round trip. The buckets are
+made cumulative when the page is rendered.
+
+Observing is best effort: a Redis failure is logged and never raised into
+the request or task. The client has short socket timeouts. Requests don't
+talk to Redis at all: ``record_later`` buffers their observations in the
+process, and a background thread flushes the buffer every
+``METRICS_FLUSH_SECONDS``. If Redis stays down, the oldest observations
+are dropped once ``METRICS_BUFFER_SIZE`` are waiting.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from django.conf import settings
+import redis
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'metrics:'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+INF = float('inf')
+
+REGISTRY = {}
+_client = None
+_buffer = deque(maxlen=settings.METRICS_BUFFER_SIZE)
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(
+            settings.METRICS_REDIS_URL,
+            socket_connect_timeout=settings.METRICS_REDIS_TIMEOUT,
+            socket_timeout=settings.METRICS_REDIS_TIMEOUT
+        )
+    return _client
+
+
+def _format_value(value):
+    if value == INF:
+        return '+Inf'
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets)) + (INF,)
+        self.labels = tuple(labels)
+        REGISTRY[name] = self
+
+    @property
+    def key(self):
+        return f'{KEY_PREFIX}{self.name}'
+
+    def _label_key(self, labels):
+        return json.dumps([str(labels[name]) for name in self.labels])
+
+    def queue(self, pipe, value, labels):
+        """Add one observation to a Redis pipeline"""
+        label_key = self._label_key(labels)
+        bucket = next(le for le in self.buckets if value <= le)
+        pipe.hincrby(self.key, f'{label_key}|{_format_value(bucket)}', 1)
+        pipe.hincrbyfloat(self.key, f'{label_key}|sum', value)
+
+    def observe(self, value, **labels):
+        record([(self, value, labels)])
+
+    def render(self, fields):
+        """Exposition lines for the hash ``fields`` read back from Redis"""
+        series = {}
+        for field, raw in fields.items():
+            label_key, _, suffix = field.decode().rpartition('|')
+            series.setdefault(label_key, {})[suffix] = raw.decode()
+
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_key in sorted(series):
+            values = series[label_key]
+            labels = ','.join(
+                f'{name}="{_escape(value)}"' for name, value in zip(self.labels, json.loads(label_key))
+            )
+            prefix = f'{labels},' if labels else ''
+            cumulative = 0
+            for le in self.buckets:
+                cumulative += int(values.get(_format_value(le), 0))
+                lines.append(f'{self.name}_bucket{{{prefix}le="{_format_value(le)}"}} {cumulative}')
+            braces = f'{{{labels}}}' if labels else ''
+            lines.append(f'{self.name}_sum{braces} {values.get("sum", "0")}')
+            lines.append(f'{self.name}_count{braces} {cumulative}')
+        return lines
+
+
+def record(observations):
+    """Observe ``[(histogram, value, labels), ...]`` in one round trip"""
+    if not observations:
+        return
+    try:
+        pipe = get_client().pipeline(transaction=False)
+        for histogram, value, labels in observations:
+            histogram.queue(pipe, value, labels)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("Error recording metrics: %s", e)
+
+
+def _flush_forever():
+    while True:
+        time.sleep(settings.METRICS_FLUSH_SECONDS)
+        try:
+            flush()
+        except Exception:
+            logger.exception("Error flushing metrics")
+
+
+def flush():
+    """Record everything ``record_later`` has buffered"""
+    observations = []
+    while _buffer:
+        try:
+            observations.append(_buffer.popleft())
+        except IndexError:
+            break
+    record(observations)
+
+
+def record_later(observations):
+    """Buffer observations for the background flusher; never blocks on Redis"""
+    global _flusher_pid
+    _buffer.extend(observations)
+    # One flusher per process; a forked worker starts its own
+    if _flusher_pid != os.getpid():
+        with _flusher_lock:
+            if _flusher_pid != os.getpid():
+                threading.Thread(target=_flush_forever, name='metrics-flush', daemon=True).start()
+                _flusher_pid = os.getpid()
+
+
+def render():
+    """Every registered histogram in the Prometheus text format"""
+    pipe = get_client().pipeline(transaction=False)
+    for histogram in REGISTRY.values():
+        pipe.hgetall(histogram.key)
+    lines = []
+    for histogram, fields in zip(REGISTRY.values(), pipe.execute()):
+        lines.extend(histogram.render(fields))
+    return '\n'.join(lines) + '\n'
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'moodsinger_http_request_duration_seconds',
+    'API view latency by route pattern.',
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    labels=('method', 'route', 'status')
+)
+
+ANALYSIS_STAGE_SECONDS = Histogram(
+    'moodsinger_analysis_stage_duration_seconds',
+    'Time spent in each analysis stage.',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+    labels=('stage',)
+)
+
+ANALYSIS_PEAK_MEMORY_BYTES = Histogram(
+    'moodsinger_analysis_peak_memory_bytes',
+    'Peak resident memory of each analysis branch.',
+    buckets=tuple(2**power * 2**20 for power in range(7, 16)),
+    labels=('branch',)
+)
+
+ANALYSIS_AUDIO_SECONDS = Histogram(
+    'moodsinger_analysis_audio_duration_seconds',
+    'Duration of the analysed audio.',
+    buckets=(10, 30, 60, 120, 180, 300, 600, 1200, 3600, 7200)
+)
+
+ANALYSIS_REALTIME_FACTOR = Histogram(
+    'moodsinger_analysis_realtime_factor',
+    'Processing seconds on the slower branch per second of audio.',
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+)
@@ -0,0 +1,47 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from . import metrics
+
+# Routes left out of the latency histogram
+EXCLUDED_ROUTES = ('metrics',)
+
+
+class RequestLatencyMiddleware:
+    """Observe each routed request's latency, labelled by its URL pattern.
+
+    The route pattern (``api/analysis/<int:analysis_id>/``) rather than the
+    path keeps the label set bounded. For streaming responses this measures
+    the time to the response headers. Observations are buffered and sent to
+    Redis off the request path (see metrics.record_later).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started)
+        return response
+
+    @staticmethod
+    def observe(request, response, seconds):
+        match = request.resolver_match
+        if match is None or match.route in EXCLUDED_ROUTES:
+            return
+        metrics.record_later([(
+            metrics.HTTP_REQUEST_SECONDS, seconds,
+            {'method': request.method, 'route': match.route, 'status': response.status_code}
+        )])
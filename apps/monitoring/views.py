@@ -0,0 +1,22 @@
+import logging
+from django.conf import settings
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET
+import redis
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+@require_GET
+def metrics_view(request):
+    """Prometheus scrape endpoint; requires METRICS_TOKEN as a bearer token when set"""
+    token = settings.METRICS_TOKEN
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponse(status=401)
+    try:
+        body = metrics.render()
+    except redis.RedisError as e:
+        logger.warning("Error reading metrics: %s", e)
+        return HttpResponse(status=503)
+    return HttpResponse(body, content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class MusicConfig(AppConfig):
+    name = 'apps.music'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,44 @@
+"""Maintained per-user song counts.
+
+Counts are adjusted with ``F()`` updates when songs are created or deleted
+(see signals.py). A user's counter row is created lazily with one
+``COUNT(*)``. That count already includes the write that triggered it, so the
+first increment is never applied twice.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .models import Song, SongCounter
+
+
+def _initialize(user_id):
+    try:
+        with transaction.atomic():
+            counter, created = SongCounter.objects.get_or_create(
+                user_id=user_id,
+                defaults={'count': Song.objects.filter(user_id=user_id).count()}
+            )
+    except IntegrityError:
+        counter = SongCounter.objects.get(user_id=user_id)
+    return counter
+
+
+def adjust(user_id, delta):
+    updated = SongCounter.objects.filter(user_id=user_id).update(count=F('count') + delta)
+    # Deletes never create a row: the user may be mid-cascade, and the next
+    # read recounts anyway
+    if not updated and delta > 0:
+        _initialize(user_id)
+
+
+def get_count(user_id):
+    count = SongCounter.objects.filter(user_id=user_id).values_list('count', flat=True).first()
+    if count is None:
+        count = _initialize(user_id).count
+    return count
+
+
+def rebuild(user_id):
+    """Recount from scratch, e.g. after raw SQL deletes"""
+    count = Song.objects.filter(user_id=user_id).count()
+    SongCounter.objects.update_or_create(user_id=user_id, defaults={'count': count})
+    return count
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from apps.music import uploads
+
+
+class Command(BaseCommand):
+    help = "Delete unfinished chunked uploads idle longer than UPLOAD_SESSION_TTL_SECONDS, with their spool files"
+
+    def handle(self, *args, **options):
+        removed = uploads.expire()
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} expired uploads"))
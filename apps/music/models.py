@@ -1,3 +1,4 @@
+import uuid
 from django.db import models
 from django.contrib.auth import get_user_model
 
@@ -8,24 +9,61 @@ class Song(models.Model):
     title = models.CharField(max_length=255)
     file = models.FileField(upload_to='songs/')
     url = models.URLField(null=True, blank=True)
+    # SHA-256 of the uploaded audio, used to reuse analyses of duplicate files
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)
     is_analyzed = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
-        ordering = ['-created_at']
+        ordering = ['-created_at', '-id']
+        indexes = [
+            # Matches the listing order, for keyset pagination per user
+            models.Index(fields=['user', '-created_at', '-id'], name='song_user_created_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
-class SongChunk(models.Model):
-    song = models.ForeignKey(Song, on_delete=models.CASCADE, related_name='chunks')
-    chunk_number = models.IntegerField()
-    total_chunks = models.IntegerField()
-    chunk_data = models.BinaryField()
+class SongCounter(models.Model):
+    """Per-user song count, maintained by signals instead of COUNT(*)"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='song_counter')
+    count = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.count} songs for {self.user_id}"
+
+class UploadSession(models.Model):
+    """A chunked upload being spooled to disk.
+
+    Chunk bytes go straight to a preallocated file on the media volume; this
+    row only tracks which chunks have arrived, as a bitmap.
+    """
+    upload_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
     unique_id = models.CharField(max_length=255)
+    filename = models.CharField(max_length=255)
+    title = models.CharField(max_length=255, blank=True)
+    # Optional SHA-256 of the whole file, verified on finalize
+    checksum = models.CharField(max_length=64, blank=True)
+    total_chunks = models.IntegerField()
+    chunk_size = models.BigIntegerField()
+    # Known once the final (possibly shorter) chunk has arrived
+    total_size = models.BigIntegerField(null=True, blank=True)
+    received = models.BinaryField(default=b'')
+    received_count = models.IntegerField(default=0)
+    song = models.ForeignKey(Song, on_delete=models.SET_NULL, null=True, blank=True, related_name='upload_sessions')
+    completed_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
-        unique_together = ['song', 'chunk_number']
-        ordering = ['chunk_number']
+        unique_together = ['user', 'unique_id']
+
+    def __str__(self):
+        return f"Upload {self.unique_id} ({self.received_count}/{self.total_chunks})"
+
+    @property
+    def is_complete(self):
+        return self.received_count == self.total_chunks
@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import Song
 
@@ -11,3 +12,24 @@ class SongListSerializer(serializers.ModelSerializer):
     class Meta:
         model = Song
         fields = ['id', 'title', 'is_analyzed', 'created_at']
+
+class UploadSessionCreateSerializer(serializers.Serializer):
+    filename = serializers.CharField(max_length=255)
+    title = serializers.CharField(max_length=255, required=False, allow_blank=True)
+    totalSize = serializers.IntegerField(min_value=1)
+    chunkSize = serializers.IntegerField(min_value=1, max_value=settings.DATA_UPLOAD_MAX_MEMORY_SIZE)
+    # Optional client-side ID, and SHA-256 of the whole file
+    uniqueId = serializers.CharField(max_length=255, required=False)
+    checksum = serializers.RegexField(r'^[0-9a-fA-F]{64}$', required=False)
+
+    def validate_totalSize(self, value):
+        if value > settings.UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f'Uploads are limited to {settings.UPLOAD_MAX_SIZE} bytes')
+        return value
+
+    def validate(self, data):
+        if -(-data['totalSize'] // data['chunkSize']) > settings.UPLOAD_MAX_CHUNKS:
+            raise serializers.ValidationError(
+                {'chunkSize': f'Uploads are limited to {settings.UPLOAD_MAX_CHUNKS} chunks'}
+            )
+        return data
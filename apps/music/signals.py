@@ -0,0 +1,15 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Song
+from . import counters
+
+
+@receiver(post_save, sender=Song)
+def count_created_song(sender, instance, created, **kwargs):
+    if created:
+        counters.adjust(instance.user_id, 1)
+
+
+@receiver(post_delete, sender=Song)
+def count_deleted_song(sender, instance, **kwargs):
+    counters.adjust(instance.user_id, -1)
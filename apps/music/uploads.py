@@ -0,0 +1,208 @@
+"""Disk-spooled chunk store for chunked uploads.
+
+Every upload gets a spool file under ``MEDIA_ROOT/uploads/``, preallocated to
+``total_chunks * chunk_size`` bytes. Each chunk is written with ``pwrite`` at
+its own offset, so chunks can arrive in any order and from parallel requests.
+The UploadSession row tracks only a bitmap of received chunks. The write and
+the bitmap update happen under the session's row lock, which finalizing
+also takes, so no chunk is written once the file has been hashed. Finalizing trims the spool file to its real size, checks the
+optional whole-file SHA-256 and renames the file into ``songs/``
+atomically. Audio bytes never pass through the database.
+
+Uploads are capped at ``UPLOAD_MAX_SIZE`` bytes and ``UPLOAD_MAX_CHUNKS``
+chunks. Unfinished sessions idle for ``UPLOAD_SESSION_TTL_SECONDS`` are
+removed with their spool files by ``expire()`` (``manage.py expire_uploads``).
+"""
+import errno
+import hashlib
+import hmac
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import UploadSession
+
+SPOOL_DIR = 'uploads'
+SONG_DIR = 'songs'
+
+
+class ChunkError(ValueError):
+    pass
+
+
+def spool_path(session):
+    return os.path.join(settings.MEDIA_ROOT, SPOOL_DIR, f'{session.user_id}_{session.pk}.part')
+
+
+def check_limits(total_chunks, chunk_size):
+    """Reject uploads larger than the configured limits"""
+    if total_chunks < 1 or chunk_size < 1:
+        raise ChunkError('totalChunks and chunkSize must be positive')
+    if total_chunks > settings.UPLOAD_MAX_CHUNKS:
+        raise ChunkError(f'Uploads are limited to {settings.UPLOAD_MAX_CHUNKS} chunks')
+    # The last chunk may be short, so only the others must fit
+    if (total_chunks - 1) * chunk_size >= settings.UPLOAD_MAX_SIZE:
+        raise ChunkError(f'Uploads are limited to {settings.UPLOAD_MAX_SIZE} bytes')
+
+
+def _preallocate(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if hasattr(os, 'posix_fallocate') and size > 0:
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def open_session(user, unique_id, filename, total_chunks, chunk_size, title='', checksum=''):
+    """Get or create the upload session and its spool file"""
+    check_limits(total_chunks, chunk_size)
+
+    filename = os.path.basename(filename) or 'Untitled'
+    session, created = UploadSession.objects.get_or_create(
+        user=user,
+        unique_id=unique_id,
+        defaults={
+            'filename': filename,
+            'title': title or filename,
+            'checksum': checksum.lower(),
+            'total_chunks': total_chunks,
+            'chunk_size': chunk_size,
+            'received': bytes((total_chunks + 7) // 8),
+        }
+    )
+    if not os.path.exists(spool_path(session)) and session.completed_at is None:
+        try:
+            _preallocate(spool_path(session), session.total_chunks * session.chunk_size)
+        except OSError as e:
+            if e.errno not in (errno.ENOSPC, errno.EDQUOT, errno.EFBIG):
+                raise
+            discard(session)
+            raise ChunkError('Not enough storage for this upload')
+    return session
+
+
+def verify_checksum(data, expected):
+    """Compare a SHA-256 hex digest against the chunk; no-op if none given"""
+    if expected and not hmac.compare_digest(hashlib.sha256(data).hexdigest(), expected.lower()):
+        raise ChunkError('Chunk checksum mismatch')
+
+
+def write_chunk(session, index, data, checksum=None):
+    """Write one chunk at its offset and mark it received.
+
+    Returns ``(session, completed_now)``; ``completed_now`` is True only for
+    the request whose chunk completed the upload, so exactly one caller
+    finalizes it.
+    """
+    verify_checksum(data, checksum)
+    if not 0 <= index < session.total_chunks:
+        raise ChunkError(f'Chunk index {index} out of range')
+    is_last = index == session.total_chunks - 1
+    if len(data) > session.chunk_size or (not is_last and len(data) != session.chunk_size):
+        raise ChunkError(f'Chunk {index} has size {len(data)}, expected {session.chunk_size}')
+
+    # The write happens under the row lock finalize() also holds. Otherwise
+    # a retried chunk could land in the renamed song file after its hash
+    # was taken.
+    with transaction.atomic():
+        locked = UploadSession.objects.select_for_update().get(pk=session.pk)
+        if locked.completed_at is not None:
+            raise ChunkError('Upload already finalized')
+        try:
+            fd = os.open(spool_path(locked), os.O_WRONLY)
+        except FileNotFoundError:
+            # Discarded by another request
+            raise ChunkError('Upload no longer exists')
+        try:
+            os.pwrite(fd, data, index * locked.chunk_size)
+        finally:
+            os.close(fd)
+
+        bitmap = bytearray(locked.received)
+        byte, bit = divmod(index, 8)
+        was_complete = locked.is_complete
+        if not bitmap[byte] & (1 << bit):
+            bitmap[byte] |= 1 << bit
+            locked.received = bytes(bitmap)
+            locked.received_count += 1
+        if is_last:
+            locked.total_size = index * locked.chunk_size + len(data)
+        locked.save(update_fields=['received', 'received_count', 'total_size', 'updated_at'])
+
+    return locked, locked.is_complete and not was_complete
+
+
+def missing_chunks(session):
+    """Indices of the chunks not received yet"""
+    bitmap = bytes(session.received)
+    return [
+        index for index in range(session.total_chunks)
+        if not bitmap[index // 8] & (1 << (index % 8))
+    ]
+
+
+def _hash_file(f, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    f.seek(0)
+    for block in iter(lambda: f.read(chunk_size), b''):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def finalize(session):
+    """Move the completed spool file into songs/.
+
+    Returns ``(relative_path, sha256)``. Must be called with the session row
+    locked (or from the single request that completed it) so the rename
+    happens once.
+    """
+    if not session.is_complete:
+        raise ChunkError('Upload is missing chunks')
+
+    source = spool_path(session)
+    # uniqueId comes from the client, so it can't name the file: two users
+    # (or one reusing an ID) would overwrite each other's songs
+    relative_path = os.path.join(SONG_DIR, f'{session.user_id}_{session.pk}_{session.filename}')
+    destination = os.path.join(settings.MEDIA_ROOT, relative_path)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+    with open(source, 'r+b') as f:
+        f.truncate(session.total_size)
+        digest = _hash_file(f)
+        if session.checksum and not hmac.compare_digest(digest, session.checksum):
+            raise ChunkError('File checksum mismatch')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(source, destination)
+
+    session.completed_at = timezone.now()
+    session.save(update_fields=['completed_at', 'updated_at'])
+    return relative_path, digest
+
+
+def discard(session):
+    """Delete an abandoned upload's spool file and session"""
+    try:
+        os.remove(spool_path(session))
+    except FileNotFoundError:
+        pass
+    session.delete()
+
+
+def expire(now=None):
+    """Discard unfinished uploads idle longer than UPLOAD_SESSION_TTL_SECONDS.
+
+    Returns the number of sessions removed.
+    """
+    cutoff = (now or timezone.now()) - timedelta(seconds=settings.UPLOAD_SESSION_TTL_SECONDS)
+    expired = UploadSession.objects.filter(completed_at__isnull=True, updated_at__lt=cutoff)
+    removed = 0
+    for session in expired.iterator():
+        discard(session)
+        removed += 1
+    return removed
@@ -3,7 +3,12 @@ from . import views
 
 urlpatterns = [
     path('upload/', views.upload_song, name='upload-song'),
+    path('uploads/', views.create_upload, name='create-upload'),
+    path('uploads/<uuid:upload_id>/', views.upload_status, name='upload-status'),
+    path('uploads/<uuid:upload_id>/chunks/<int:index>/', views.upload_chunk, name='upload-chunk'),
+    path('uploads/<uuid:upload_id>/complete/', views.complete_upload, name='complete-upload'),
     path('', views.list_songs, name='list-songs'),
     path('count/', views.get_song_count, name='song-count'),
     path('analyse/<int:song_id>/', views.analyze_song, name='analyze-song'),
+    path('analyse/<int:song_id>/events/', views.analysis_events, name='analysis-events'),
 ]
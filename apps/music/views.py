@@ -1,14 +1,33 @@
-import os
+import asyncio
+import base64
+import binascii
+import json
+import uuid
+from asgiref.sync import sync_to_async
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes, parser_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from django.conf import settings
 from django.core.paginator import Paginator
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from django.db import transaction
 from django.db.models import Q
-from .models import Song, SongChunk
-from .serializers import SongSerializer, SongListSerializer
-from apps.analysis.tasks import analyze_song_task # type: ignore
+from .models import Song, UploadSession
+from . import uploads, counters
+from .serializers import SongSerializer, SongListSerializer, UploadSessionCreateSerializer
+from apps.analysis.models import SongAnalysis
+from apps.analysis import content_cache, scheduling, progress
+
+MAX_PAGE_SIZE = 100
+
+# Seconds between SSE keep-alive comments while no stage event arrives
+PROGRESS_HEARTBEAT_SECONDS = 15
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -21,57 +40,54 @@ def upload_song(request):
     original_name = request.data.get('originalname', 'Untitled')
     
     if chunk_number is not None and total_chunks is not None:
-        # This is a chunked upload
-        chunk_data = request.FILES['file'].read()
-        
-        # Create or get song instance
-        song, created = Song.objects.get_or_create(
-            user=request.user,
-            title=original_name,
-            defaults={'file': None}
-        )
-        
-        # Save chunk
-        SongChunk.objects.create(
-            song=song,
-            chunk_number=int(chunk_number),
-            total_chunks=int(total_chunks),
-            chunk_data=chunk_data,
-            unique_id=unique_id
-        )
-        
-        # Check if all chunks are uploaded
-        uploaded_chunks = SongChunk.objects.filter(
-            song=song,
-            unique_id=unique_id
-        ).count()
+        # This is a chunked upload, spooled straight to disk
+        chunk_file = request.FILES.get('file')
+        if chunk_file is None:
+            return Response({'error': 'file is required'}, status=status.HTTP_400_BAD_REQUEST)
+        chunk_size = request.data.get('chunkSize')
+        try:
+            index = int(chunk_number) - settings.UPLOAD_CHUNK_NUMBER_BASE
+            total_chunks = int(total_chunks)
+            chunk_size = int(chunk_size) if chunk_size is not None else None
+        except ValueError:
+            return Response(
+                {'error': 'chunkNumber, totalChunks and chunkSize must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if total_chunks < 1 or (chunk_size is not None and chunk_size < 1):
+            return Response(
+                {'error': 'totalChunks and chunkSize must be positive'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not unique_id:
+            return Response({'error': 'uniqueId is required'}, status=status.HTTP_400_BAD_REQUEST)
+        chunk_data = chunk_file.read()
+
+        # Chunks other than the last all share the first one's size
+        if chunk_size is None and (total_chunks == 1 or index < total_chunks - 1):
+            chunk_size = len(chunk_data)
+
+        try:
+            session = UploadSession.objects.filter(user=request.user, unique_id=unique_id).first()
+            if session is None:
+                if chunk_size is None:
+                    return Response(
+                        {'error': 'chunkSize is required when the last chunk arrives first'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                session = uploads.open_session(
+                    request.user, unique_id, original_name, total_chunks, chunk_size,
+                    title=original_name
+                )
+            session, completed = uploads.write_chunk(session, index, chunk_data)
+        except uploads.ChunkError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
-        if uploaded_chunks == int(total_chunks):
-            # Combine chunks and save file
-            chunks = SongChunk.objects.filter(
-                song=song,
-                unique_id=unique_id
-            ).order_by('chunk_number')
-            
-            # Create the complete file
-            file_path = f'songs/{unique_id}_{original_name}'
-            full_path = os.path.join('media', file_path)
-            
-            os.makedirs(os.path.dirname(full_path), exist_ok=True)
-            
-            with open(full_path, 'wb') as f:
-                for chunk in chunks:
-                    f.write(chunk.chunk_data)
-            
-            # Update song with file path
-            song.file = file_path
-            song.save()
-            
-            # Clean up chunks
-            chunks.delete()
-            
-            # Trigger analysis
-            analyze_song_task.delay(song.id)
+        if completed:
+            try:
+                song = _complete_upload(session)
+            except uploads.ChunkError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
             
             return Response({
                 'message': 'Upload complete',
@@ -87,21 +103,211 @@ def upload_song(request):
         serializer = SongSerializer(data=request.data)
         if serializer.is_valid():
             song = serializer.save(user=request.user)
+            content_cache.ensure_content_hash(song)
             
-            # Trigger analysis
-            analyze_song_task.delay(song.id)
+            # Trigger analysis unless this audio was already analysed
+            if not content_cache.apply_cached_result(song):
+                scheduling.schedule_analysis(song)
             
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+def _complete_upload(session):
+    """Turn a fully received upload into a Song and start its analysis"""
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().get(pk=session.pk)
+        if session.song_id:
+            return session.song
+
+        # Move the spooled file into place
+        file_path, content_hash = uploads.finalize(session)
+        song = Song.objects.create(
+            user=session.user,
+            title=session.title or session.filename,
+            file=file_path,
+            content_hash=content_hash
+        )
+        session.song = song
+        session.save(update_fields=['song', 'updated_at'])
+
+    # Trigger analysis unless this audio was already analysed
+    if not content_cache.apply_cached_result(song):
+        scheduling.schedule_analysis(song)
+    return song
+
+def _upload_status(session):
+    missing = uploads.missing_chunks(session)
+    return {
+        'uploadId': str(session.upload_id),
+        'chunkSize': session.chunk_size,
+        'totalChunks': session.total_chunks,
+        'receivedChunks': session.received_count,
+        'missingChunks': missing,
+        'complete': session.completed_at is not None,
+        'songId': session.song_id
+    }
+
+def _get_upload(request, upload_id):
+    return UploadSession.objects.filter(upload_id=upload_id, user=request.user).first()
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def create_upload(request):
+    serializer = UploadSessionCreateSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    data = serializer.validated_data
+    total_chunks = -(-data['totalSize'] // data['chunkSize'])
+    try:
+        session = uploads.open_session(
+            request.user,
+            data.get('uniqueId') or uuid.uuid4().hex,
+            data['filename'],
+            total_chunks,
+            data['chunkSize'],
+            title=data.get('title', ''),
+            checksum=data.get('checksum', '')
+        )
+    except uploads.ChunkError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(_upload_status(session), status=status.HTTP_201_CREATED)
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def upload_status(request, upload_id):
+    session = _get_upload(request, upload_id)
+    if session is None:
+        return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    if request.method == 'DELETE':
+        if session.completed_at is None:
+            uploads.discard(session)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    return Response(_upload_status(session), status=status.HTTP_200_OK)
+
+@api_view(['PUT'])
+@permission_classes([IsAuthenticated])
+def upload_chunk(request, upload_id, index):
+    """Store one chunk; chunks may arrive in any order and in parallel.
+
+    The body is the raw chunk (or a multipart ``file`` field). An optional
+    ``X-Chunk-Checksum`` header carries its SHA-256 hex digest.
+    """
+    session = _get_upload(request, upload_id)
+    if session is None:
+        return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    if request.content_type.startswith('multipart/'):
+        chunk_file = request.FILES.get('file')
+        if chunk_file is None:
+            return Response({'error': 'file is required'}, status=status.HTTP_400_BAD_REQUEST)
+        chunk_data = chunk_file.read()
+    else:
+        chunk_data = request.body
+
+    try:
+        session, completed = uploads.write_chunk(
+            session, index, chunk_data,
+            checksum=request.headers.get('X-Chunk-Checksum')
+        )
+    except uploads.ChunkError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response({
+        'index': index,
+        'receivedChunks': session.received_count,
+        'totalChunks': session.total_chunks
+    }, status=status.HTTP_200_OK)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def complete_upload(request, upload_id):
+    session = _get_upload(request, upload_id)
+    if session is None:
+        return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    if not session.is_complete:
+        return Response({
+            'error': 'Upload is missing chunks',
+            'missingChunks': uploads.missing_chunks(session)
+        }, status=status.HTTP_409_CONFLICT)
+
+    try:
+        song = _complete_upload(session)
+    except uploads.ChunkError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response({
+        'message': 'Upload complete',
+        'song_id': song.id
+    }, status=status.HTTP_201_CREATED)
+
+def _encode_cursor(song):
+    raw = f'{song.created_at.isoformat()}|{song.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor):
+    created_at, song_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    created_at = parse_datetime(created_at)
+    if created_at is None:
+        raise ValueError('Invalid cursor')
+    return created_at, int(song_id)
+
+def _list_songs_keyset(request, songs, cursor, limit):
+    """Keyset page on (created_at, id): a single index range scan at any depth"""
+    if cursor:
+        try:
+            created_at, song_id = _decode_cursor(cursor)
+        except (ValueError, UnicodeDecodeError, binascii.Error):
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+        # The redundant created_at bound gives the planner an index range to
+        # scan; the OR alone often falls back to a filter over the user's rows
+        songs = songs.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=song_id),
+            created_at__lte=created_at
+        )
+
+    rows = list(songs.order_by('-created_at', '-id')[:limit + 1])
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    serializer = SongListSerializer(rows, many=True)
+
+    return Response({
+        'data': serializer.data,
+        'pagination': {
+            'totalItems': counters.get_count(request.user.id),
+            'nextCursor': _encode_cursor(rows[-1]) if has_next else None,
+            'hasNext': has_next
+        }
+    }, status=status.HTTP_200_OK)
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def list_songs(request):
+    """List the user's songs.
+
+    ``?cursor=`` (empty for the first page) selects keyset pagination and
+    returns ``nextCursor``. Without it, the original ``page``/``limit``
+    offset pagination is used.
+    """
     page = request.GET.get('page', 1)
     limit = request.GET.get('limit', 10)
     
     songs = Song.objects.filter(user=request.user)
+
+    cursor = request.GET.get('cursor')
+    if cursor is not None:
+        try:
+            limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        except ValueError:
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        return _list_songs_keyset(request, songs, cursor, limit)
+
     paginator = Paginator(songs, limit)
+    # Use the maintained counter instead of a COUNT(*) per page
+    paginator.count = counters.get_count(request.user.id)
     
     try:
         songs_page = paginator.page(page)
@@ -124,7 +330,7 @@ def list_songs(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_song_count(request):
-    count = Song.objects.filter(user=request.user).count()
+    count = counters.get_count(request.user.id)
     return Response({'count': count}, status=status.HTTP_200_OK)
 
 @api_view(['GET'])
@@ -133,23 +339,107 @@ def analyze_song(request, song_id):
     try:
         song = Song.objects.get(id=song_id, user=request.user)
         
-        # Get or create analysis
-        analysis = getattr(song, 'analysis', None)
+        # Starts an analysis only if none is active or completed; repeated
+        # calls report the existing task instead of enqueueing another
+        analysis, scheduled = scheduling.schedule_analysis(song)
         
-        if analysis:
-            return Response({
-                'request_id': analysis.id,
-                'title': song.title,
-                'status': 'completed' if song.is_analyzed else 'processing'
-            }, status=status.HTTP_200_OK)
-        else:
-            # Trigger analysis if not exists
-            analyze_song_task.delay(song.id)
+        if scheduled:
             return Response({
                 'message': 'Analysis started',
+                'request_id': analysis.id,
                 'title': song.title,
-                'status': 'processing'
+                'status': 'processing',
+                'state': analysis.state,
+                'task_id': analysis.task_id
             }, status=status.HTTP_200_OK)
+        
+        return Response({
+            'request_id': analysis.id,
+            'title': song.title,
+            'status': 'completed' if song.is_analyzed else 'processing',
+            'state': analysis.state,
+            'task_id': analysis.task_id,
+            'queued_at': analysis.queued_at,
+            'started_at': analysis.started_at,
+            'finished_at': analysis.finished_at
+        }, status=status.HTTP_200_OK)
             
     except Song.DoesNotExist:
         return Response({'error': 'Song not found'}, status=status.HTTP_404_NOT_FOUND)
+
+async def _authenticate_stream(request):
+    """JWT auth for the event stream.
+
+    EventSource can't set headers, so the access token may also be passed
+    as ``?token=``.
+    """
+    authenticator = JWTAuthentication()
+    raw_token = request.GET.get('token')
+    try:
+        if raw_token:
+            validated_token = authenticator.get_validated_token(raw_token)
+            return await sync_to_async(authenticator.get_user)(validated_token)
+        result = await sync_to_async(authenticator.authenticate)(request)
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return None
+    return result[0] if result else None
+
+def _sse(event):
+    return f"event: {event['stage']}\ndata: {json.dumps(event)}\n\n"
+
+async def _progress_stream(song_id):
+    # Subscribe before reading the current state so no event falls between
+    client, pubsub = await progress.subscribe(song_id)
+    try:
+        analysis = await SongAnalysis.objects.filter(song_id=song_id).values(
+            'state', 'error_message'
+        ).afirst()
+        if analysis and analysis['state'] == SongAnalysis.STATE_COMPLETED:
+            yield _sse(progress.event(song_id, 'done'))
+            return
+        if analysis and analysis['state'] == SongAnalysis.STATE_FAILED:
+            yield _sse(progress.event(song_id, 'failed', error=analysis['error_message']))
+            return
+
+        last = await progress.last_event(client, song_id)
+        if last:
+            yield _sse(last)
+            if last['stage'] in progress.TERMINAL_STAGES:
+                return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.ANALYSIS_PROGRESS_STREAM_SECONDS
+        while loop.time() < deadline:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True,
+                timeout=PROGRESS_HEARTBEAT_SECONDS
+            )
+            if message is None:
+                yield ': keep-alive\n\n'
+                continue
+            event = json.loads(message['data'])
+            yield _sse(event)
+            if event['stage'] in progress.TERMINAL_STAGES:
+                return
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+        await client.aclose()
+
+async def analysis_events(request, song_id):
+    """Server-Sent Events stream of a song's analysis stages.
+
+    Ends after ``done`` or ``failed``, or after
+    ANALYSIS_PROGRESS_STREAM_SECONDS, when EventSource reconnects by itself.
+    """
+    user = await _authenticate_stream(request)
+    if user is None:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+    if not await Song.objects.filter(id=song_id, user=user).aexists():
+        return JsonResponse({'error': 'Song not found'}, status=404)
+
+    return StreamingHttpResponse(
+        _progress_stream(song_id),
+        content_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'moodsinger.settings')
 
 application = get_asgi_application()
+
+from django.conf import settings  # noqa: E402
+
+if settings.SIMILARITY_WARM_ON_START:
+    from apps.analysis import similarity  # noqa: E402
+    similarity.warm_in_background()
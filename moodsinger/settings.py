@@ -56,8 +56,10 @@ INSTALLED_APPS = [
     'apps.music',
     'apps.analysis',
     'apps.feature_settings',
+    'apps.monitoring',
 ]
 MIDDLEWARE = [
+    'apps.monitoring.middleware.RequestLatencyMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -147,6 +149,20 @@ CORS_ALLOWED_ORIGINS = [
     "http://localhost:3001",
 ]
 
+# Cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': config('CACHE_URL', default=config('REDIS_URL', default='redis://localhost:6379/0')),
+    }
+}
+
+# Serialized get_analysis payloads: Redis TTL, plus the size and TTL of the
+# per-process LRU in front of it (kept short, other processes can't clear it)
+ANALYSIS_READ_CACHE_SECONDS = config('ANALYSIS_READ_CACHE_SECONDS', default=86400, cast=int)
+ANALYSIS_LOCAL_CACHE_SIZE = config('ANALYSIS_LOCAL_CACHE_SIZE', default=1024, cast=int)
+ANALYSIS_LOCAL_CACHE_SECONDS = config('ANALYSIS_LOCAL_CACHE_SECONDS', default=5, cast=int)
+
 # Celery Configuration
 CELERY_BROKER_URL = config('REDIS_URL', default='redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = config('REDIS_URL', default='redis://localhost:6379/0')
@@ -154,6 +170,89 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
+# Light librosa work and heavy Spleeter/OpenL3 work go to separate queues so
+# their worker pools can be sized independently.
+ANALYSIS_LIGHT_QUEUE = config('ANALYSIS_LIGHT_QUEUE', default='analysis_light')
+ANALYSIS_HEAVY_QUEUE = config('ANALYSIS_HEAVY_QUEUE', default='analysis_heavy')
+# Analyses queued, or running without a stage heartbeat, for longer than this
+# are considered lost and may be rescheduled.
+ANALYSIS_STALE_SECONDS = config('ANALYSIS_STALE_SECONDS', default=3600, cast=int)
+# Analysis progress events (Redis pub/sub, relayed to clients over SSE)
+ANALYSIS_PROGRESS_REDIS_URL = config('ANALYSIS_PROGRESS_REDIS_URL', default=CELERY_BROKER_URL)
+ANALYSIS_PROGRESS_TTL = config('ANALYSIS_PROGRESS_TTL', default=3600, cast=int)
+ANALYSIS_PROGRESS_STREAM_SECONDS = config('ANALYSIS_PROGRESS_STREAM_SECONDS', default=900, cast=int)
+CELERY_TASK_ROUTES = {
+    'apps.analysis.tasks.analyze_stems_stage': {'queue': ANALYSIS_HEAVY_QUEUE},
+    'apps.analysis.tasks.analyze_songs_batch_task': {'queue': ANALYSIS_HEAVY_QUEUE},
+    'apps.analysis.tasks.*': {'queue': ANALYSIS_LIGHT_QUEUE},
+}
+
+# Analysis models are loaded once per worker process; warming up also runs a
+# dummy inference so the first song doesn't pay for graph initialisation.
+ANALYSIS_PRELOAD_MODELS = config('ANALYSIS_PRELOAD_MODELS', default=True, cast=bool)
+ANALYSIS_WARM_UP_MODELS = config('ANALYSIS_WARM_UP_MODELS', default=False, cast=bool)
+# Keep frame-level features and per-frame stem embeddings on the media volume
+# (see apps/analysis/feature_store.py).
+ANALYSIS_FEATURE_STORE = config('ANALYSIS_FEATURE_STORE', default=True, cast=bool)
+# Light-queue workers can skip loading Spleeter and OpenL3.
+ANALYSIS_PRELOAD_STEM_MODELS = config('ANALYSIS_PRELOAD_STEM_MODELS', default=True, cast=bool)
+# Keep separated stems in memory instead of writing them to temp wav files.
+ANALYSIS_STEMS_IN_MEMORY = config('ANALYSIS_STEMS_IN_MEMORY', default=True, cast=bool)
+# Batch analysis: feature-extraction processes (None = one per CPU) and how
+# many songs share one stem-embedding batch.
+ANALYSIS_BATCH_PROCESSES = config('ANALYSIS_BATCH_PROCESSES', default=None, cast=lambda v: int(v) if v else None)
+ANALYSIS_STEM_BATCH_SONGS = config('ANALYSIS_STEM_BATCH_SONGS', default=4, cast=int)
+# OpenL3 embedding: 'default' uses a 0.1 s hop, 'fast' a 0.5 s hop. An
+# explicit hop size (seconds) overrides the preset.
+ANALYSIS_EMBEDDING_PRESET = config('ANALYSIS_EMBEDDING_PRESET', default='default')
+ANALYSIS_EMBEDDING_HOP_SIZE = config('ANALYSIS_EMBEDDING_HOP_SIZE', default=None, cast=lambda v: float(v) if v else None)
+ANALYSIS_EMBEDDING_BATCH_SIZE = config('ANALYSIS_EMBEDDING_BATCH_SIZE', default=32, cast=int)
+
+# Prometheus histograms are aggregated in Redis across web and worker
+# processes and served at /metrics, behind a bearer token when one is set.
+METRICS_REDIS_URL = config('METRICS_REDIS_URL', default=CELERY_BROKER_URL)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+# Socket timeouts of the metrics client, and how request latencies are
+# buffered before a background thread sends them
+METRICS_REDIS_TIMEOUT = config('METRICS_REDIS_TIMEOUT', default=0.25, cast=float)
+METRICS_FLUSH_SECONDS = config('METRICS_FLUSH_SECONDS', default=1.0, cast=float)
+METRICS_BUFFER_SIZE = config('METRICS_BUFFER_SIZE', default=10000, cast=int)
+
+# Similar-song search: indexes switch to IVF partitioning above this many
+# songs and poll for new embeddings at most this often. build_similarity_index
+# writes them to SIMILARITY_INDEX_DIR, and web processes map them at start-up.
+SIMILARITY_IVF_THRESHOLD = config('SIMILARITY_IVF_THRESHOLD', default=50000, cast=int)
+SIMILARITY_REFRESH_SECONDS = config('SIMILARITY_REFRESH_SECONDS', default=30, cast=int)
+SIMILARITY_INDEX_DIR = config('SIMILARITY_INDEX_DIR', default=os.path.join(BASE_DIR, 'similarity_index'))
+SIMILARITY_WARM_ON_START = config('SIMILARITY_WARM_ON_START', default=True, cast=bool)
+
 # File upload settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024  # 100 MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024  # 100 MB
+# Chunked uploads: largest file, most chunks per upload, and how long an
+# unfinished upload is kept before `manage.py expire_uploads` deletes it
+UPLOAD_MAX_SIZE = config('UPLOAD_MAX_SIZE', default=1024 * 1024 * 1024, cast=int)
+UPLOAD_MAX_CHUNKS = config('UPLOAD_MAX_CHUNKS', default=10000, cast=int)
+UPLOAD_SESSION_TTL_SECONDS = config('UPLOAD_SESSION_TTL_SECONDS', default=24 * 3600, cast=int)
+# First chunkNumber of the legacy POST /upload endpoint. The existing clients
+# count from 1; the upload-session API always uses 0-based indices.
+UPLOAD_CHUNK_NUMBER_BASE = config('UPLOAD_CHUNK_NUMBER_BASE', default=1, cast=int)
+
+# Logging
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'default': {'format': '%(asctime)s %(levelname)s %(name)s %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'default'},
+    },
+    'loggers': {
+        'apps': {
+            'handlers': ['console'],
+            'level': config('LOG_LEVEL', default='INFO'),
+            'propagate': False,
+        },
+    },
+}
@@ -39,6 +39,7 @@ urlpatterns = [
     path('api/analysis/', include('apps.analysis.urls')),
     path('api/feature-settings/', include('apps.feature_settings.urls')),
     path('api/docs/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
+    path('', include('apps.monitoring.urls')),
 ]
 
 if settings.DEBUG:
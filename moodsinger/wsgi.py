@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'moodsinger.settings')
 
 application = get_wsgi_application()
+
+from django.conf import settings  # noqa: E402
+
+if settings.SIMILARITY_WARM_ON_START:
+    from apps.analysis import similarity  # noqa: E402
+    similarity.warm_in_background()